@@ -0,0 +1 @@
+from terra_project_ll97_dataset.api import DatasetResults, build_datasets, join_datasets
@@ -0,0 +1,319 @@
+"""
+Library API for building the LL97 datasets from in-memory data.
+
+build_datasets runs the same join, cleaning and calculations as the build_dataset command on
+pandas DataFrames or Arrow tables and returns the results as DataFrames, without writing or reading
+any file. The metrics are returned separately from the building columns, and the wide datasets
+written by the command line tool are assembled on request without copying the building columns.
+"""
+
+import os
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from terra_project_ll97_dataset.calculator.coefficient_tables import CoefficientTables, load_coefficient_tables
+from terra_project_ll97_dataset.calculator.energy_unit_conversion import get_energy_consumption_matrix
+from terra_project_ll97_dataset.calculator.retrofits import calculate_minimum_cost_retrofits, load_retrofit_grid, \
+    retrofits_to_long_dataframe
+from terra_project_ll97_dataset.calculator.scenarios import calculate_scenario_metrics, load_scenario_grid, \
+    scenario_metrics_to_long_dataframe
+from terra_project_ll97_dataset.calculator.uncertainty import Uncertainty, bands_to_dataframe, \
+    calculate_sampled_metrics
+from terra_project_ll97_dataset.calculator.yearly_metrics import YearlyMetrics, calculate_year_range_metrics, \
+    calculate_yearly_metrics
+from terra_project_ll97_dataset.dataset.baseline_years import calculate_trend_features, get_reporting_years, \
+    insert_baseline_years, replace_energy_use_with_trend
+from terra_project_ll97_dataset.dataset.bbl_join import JoinDiagnostics, join_ll97_ll84, \
+    join_ll97_ll84_by_baseline_year
+from terra_project_ll97_dataset.dataset.column_projection import LL84_BBL_COLUMN, LL97_BBL_COLUMN, \
+    drop_year_columns, get_required_ll84_columns, select_columns
+from terra_project_ll97_dataset.dataset.data_cleansing import clean_and_count_numerical_columns
+from terra_project_ll97_dataset.util.common import get_required_metrics, get_year_ranges, get_years_in_range
+
+START_YEAR = 2024
+END_YEAR = 2050
+
+DEFAULT_CARBON_EMISSIONS_BY_BUILDING_TYPE_FILE_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "data", "carbon_thresholds_by_building_type.csv")
+
+
+def _to_dataframe(data: Any) -> pd.DataFrame:
+    # pyarrow tables and record batches, and other objects with a to_pandas method
+    if isinstance(data, pd.DataFrame):
+        return data
+    if hasattr(data, "to_pandas"):
+        return data.to_pandas()
+    raise TypeError(f"expected a pandas DataFrame or an Arrow table, got {type(data).__name__}")
+
+
+def _with_integer_bbls(df: pd.DataFrame, column: str) -> pd.DataFrame:
+    """
+    Numeric BBLs as integers, which the join reads as strings. read_csv parses a BBL column with blanks
+    as floats, and 1000010001.0 is not a valid BBL.
+    """
+    bbls = df[column]
+    if not pd.api.types.is_float_dtype(bbls):
+        return df
+    values = bbls.dropna().to_numpy(dtype=float)
+    if not np.array_equal(values, np.round(values)):
+        return df
+    return df.assign(**{column: bbls.astype("Int64")})
+
+
+def concat_columns(frames: List[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Concatenate frames with the same index side by side. The columns reference the arrays of the
+    input frames instead of copying them, so the result must not be modified in place.
+    """
+    # without copy on write, concat consolidates the columns of the same dtype into new arrays
+    with pd.option_context("mode.copy_on_write", True):
+        return pd.concat(frames, axis=1)
+
+
+def join_datasets(ll97: Any,
+                  ll84: Any,
+                  keep_columns: Optional[List[str]] = None,
+                  mixed_use_thresholds: bool = False,
+                  by_baseline_year: bool = False,
+                  trend_features: bool = False,
+                  project_from_trend: bool = False) -> Tuple[pd.DataFrame, JoinDiagnostics, Dict]:
+    """
+    Join the LL84 benchmarking data onto the LL97 buildings and clean the numerical columns.
+    The input frames are not modified.
+
+    Args:
+        ll97: LL97 DataFrame or Arrow table with a "BBL" column, of strings or of integer valued numbers
+        ll84: LL84 DataFrame or Arrow table with a "NYC Borough, Block and Lot (BBL)" column, or a list of
+            them, e.g. one per reporting year, which are concatenated in order
+        keep_columns (Optional[List[str]]): Passthrough columns, or ["all"] to keep every column
+        mixed_use_thresholds (bool): Also keep the columns read by the mixed use thresholds
+        by_baseline_year (bool): Join one row for each building and LL84 reporting year, see
+            join_ll97_ll84_by_baseline_year, instead of the first LL84 row of each building
+        trend_features (bool): Add the trend of the energy use of each building over its reporting years,
+            see calculate_trend_features, requires by_baseline_year
+        project_from_trend (bool): Replace the energy use of each row with its trend value, see
+            replace_energy_use_with_trend, requires trend_features
+
+    Returns:
+        Tuple[pd.DataFrame, JoinDiagnostics, Dict]: The joined dataset in LL97 order indexed by BBL,
+        the diagnostics of the join, and the missing and coerced value counts of each numerical column
+
+    Raises:
+        ValueError: If trend_features is set without by_baseline_year, project_from_trend without trend_features,
+            or the LL84 data has no reporting year
+    """
+    if trend_features and not by_baseline_year:
+        raise ValueError("the trend features are calculated over the baseline years, they require by_baseline_year")
+    if project_from_trend and not trend_features:
+        raise ValueError("the projections from the trend use the trend features, they require trend_features")
+    ll97_df = _to_dataframe(ll97)
+    ll84_frames = [_to_dataframe(frame) for frame in ll84] if isinstance(ll84, (list, tuple)) else [
+        _to_dataframe(ll84)]
+    required_ll84_columns = get_required_ll84_columns(mixed_use_thresholds, by_baseline_year)
+    ll84_frames = [_with_integer_bbls(frame[select_columns(list(frame.columns), required_ll84_columns, keep_columns)],
+                                      LL84_BBL_COLUMN)
+                   for frame in ll84_frames]
+    ll84_df = pd.concat(ll84_frames, ignore_index=True) if len(ll84_frames) > 1 else ll84_frames[0]
+    ll97_df = _with_integer_bbls(ll97_df[select_columns(list(ll97_df.columns), [LL97_BBL_COLUMN], keep_columns)],
+                                 LL97_BBL_COLUMN)
+
+    if by_baseline_year:
+        reporting_years = get_reporting_years(ll84_df)
+        ll84_df = drop_year_columns(ll84_df, keep_columns)
+        joined_df, join_diagnostics = join_ll97_ll84_by_baseline_year(ll97_df, ll84_df, reporting_years)
+    else:
+        joined_df, join_diagnostics = join_ll97_ll84(ll97_df, ll84_df)
+    joined_df, coerced_values = clean_and_count_numerical_columns(joined_df)
+    if trend_features:
+        joined_df = pd.concat([joined_df, calculate_trend_features(joined_df)], axis=1)
+    if project_from_trend:
+        joined_df = replace_energy_use_with_trend(joined_df)
+    return joined_df, join_diagnostics, coerced_values
+
+
+class DatasetResults:
+    """
+    Joined buildings and their calculated metrics, all indexed by BBL in LL97 order.
+    """
+
+    def __init__(
+            self,
+            buildings: pd.DataFrame,
+            yearly_metrics: YearlyMetrics,
+            year_range_metrics: YearlyMetrics,
+            join_diagnostics: JoinDiagnostics,
+            coerced_values: Dict,
+            scenarios: Optional[pd.DataFrame] = None,
+            retrofits: Optional[pd.DataFrame] = None,
+            yearly_bands: Optional[Dict[float, YearlyMetrics]] = None,
+            year_range_bands: Optional[Dict[float, YearlyMetrics]] = None):
+        """
+        Args:
+            buildings (pd.DataFrame): The joined and cleaned LL97/LL84 dataset
+            yearly_metrics (YearlyMetrics): (buildings x years) arrays of the requested metrics
+            year_range_metrics (YearlyMetrics): (buildings x year ranges) arrays of the requested metrics
+            join_diagnostics (JoinDiagnostics): BBLs that could not be joined one to one
+            coerced_values (Dict): Missing and coerced value counts of each numerical column
+            scenarios (Optional[pd.DataFrame]): Long scenario dataset, when scenarios were given
+            retrofits (Optional[pd.DataFrame]): Minimum cost retrofit of each building and year range,
+                when retrofit actions were given
+            yearly_bands (Optional[Dict[float, YearlyMetrics]]): (buildings x years) arrays of each percentile
+                of the Monte Carlo samples, when samples were drawn
+            year_range_bands (Optional[Dict[float, YearlyMetrics]]): (buildings x year ranges) arrays of each
+                percentile of the Monte Carlo samples, when samples were drawn
+        """
+        self.buildings = buildings
+        self.yearly_metrics = yearly_metrics
+        self.year_range_metrics = year_range_metrics
+        self.join_diagnostics = join_diagnostics
+        self.coerced_values = coerced_values
+        self.scenarios = scenarios
+        self.retrofits = retrofits
+        self.yearly_bands = yearly_bands
+        self.year_range_bands = year_range_bands
+
+    def get_yearly_metrics(self) -> pd.DataFrame:
+        """"{year}_{metric}" columns of every building."""
+        return self.yearly_metrics.to_dataframe(self.buildings.index)
+
+    def get_year_range_metrics(self) -> pd.DataFrame:
+        """"{year range}_{metric}_per_year" columns of every building."""
+        return self.year_range_metrics.to_dataframe(self.buildings.index)
+
+    def get_yearly_dataset(self) -> pd.DataFrame:
+        """
+        The yearly dataset written by the command line tool: the building columns followed by the yearly metrics.
+        The building columns are shared with buildings, see concat_columns.
+        """
+        return concat_columns([self.buildings, self.get_yearly_metrics()])
+
+    def get_year_range_dataset(self) -> pd.DataFrame:
+        """
+        The year range dataset written by the command line tool: the building columns followed by the
+        metrics averaged over each year range. The building columns are shared with buildings.
+        """
+        return concat_columns([self.buildings, self.get_year_range_metrics()])
+
+    def get_yearly_bands(self) -> pd.DataFrame:
+        """"{year}_{metric}_p{percentile}" columns of every building, when samples were drawn."""
+        return bands_to_dataframe(self.yearly_bands, self.buildings.index)
+
+    def get_year_range_bands(self) -> pd.DataFrame:
+        """"{year range}_{metric}_per_year_p{percentile}" columns of every building, when samples were drawn."""
+        return bands_to_dataframe(self.year_range_bands, self.buildings.index)
+
+
+def build_datasets(ll97: Any,
+                   ll84: Any,
+                   carbon_emissions_by_building_type: Union[str, pd.DataFrame] =
+                   DEFAULT_CARBON_EMISSIONS_BY_BUILDING_TYPE_FILE_PATH,
+                   year_ranges: Optional[List[Tuple[int, int]]] = None,
+                   keep_columns: Optional[List[str]] = None,
+                   scenarios: Optional[Union[str, pd.DataFrame]] = None,
+                   coefficient_tables: Optional[CoefficientTables] = None,
+                   metrics: Optional[List[str]] = None,
+                   years: Optional[List[int]] = None,
+                   mixed_use_thresholds: bool = False,
+                   retrofit_actions: Optional[Union[str, pd.DataFrame]] = None,
+                   samples: Optional[int] = None,
+                   uncertainty: Optional[Uncertainty] = None,
+                   sample_percentiles: Optional[List[float]] = None,
+                   seed: int = 0,
+                   by_baseline_year: bool = False,
+                   trend_features: bool = False,
+                   project_from_trend: bool = False) -> DatasetResults:
+    """
+    Join the LL97 and LL84 datasets and calculate the yearly, year range, scenario and retrofit metrics,
+    and their Monte Carlo bands, in memory.
+
+    Args:
+        ll97: LL97 DataFrame or Arrow table with a "BBL" column
+        ll84: LL84 DataFrame or Arrow table with a "NYC Borough, Block and Lot (BBL)" column, or a list of them
+        carbon_emissions_by_building_type (Union[str, pd.DataFrame]): Carbon thresholds file or DataFrame
+            (defaults to the included data file)
+        year_ranges (Optional[List[Tuple[int, int]]]): (start year, end year) tuples to average the metrics
+            over, with -1 as the end year of an open range (defaults to the compliance periods)
+        keep_columns (Optional[List[str]]): Passthrough columns, or ["all"] to keep every column
+        scenarios (Optional[Union[str, pd.DataFrame]]): Scenario file or DataFrame, see calculator/scenarios.py
+        coefficient_tables (Optional[CoefficientTables]): Precompiled coefficient tables, which replace
+            carbon_emissions_by_building_type when calling build_datasets repeatedly
+        metrics (Optional[List[str]]): Metrics to calculate (defaults to every metric in Metrics), only the
+            calculations they depend on are run
+        years (Optional[List[int]]): Years of the yearly metrics and scenarios (defaults to every year)
+        mixed_use_thresholds (bool): Sum the thresholds of the three largest uses of each building instead
+            of applying the threshold of the largest use to its floor area only
+        retrofit_actions (Optional[Union[str, pd.DataFrame]]): Retrofit action file or DataFrame,
+            see calculator/retrofits.py
+        samples (Optional[int]): Number of Monte Carlo samples to estimate the percentiles of every metric
+            over, see calculator/uncertainty.py
+        uncertainty (Optional[Uncertainty]): Standard deviations of the sampled perturbations
+            (defaults to Uncertainty())
+        sample_percentiles (Optional[List[float]]): Percentiles of the samples (defaults to SamplePercentiles)
+        seed (int): Seed of the samples
+        by_baseline_year (bool): Calculate every building from each of its LL84 reporting years, with one row
+            per building and baseline year, see join_ll97_ll84_by_baseline_year
+        trend_features (bool): Add the trend of the energy use of each building over its reporting years,
+            requires by_baseline_year
+        project_from_trend (bool): Calculate the metrics from the trend value of the energy use of each
+            building in its baseline year instead of the use it reported, requires trend_features
+
+    Returns:
+        DatasetResults: The joined buildings and their metrics
+
+    Raises:
+        ValueError: If metrics names an unknown metric, years or year_ranges fall outside of the coefficient tables,
+            trend_features is set without by_baseline_year or project_from_trend without trend_features
+    """
+    if coefficient_tables is None:
+        coefficient_tables = load_coefficient_tables(START_YEAR, END_YEAR, carbon_emissions_by_building_type)
+    required_metrics = get_required_metrics(metrics)
+    year_ranges = year_ranges or get_year_ranges()
+    years = sorted(set(years)) if years else coefficient_tables.years
+    # the yearly metrics are calculated for the selected years and the years of every year range
+    calculated_years = sorted(set(years).union(
+        *[get_years_in_range(year_range_tuple) for year_range_tuple in year_ranges]).intersection(
+        coefficient_tables.years))
+
+    joined_df, join_diagnostics, coerced_values = join_datasets(ll97, ll84, keep_columns, mixed_use_thresholds,
+                                                                by_baseline_year, trend_features,
+                                                                project_from_trend)
+    calculated_metrics = calculate_yearly_metrics(joined_df, calculated_years, coefficient_tables, metrics,
+                                                  mixed_use_thresholds)
+    yearly_metrics = calculated_metrics.select(years)
+    year_range_metrics = calculate_year_range_metrics(calculated_metrics, year_ranges)
+
+    scenario_df = None
+    if scenarios is not None:
+        scenario_grid = load_scenario_grid(scenarios, coefficient_tables)
+        energy_consumption, carbon_emissions_threshold = None, None
+        if "carbon_emissions" in required_metrics or "cost_of_energy" in required_metrics:
+            energy_consumption = get_energy_consumption_matrix(joined_df)
+        if "carbon_emissions_threshold" in required_metrics:
+            carbon_emissions_threshold = calculated_metrics.select(
+                years, ["carbon_emissions_threshold"]).values["carbon_emissions_threshold"]
+        scenario_metrics = calculate_scenario_metrics(
+            scenario_grid, slice(None), energy_consumption, carbon_emissions_threshold, years, metrics)
+        scenario_df = scenario_metrics_to_long_dataframe(
+            scenario_grid.names, joined_df.index, years, scenario_metrics, yearly_metrics.metrics)
+        if by_baseline_year:
+            insert_baseline_years(scenario_df, joined_df, 2, len(years), len(scenario_grid.names))
+
+    retrofit_df = None
+    if retrofit_actions is not None:
+        retrofit_grid = load_retrofit_grid(retrofit_actions)
+        retrofit_solutions = calculate_minimum_cost_retrofits(
+            retrofit_grid, joined_df, coefficient_tables, year_ranges, mixed_use_thresholds)
+        retrofit_df = retrofits_to_long_dataframe(retrofit_grid, joined_df.index, year_ranges, retrofit_solutions)
+        if by_baseline_year:
+            insert_baseline_years(retrofit_df, joined_df, 0, len(year_ranges))
+
+    yearly_bands, year_range_bands = None, None
+    if samples:
+        yearly_bands, year_range_bands = calculate_sampled_metrics(
+            joined_df, coefficient_tables, years, year_ranges, samples, uncertainty, sample_percentiles, seed,
+            metrics, mixed_use_thresholds)
+
+    return DatasetResults(joined_df, yearly_metrics, year_range_metrics, join_diagnostics, coerced_values,
+                          scenario_df, retrofit_df, yearly_bands, year_range_bands)
@@ -5,6 +5,16 @@ This module defines and parses command line arguments required for dataset proce
 
 import argparse
 import os
+from typing import List, Tuple
+
+from terra_project_ll97_dataset.api import DEFAULT_CARBON_EMISSIONS_BY_BUILDING_TYPE_FILE_PATH
+from terra_project_ll97_dataset.calculator.uncertainty import SamplePercentiles
+from terra_project_ll97_dataset.dataset.columnar_output import CSV_FORMAT, Compressions, OutputFormats, \
+    PartitionColumns
+from terra_project_ll97_dataset.dataset.dataset_cache import DEFAULT_CACHE_DIR
+from terra_project_ll97_dataset.dataset.sql_backend import PANDAS_BACKEND, Backends
+from terra_project_ll97_dataset.util.common import Metrics
+from terra_project_ll97_dataset.util.run_report import Profilers
 
 
 def _dir_path(path: str) -> str:
@@ -45,6 +55,96 @@ def _file_path(path: str) -> str:
         raise argparse.ArgumentTypeError(f"readable_file:{path} is not a valid file")
 
 
+def _year_range(year_range: str) -> Tuple[int, int]:
+    """
+    Parses a year range such as "2024-2034", or "2050+" for a range that covers only its start year.
+    
+    Args:
+        year_range (str): The year range to parse
+        
+    Returns:
+        Tuple[int, int]: The (start year, end year) tuple, with -1 as the end year of a "+" range
+        
+    Raises:
+        argparse.ArgumentTypeError: If the year range cannot be parsed
+    """
+    try:
+        if year_range.endswith("+"):
+            return int(year_range[:-1]), -1
+        start_year, end_year = year_range.split("-")
+        if int(end_year) < int(start_year):
+            raise ValueError
+        return int(start_year), int(end_year)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"year_range:{year_range} is not a valid year range")
+
+
+def _years(years: str) -> List[int]:
+    """
+    Parses a year such as "2030", or a range of years such as "2030-2034".
+    
+    Args:
+        years (str): The year or range of years to parse
+        
+    Returns:
+        List[int]: The years
+        
+    Raises:
+        argparse.ArgumentTypeError: If the years cannot be parsed
+    """
+    try:
+        if "-" not in years:
+            return [int(years)]
+        start_year, end_year = years.split("-")
+        if int(end_year) < int(start_year):
+            raise ValueError
+        return list(range(int(start_year), int(end_year) + 1))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"years:{years} is not a valid year or range of years")
+
+
+def _positive_int(value: str) -> int:
+    """
+    Parses a positive integer, such as a batch size or a number of workers.
+    
+    Args:
+        value (str): The integer to parse
+        
+    Returns:
+        int: The integer
+        
+    Raises:
+        argparse.ArgumentTypeError: If the value is not an integer greater than zero
+    """
+    try:
+        if int(value) < 1:
+            raise ValueError
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"positive_int:{value} is not a positive integer")
+
+
+def _percentile(value: str) -> float:
+    """
+    Parses a percentile between 0 and 100.
+    
+    Args:
+        value (str): The percentile to parse
+        
+    Returns:
+        float: The percentile
+        
+    Raises:
+        argparse.ArgumentTypeError: If the value is not a number between 0 and 100
+    """
+    try:
+        if not 0 <= float(value) <= 100:
+            raise ValueError
+        return float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"percentile:{value} is not a number between 0 and 100")
+
+
 class BuildDatasetArguments:
     """
     Handles command line argument parsing for the dataset builder.
@@ -77,19 +177,223 @@ class BuildDatasetArguments:
         self.parser.add_argument(
             "--ll84_dataset",
             type=_file_path,
-            help="location of the .csv file that contains the LL84 dataset for the most recent year"
+            nargs="+",
+            help="location of the .csv file that contains the LL84 dataset for the most recent year, or of several "
+                 "files, e.g. one per reporting year, which are read one after the other"
+        )
+        self.parser.add_argument(
+            "--by_baseline_year",
+            action="store_true",
+            help="join every LL84 reporting year of each building, read from its Calendar Year or Year Ending "
+                 "column, and calculate the projections from each of them as a baseline year, instead of "
+                 "joining the first LL84 row of each building"
+        )
+        self.parser.add_argument(
+            "--trend_features",
+            action="store_true",
+            help="with --by_baseline_year, add the least squares slope of the energy use of each building over "
+                 "its reporting years and the fitted value in each baseline year"
+        )
+        self.parser.add_argument(
+            "--project_from_trend",
+            action="store_true",
+            help="with --trend_features, calculate the metrics of each baseline year from the fitted value of the "
+                 "energy use in that year instead of the reported use"
+        )
+        self.parser.add_argument(
+            "--ll84_chunksize",
+            type=_positive_int,
+            help="read the LL84 dataset this many rows at a time, keeping only the buildings in the LL97 dataset, "
+                 "to bound memory usage on very large files"
         )
         self.parser.add_argument(
             "--carbon_emissions_by_building_type",
             type=_file_path,
             help="location of the .csv file that contains the carbon emission targets for each building type",
-            default="./terra_project_ll97_dataset/data/carbon_thresholds_by_building_type.csv"
+            default=DEFAULT_CARBON_EMISSIONS_BY_BUILDING_TYPE_FILE_PATH
         )
         self.parser.add_argument(
             "--output_dir",
             type=_dir_path,
             help="directory where the output will be written"
         )
+        self.parser.add_argument(
+            "--output_format",
+            choices=OutputFormats,
+            nargs="+",
+            default=[CSV_FORMAT],
+            help="formats to write the yearly and year range datasets in: the wide csv files, and/or long "
+                 "parquet or arrow (IPC) datasets with a separate building table; parquet and arrow require pyarrow"
+        )
+        self.parser.add_argument(
+            "--partition_by",
+            choices=PartitionColumns,
+            help="partition the parquet and arrow datasets by year or borough"
+        )
+        self.parser.add_argument(
+            "--columnar_compression",
+            choices=Compressions,
+            default="zstd",
+            help="compression of the parquet and arrow datasets; uncompressed arrow files can be memory-mapped"
+        )
+        self.parser.add_argument(
+            "--portfolio_cubes",
+            action="store_true",
+            help="also write the sum, count and percentiles of each metric by borough, property type and year "
+                 "or year range, in each --output_format"
+        )
+        self.parser.add_argument(
+            "--year_ranges",
+            type=_year_range,
+            nargs="+",
+            help="year ranges to average the metrics over, e.g. 2024-2034 2030-2050 2050+ "
+                 "(defaults to the compliance periods)"
+        )
+        self.parser.add_argument(
+            "--metrics",
+            choices=Metrics,
+            nargs="+",
+            help="metrics to calculate and write (defaults to every metric); only the calculations the requested "
+                 "metrics depend on are run, e.g. estimated_penalty also calculates the emissions and threshold"
+        )
+        self.parser.add_argument(
+            "--years",
+            type=_years,
+            nargs="+",
+            help="years to write the yearly metrics and scenarios for, e.g. 2030 2035-2039 "
+                 "(defaults to every year); the year ranges are still averaged over all of their years"
+        )
+        self.parser.add_argument(
+            "--mixed_use_thresholds",
+            action="store_true",
+            help="sum the carbon emissions thresholds of the three largest property uses of each building, "
+                 "each over its own floor area, instead of applying the threshold of the largest use to its "
+                 "floor area only"
+        )
+        self.parser.add_argument(
+            "--keep_columns",
+            nargs="+",
+            help="LL97 or LL84 columns to pass through to the output in addition to the columns used by the "
+                 "calculations, or 'all' to keep every column"
+        )
+        self.parser.add_argument(
+            "--scenarios",
+            type=_file_path,
+            help="location of a .csv file of scenarios that override emission factors, energy prices or the "
+                 "penalty rate; every scenario is calculated in one pass and written to a long dataset"
+        )
+        self.parser.add_argument(
+            "--scenario_batch_size",
+            type=_positive_int,
+            default=16,
+            help="number of scenarios to calculate at a time, bounds the memory used by the scenario calculations"
+        )
+        self.parser.add_argument(
+            "--retrofit_actions",
+            type=_file_path,
+            help="location of a .csv file of retrofit and fuel switching actions; every action is evaluated for "
+                 "every building, and the cheapest action that keeps the emissions of each year range under "
+                 "its thresholds is written to a long dataset"
+        )
+        self.parser.add_argument(
+            "--samples",
+            type=_positive_int,
+            help="number of Monte Carlo samples of the emission factors, energy prices and energy use; the "
+                 "percentiles of every yearly and year range metric over the samples are written to banded datasets"
+        )
+        self.parser.add_argument(
+            "--seed",
+            type=int,
+            default=0,
+            help="seed of the Monte Carlo samples, the same seed gives the same bands for any number of workers"
+        )
+        self.parser.add_argument(
+            "--sample_percentiles",
+            type=_percentile,
+            nargs="+",
+            default=SamplePercentiles,
+            help="percentiles of the Monte Carlo samples to write for each metric"
+        )
+        self.parser.add_argument(
+            "--sample_batch_size",
+            type=_positive_int,
+            default=256,
+            help="number of Monte Carlo samples to evaluate at a time, bounds the memory used by the sampling"
+        )
+        self.parser.add_argument(
+            "--emission_factor_uncertainty",
+            type=float,
+            default=0.05,
+            help="relative standard deviation of the emission factor of each energy type in the Monte Carlo samples"
+        )
+        self.parser.add_argument(
+            "--energy_price_uncertainty",
+            type=float,
+            default=0.10,
+            help="relative standard deviation of the price of each energy type in the Monte Carlo samples"
+        )
+        self.parser.add_argument(
+            "--energy_use_uncertainty",
+            type=float,
+            default=0.10,
+            help="relative standard deviation of the energy use of each building and energy type in the "
+                 "Monte Carlo samples"
+        )
+        self.parser.add_argument(
+            "--workers",
+            type=_positive_int,
+            default=1,
+            help="number of processes to calculate and write the datasets with; "
+                 "the output is identical for any number of workers"
+        )
+        self.parser.add_argument(
+            "--backend",
+            choices=Backends,
+            default=PANDAS_BACKEND,
+            help="run the join and the yearly and year range calculations with pandas and NumPy in memory, or in "
+                 "duckdb, an embedded SQL engine that spills to disk; both write the same csv files and "
+                 "metric values, duckdb requires the duckdb package. duckdb joins each building to the first "
+                 "LL84 row of its BBL, like pandas without --by_baseline_year; builds by baseline year need the "
+                 "pandas backend"
+        )
+        self.parser.add_argument(
+            "--sql_memory_limit",
+            help="memory the duckdb backend may use before spilling to disk, e.g. 2GB (defaults to the engine's "
+                 "default, 80%% of the RAM)"
+        )
+        self.parser.add_argument(
+            "--cache_dir",
+            default=DEFAULT_CACHE_DIR,
+            help="directory where the joined and cleaned dataset is cached between runs"
+        )
+        self.parser.add_argument(
+            "--cache_max_size_mb",
+            type=float,
+            default=4096,
+            help="size of the cache above which the least recently used entries are evicted"
+        )
+        self.parser.add_argument(
+            "--no_cache",
+            action="store_true",
+            help="always read and join the input datasets, without reading or writing the cache"
+        )
+        self.parser.add_argument(
+            "--previous_output_dir",
+            type=_dir_path,
+            help="output directory of a previous run; only the buildings whose LL97/LL84 data changed since then "
+                 "are recalculated and patched into its yearly and year range datasets"
+        )
+        self.parser.add_argument(
+            "--profile",
+            choices=Profilers,
+            help="profile the run with cProfile, written next to the outputs, or record the peak Python "
+                 "allocations of each stage with tracemalloc in the run report"
+        )
+        self.parser.add_argument(
+            "--row_wise",
+            action="store_true",
+            help="calculate the yearly metrics one building at a time instead of with the vectorized engine"
+        )
 
     def parse_args(self):
         """Parse the command line arguments and store them in self.args."""
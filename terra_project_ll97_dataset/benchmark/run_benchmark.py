@@ -0,0 +1,170 @@
+#!/usr/bin/python3
+"""
+Benchmark of the dataset builder on synthetic datasets of increasing size.
+
+Each size is built in a fresh process, so that the peak memory recorded for it is not inflated by
+the previous sizes, and the stages of its run report (see util/run_report.py) are written to a JSON
+file that can be compared between versions.
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from importlib import metadata
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+
+from terra_project_ll97_dataset.api import DEFAULT_CARBON_EMISSIONS_BY_BUILDING_TYPE_FILE_PATH
+from terra_project_ll97_dataset.arguments import BuildDatasetArguments
+from terra_project_ll97_dataset.benchmark.synthetic_data import LL84_FILE_NAME, LL97_FILE_NAME, generate_datasets
+from terra_project_ll97_dataset.dataset.dataset_builder import DatasetBuilder
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SIZES = [10000, 100000, 1000000]
+
+
+def _get_datasets(number_of_buildings: int, data_dir: str, seed: int) -> Dict[str, str]:
+    # generated datasets are kept in data_dir and reused by later benchmarks with the same size and seed
+    dataset_dir = os.path.join(data_dir, f"buildings-{number_of_buildings}-seed-{seed}")
+    ll97_file_path = os.path.join(dataset_dir, LL97_FILE_NAME)
+    ll84_file_path = os.path.join(dataset_dir, LL84_FILE_NAME)
+    if not (os.path.exists(ll97_file_path) and os.path.exists(ll84_file_path)):
+        logger.info("generating %d buildings in %s", number_of_buildings, dataset_dir)
+        generate_datasets(number_of_buildings, dataset_dir, DEFAULT_CARBON_EMISSIONS_BY_BUILDING_TYPE_FILE_PATH, seed)
+    return {"ll97_dataset": ll97_file_path, "ll84_dataset": ll84_file_path}
+
+
+def _benchmark_size(number_of_buildings: int, datasets: Dict[str, str], builder_arguments: List[str]) -> dict:
+    """
+    Build the datasets of one size and return the stages of its run report. Runs in its own process.
+    """
+    with tempfile.TemporaryDirectory() as output_dir:
+        build_dataset_arguments = BuildDatasetArguments()
+        arguments = build_dataset_arguments.parser.parse_args([
+            "--ll97_dataset", datasets["ll97_dataset"],
+            "--ll84_dataset", datasets["ll84_dataset"],
+            "--output_dir", output_dir,
+            "--no_cache",
+        ] + builder_arguments)
+        builder = DatasetBuilder(arguments)
+        builder.run()
+
+    run_report = builder.run_report.to_dict()
+    return {
+        "buildings": number_of_buildings,
+        "wall_seconds": run_report["wall_seconds"],
+        "cpu_seconds": run_report["cpu_seconds"],
+        "peak_rss_mb": run_report["peak_rss_mb"],
+        "workers_peak_rss_mb": run_report["workers_peak_rss_mb"],
+        "stages": run_report["stages"],
+    }
+
+
+def _get_package_version() -> str:
+    try:
+        return metadata.version("terra-project-ll97-dataset")
+    except metadata.PackageNotFoundError:
+        return "unknown"
+
+
+def run_benchmark(sizes: List[int], data_dir: str, seed: int, builder_arguments: List[str]) -> dict:
+    """
+    Benchmark the dataset builder on synthetic datasets of the given sizes.
+
+    Args:
+        sizes (List[int]): Numbers of buildings to benchmark
+        data_dir (str): Directory where the synthetic datasets are generated and reused
+        seed (int): Seed of the synthetic datasets
+        builder_arguments (List[str]): Additional build_dataset arguments, e.g. ["--ll84_chunksize", "100000"]
+
+    Returns:
+        dict: The environment and, for each size, the measurements of each stage
+    """
+    results = []
+    # a fresh interpreter per size, fork would start each size with the memory of the parent
+    context = multiprocessing.get_context("spawn")
+    for number_of_buildings in sizes:
+        datasets = _get_datasets(number_of_buildings, data_dir, seed)
+        # the workers of a Pool are daemonic and cannot start the worker processes of --workers, an executor's can
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            results.append(executor.submit(_benchmark_size, number_of_buildings, datasets, builder_arguments).result())
+
+    return {
+        "version": _get_package_version(),
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "seed": seed,
+        "builder_arguments": builder_arguments,
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the LL97 dataset builder on synthetic datasets",
+        epilog="arguments after -- are passed to the dataset builder, e.g. -- --ll84_chunksize 100000")
+    parser.add_argument(
+        "-v", "--verbose",
+        action="store_true",
+        help="increase output verbosity"
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=DEFAULT_SIZES,
+        help="numbers of buildings to benchmark"
+    )
+    parser.add_argument(
+        "--data_dir",
+        default=os.path.join(tempfile.gettempdir(), "terra_project_ll97_dataset_benchmark"),
+        help="directory where the synthetic datasets are generated, and reused by later runs"
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="seed of the synthetic datasets"
+    )
+    parser.add_argument(
+        "--output",
+        default="benchmark_results.json",
+        help="location of the .json file the results are written to"
+    )
+    parser.add_argument(
+        "builder_arguments",
+        nargs=argparse.REMAINDER,
+        help=argparse.SUPPRESS
+    )
+    arguments = parser.parse_args()
+    logging.basicConfig(
+        level=logging.INFO if arguments.verbose else logging.WARNING,
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    builder_arguments = [argument for argument in arguments.builder_arguments if argument != "--"]
+    results = run_benchmark(arguments.sizes, arguments.data_dir, arguments.seed, builder_arguments)
+    with open(arguments.output, "w") as output_file:
+        json.dump(results, output_file, indent=2)
+
+    for result in results["results"]:
+        stage_seconds = ", ".join(f"{stage} {values['wall_seconds']:.2f} s"
+                                  for stage, values in result["stages"].items())
+        print(f"{result['buildings']} buildings: {result['wall_seconds']:.2f} s ({stage_seconds}), "
+              f"peak RSS {result['peak_rss_mb']:.0f} MB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+"""
+Synthetic LL97 and LL84 datasets for benchmarking.
+
+The generated files follow the schema of the published datasets and contain the irregularities the
+builder has to handle: BBLs written with dashes, slashes or surrounding spaces, duplicate BBLs in
+both datasets, non-numeric entries in the energy and floor area columns, every building type of the
+carbon thresholds file plus unknown ones, LL97 buildings without LL84 data and LL84 buildings
+outside of LL97.
+"""
+
+import os
+from typing import List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from terra_project_ll97_dataset.dataset.column_projection import LL84_BBL_COLUMN, LL97_BBL_COLUMN
+
+LL97_FILE_NAME = "ll97.csv"
+LL84_FILE_NAME = "ll84.csv"
+
+# building types that are not in the carbon thresholds file
+UnknownBuildingTypes: List[str] = [
+    "Unknown Use",
+    "Not Available",
+]
+
+# non-numeric entries found in the LL84 energy and floor area columns
+NonNumericValues: List[str] = [
+    "Not Available",
+    "Insufficient access",
+    "",
+]
+
+# LL84 numerical columns and the scale of their values
+_ll84_numerical_columns = {
+    "Largest Property Use Type - Gross Floor Area (ft²)": 200000.0,
+    "2nd Largest Property Use Type - Gross Floor Area (ft²)": 50000.0,
+    "3rd Largest Property Use Type - Gross Floor Area (ft²)": 20000.0,
+    "Electricity Use - Grid Purchase (kWh)": 5e6,
+    "Natural Gas Use (kBtu)": 1e7,
+    "District Steam Use (kBtu)": 1e6,
+    "Fuel Oil #2 Use (kBtu)": 1e6,
+    "Fuel Oil #4 Use (kBtu)": 1e5,
+    "Site EUI (kBtu/ft²)": 200.0,
+}
+
+# share of the rows with each irregularity
+DASHED_BBL_FRACTION = 0.2
+SLASHED_BBL_FRACTION = 0.1
+PADDED_BBL_FRACTION = 0.05
+LL97_DUPLICATE_FRACTION = 0.01
+LL84_MISSING_FRACTION = 0.1
+LL84_DUPLICATE_FRACTION = 0.05
+LL84_REVISED_FRACTION = 0.02
+LL84_EXTRA_FRACTION = 0.2
+NON_NUMERIC_FRACTION = 0.12
+
+
+def _generate_bbls(rng: np.random.Generator, number_of_buildings: int) -> np.ndarray:
+    # distinct 10 digit BBLs: borough, 5 digit block and 4 digit lot
+    bbls = np.empty(0, dtype=np.int64)
+    while len(bbls) < number_of_buildings:
+        candidates = (rng.integers(1, 6, number_of_buildings) * 10 ** 9 +
+                      rng.integers(1, 100000, number_of_buildings) * 10 ** 4 +
+                      rng.integers(1, 10000, number_of_buildings))
+        bbls = pd.unique(np.concatenate([bbls, candidates]))
+    return bbls[:number_of_buildings]
+
+
+def _format_bbls(rng: np.random.Generator, bbls: np.ndarray) -> pd.Series:
+    """
+    Write encoded BBLs as 10 digit strings, some of them with dashes, slashes or surrounding spaces.
+    """
+    digits = pd.Series(bbls).astype(str).str.zfill(10)
+    borough, block, lot = digits.str[:1], digits.str[1:6], digits.str[6:]
+    draw = rng.random(len(bbls))
+    formatted = digits.copy()
+    dashed = draw < DASHED_BBL_FRACTION
+    slashed = (draw >= DASHED_BBL_FRACTION) & (draw < DASHED_BBL_FRACTION + SLASHED_BBL_FRACTION)
+    padded = ((draw >= DASHED_BBL_FRACTION + SLASHED_BBL_FRACTION) &
+              (draw < DASHED_BBL_FRACTION + SLASHED_BBL_FRACTION + PADDED_BBL_FRACTION))
+    formatted[dashed] = borough[dashed] + "-" + block[dashed] + "-" + lot[dashed]
+    formatted[slashed] = borough[slashed] + "/" + block[slashed] + "/" + lot[slashed]
+    formatted[padded] = " " + digits[padded] + " "
+    return formatted
+
+
+def _generate_numbers(rng: np.random.Generator, number_of_rows: int, scale: float) -> pd.Series:
+    values = pd.Series(np.round(rng.random(number_of_rows) * scale, 1)).astype(str)
+    non_numeric = rng.random(number_of_rows) < NON_NUMERIC_FRACTION
+    values[non_numeric] = rng.choice(NonNumericValues, int(non_numeric.sum()))
+    return values
+
+
+def _generate_ll97_dataset(rng: np.random.Generator, bbls: np.ndarray) -> pd.DataFrame:
+    duplicates = rng.choice(len(bbls), int(len(bbls) * LL97_DUPLICATE_FRACTION), replace=False)
+    ll97_bbls = np.concatenate([bbls, bbls[duplicates]])
+    number_of_rows = len(ll97_bbls)
+    return pd.DataFrame({
+        LL97_BBL_COLUMN: _format_bbls(rng, ll97_bbls),
+        "BIN": rng.integers(1000000, 6000000, number_of_rows),
+        "Address": pd.Series(rng.integers(1, 1000, number_of_rows)).astype(str) + " Main Street",
+        "Borough": ll97_bbls // 10 ** 9,
+    })
+
+
+def _generate_ll84_dataset(rng: np.random.Generator, bbls: np.ndarray, building_types: List[str]) -> pd.DataFrame:
+    # LL97 buildings with LL84 data, LL84 buildings outside of LL97, exact duplicate rows,
+    # and rows that revise the energy use of a building under the same BBL
+    covered_bbls = bbls[rng.random(len(bbls)) >= LL84_MISSING_FRACTION]
+    extra_bbls = _generate_bbls(rng, int(len(bbls) * LL84_EXTRA_FRACTION) + 1)
+    ll84_bbls = np.concatenate([covered_bbls, extra_bbls])
+    number_of_buildings = len(ll84_bbls)
+
+    all_building_types = np.asarray(building_types + UnknownBuildingTypes, dtype=object)
+    ll84_df = pd.DataFrame({
+        "Property Id": np.arange(number_of_buildings),
+        "Property Name": "Property " + pd.Series(np.arange(number_of_buildings)).astype(str),
+        LL84_BBL_COLUMN: _format_bbls(rng, ll84_bbls),
+        "Calendar Year": 2023,
+        "Largest Property Use Type": rng.choice(all_building_types, number_of_buildings),
+        "2nd Largest Property Use Type": rng.choice(all_building_types, number_of_buildings),
+        "3rd Largest Property Use Type": rng.choice(all_building_types, number_of_buildings),
+    })
+    # every building type appears at least once
+    first_rows = min(number_of_buildings, len(all_building_types))
+    ll84_df.loc[:first_rows - 1, "Largest Property Use Type"] = all_building_types[:first_rows]
+    for column, scale in _ll84_numerical_columns.items():
+        ll84_df[column] = _generate_numbers(rng, number_of_buildings, scale)
+
+    duplicates = ll84_df.iloc[rng.random(number_of_buildings) < LL84_DUPLICATE_FRACTION]
+    revisions = ll84_df.iloc[rng.random(number_of_buildings) < LL84_REVISED_FRACTION].copy()
+    revisions["Property Id"] += number_of_buildings
+    revisions["Electricity Use - Grid Purchase (kWh)"] = _generate_numbers(
+        rng, len(revisions), _ll84_numerical_columns["Electricity Use - Grid Purchase (kWh)"]).to_numpy()
+
+    ll84_df = pd.concat([ll84_df, duplicates, revisions])
+    # shuffle so that duplicates are spread over the file, as they are in the published dataset
+    return ll84_df.iloc[rng.permutation(len(ll84_df))]
+
+
+def generate_datasets(number_of_buildings: int,
+                      output_dir: str,
+                      carbon_emissions_by_building_type_file_path: str,
+                      seed: int = 0) -> Tuple[str, str]:
+    """
+    Write a synthetic LL97 and LL84 dataset to output_dir.
+
+    Args:
+        number_of_buildings (int): Number of distinct buildings in the LL97 dataset
+        output_dir (str): Directory to write the datasets to, created if needed
+        carbon_emissions_by_building_type_file_path (str): Carbon thresholds file whose building types are used
+        seed (int): Seed of the random generator, the same seed always generates the same files
+
+    Returns:
+        Tuple[str, str]: Locations of the LL97 and LL84 .csv files
+    """
+    rng = np.random.default_rng(seed)
+    building_types = list(pd.read_csv(carbon_emissions_by_building_type_file_path)["BuildingType"])
+    bbls = _generate_bbls(rng, number_of_buildings)
+
+    os.makedirs(output_dir, exist_ok=True)
+    ll97_file_path = os.path.join(output_dir, LL97_FILE_NAME)
+    ll84_file_path = os.path.join(output_dir, LL84_FILE_NAME)
+    _generate_ll97_dataset(rng, bbls).to_csv(ll97_file_path, index=False)
+    _generate_ll84_dataset(rng, bbls, building_types).to_csv(ll84_file_path, index=False)
+    return ll97_file_path, ll84_file_path
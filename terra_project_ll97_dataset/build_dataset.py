@@ -5,7 +5,7 @@ This script processes LL97 and LL84 datasets to calculate carbon emissions,
 energy costs, and penalties for buildings in New York City.
 """
 
-import argparse
+import logging
 
 from terra_project_ll97_dataset.arguments import BuildDatasetArguments
 from terra_project_ll97_dataset.dataset.dataset_builder import DatasetBuilder
@@ -19,7 +19,10 @@ def main():
     # Initialize and parse command line arguments
     arguments = BuildDatasetArguments()
     arguments.parse_args()
-    
+    logging.basicConfig(
+        level=logging.INFO if arguments.args.verbose else logging.WARNING,
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
     # Create and run the dataset builder
     builder = DatasetBuilder(arguments.args)
     builder.run()
@@ -1,8 +1,14 @@
-from typing import Dict
+from typing import Dict, List, TYPE_CHECKING
 
-from terra_project_ll97_dataset.calculator.energy_unit_conversion import get_energy_consumption_in_billing_units
+import numpy as np
+
+from terra_project_ll97_dataset.calculator.energy_unit_conversion import get_energy_consumption_in_billing_units, \
+    weigh_energy_consumption
 from terra_project_ll97_dataset.util.common import EnergyTypes
 
+if TYPE_CHECKING:
+    from terra_project_ll97_dataset.calculator.coefficient_tables import CoefficientTables
+
 '''
 Carbon Emissions per energy type per year
 
@@ -62,3 +68,14 @@ def get_carbon_emissions(
     for energy_type in EnergyTypes:
         carbon_emissions_in_year += energy_consumption[energy_type] * carbon_emissions_by_energy_type[energy_type]
     return carbon_emissions_in_year
+
+
+def get_carbon_emissions_matrix(
+        coefficient_tables: "CoefficientTables",
+        years: List[int],
+        energy_consumption: np.ndarray) -> np.ndarray:
+    """
+    Vectorized counterpart of get_carbon_emissions.
+    Returns a (buildings x years) array of the carbon emissions for every building and year.
+    """
+    return weigh_energy_consumption(energy_consumption, coefficient_tables.gather_carbon_emissions(years))
@@ -1,27 +1,121 @@
+from typing import List, Tuple, TYPE_CHECKING, Union
+
+import numpy as np
 import pandas as pd
 from terra_project_ll97_dataset.util.common import StartYears
 
+if TYPE_CHECKING:
+    from terra_project_ll97_dataset.calculator.coefficient_tables import CoefficientTables
+
+# LL84 columns read by the threshold calculations
+required_columns: List[str] = [
+    "Largest Property Use Type",
+    "Largest Property Use Type - Gross Floor Area (ft²)",
+]
+
+# property use type and gross floor area columns of each use of a building, largest use first
+PropertyUseColumns: List[Tuple[str, str]] = [
+    ("Largest Property Use Type", "Largest Property Use Type - Gross Floor Area (ft²)"),
+    ("2nd Largest Property Use Type", "2nd Largest Property Use Type - Gross Floor Area (ft²)"),
+    ("3rd Largest Property Use Type", "3rd Largest Property Use Type - Gross Floor Area (ft²)"),
+]
+
+# LL84 columns read by the mixed use threshold calculations
+mixed_use_required_columns: List[str] = [column for columns in PropertyUseColumns for column in columns]
+
 
-def get_carbon_emissions_threshold_by_building_type_and_start_year(carbon_emissions_by_building_type_file_path: str):
-    carbon_thresholds_df = pd.read_csv(carbon_emissions_by_building_type_file_path)
+def get_carbon_emissions_threshold_by_building_type_and_start_year(
+        carbon_emissions_by_building_type: Union[str, pd.DataFrame]):
+    # a .csv file location, or a DataFrame with the same BuildingType and start year columns
+    if isinstance(carbon_emissions_by_building_type, pd.DataFrame):
+        carbon_thresholds_df = carbon_emissions_by_building_type.rename(columns=str)
+    else:
+        carbon_thresholds_df = pd.read_csv(carbon_emissions_by_building_type)
     carbon_thresholds_df = carbon_thresholds_df.set_index("BuildingType")
     carbon_emissions_threshold_lookup_table = carbon_thresholds_df.to_dict('index')
     return carbon_emissions_threshold_lookup_table
 
 
-def get_carbon_emissions_thresholds(carbon_emissions_threshold_lookup_table, year, row):
-    if row['Largest Property Use Type'] not in carbon_emissions_threshold_lookup_table.keys():
-        return 0.0
-
+def get_reference_start_year(year: int) -> int:
     # find the start year for the range this year falls in
     reference_start_year = 0
     for start_year in StartYears:
         if year < start_year:
             break
         reference_start_year = start_year
+    return reference_start_year
+
+
+def _get_property_use_columns(mixed_use: bool) -> List[Tuple[str, str]]:
+    # without mixed use, the whole building gets the threshold of its largest use
+    return PropertyUseColumns if mixed_use else PropertyUseColumns[:1]
+
+
+def get_carbon_emissions_thresholds(carbon_emissions_threshold_lookup_table, year, row, mixed_use=False):
+    reference_start_year = get_reference_start_year(year)
+
+    carbon_emissions_threshold = 0.0
+    for building_type_column, gross_floor_area_column in _get_property_use_columns(mixed_use):
+        if row[building_type_column] not in carbon_emissions_threshold_lookup_table.keys():
+            continue
+        gross_floor_area_sq_feet = float(row[gross_floor_area_column])
+        carbon_emissions_threshold_per_sq_foot = carbon_emissions_threshold_lookup_table[row[building_type_column]][
+            str(reference_start_year)]
+        carbon_emissions_threshold += gross_floor_area_sq_feet * carbon_emissions_threshold_per_sq_foot
+
+    return carbon_emissions_threshold
+
+
+class PropertyUseAreas:
+    """
+    Sparse (buildings x building types) matrix of the gross floor area of each use of each building,
+    in coordinate form ordered by building and then by use. Uses of unknown building types are left out.
+    """
+
+    def __init__(self, number_of_buildings: int, building_indexes: np.ndarray, building_type_codes: np.ndarray,
+                 gross_floor_areas: np.ndarray):
+        self.number_of_buildings = number_of_buildings
+        self.building_indexes = building_indexes
+        self.building_type_codes = building_type_codes
+        self.gross_floor_areas = gross_floor_areas
+
+    @classmethod
+    def from_dataframe(cls, coefficient_tables: "CoefficientTables", df: pd.DataFrame,
+                       mixed_use: bool = False) -> "PropertyUseAreas":
+        """
+        The floor area of the largest use of each building in df, or of its three largest uses with mixed_use.
+        """
+        property_use_columns = _get_property_use_columns(mixed_use)
+        building_type_codes = np.column_stack([
+            coefficient_tables.encode_building_types(df[building_type_column])
+            for building_type_column, _ in property_use_columns])
+        gross_floor_areas = np.column_stack([
+            df[gross_floor_area_column].to_numpy(dtype=float) for _, gross_floor_area_column in property_use_columns])
+        building_indexes = np.repeat(np.arange(len(df)), len(property_use_columns)).reshape(building_type_codes.shape)
+
+        # boolean indexing of the (buildings x uses) arrays keeps the entries in building order
+        stored = building_type_codes >= 0
+        return cls(len(df), building_indexes[stored], building_type_codes[stored], gross_floor_areas[stored])
+
+    def dot(self, values_by_building_type: np.ndarray) -> np.ndarray:
+        """
+        Product with a dense (building types x columns) array: for each building, the sum over its uses
+        of the floor area times the row of its building type, accumulated from the largest use down.
+        """
+        result = np.zeros((self.number_of_buildings, values_by_building_type.shape[1]))
+        np.add.at(result, self.building_indexes,
+                  self.gross_floor_areas[:, np.newaxis] * values_by_building_type[self.building_type_codes])
+        return result
+
 
-    gross_floor_area_sq_feet = float(row["Largest Property Use Type - Gross Floor Area (ft²)"])
-    carbon_emissions_threshold_per_sq_foot = carbon_emissions_threshold_lookup_table[row['Largest Property Use Type']][
-        str(reference_start_year)]
+def get_carbon_emissions_thresholds_matrix(coefficient_tables: "CoefficientTables", years: List[int],
+                                           df: pd.DataFrame, mixed_use: bool = False) -> np.ndarray:
+    """
+    Vectorized counterpart of get_carbon_emissions_thresholds.
+    Returns a (buildings x years) array of the carbon emissions threshold for every building and year.
+    """
+    periods = coefficient_tables.period_by_year[coefficient_tables.get_year_indexes(years)]
+    property_use_areas = PropertyUseAreas.from_dataframe(coefficient_tables, df, mixed_use)
 
-    return gross_floor_area_sq_feet * carbon_emissions_threshold_per_sq_foot
+    # the thresholds only change between compliance periods: one sparse product per period, gathered by year
+    return property_use_areas.dot(coefficient_tables.carbon_emissions_thresholds)[:, periods]
@@ -0,0 +1,119 @@
+"""
+Array-backed lookup tables for the vectorized calculators.
+Emission factors and energy prices are stored as dense (years x EnergyTypes) arrays and carbon emissions
+thresholds as a (building types x compliance periods) array, so whole columns of buildings can be looked
+up with a single NumPy gather instead of walking nested dictionaries row by row.
+"""
+
+from typing import Dict, List, Union
+
+import numpy as np
+import pandas as pd
+
+from terra_project_ll97_dataset.calculator.carbon_emissions import get_carbon_emissions_by_year_and_energy_type
+from terra_project_ll97_dataset.calculator.carbon_emissions_thresholds import \
+    get_carbon_emissions_threshold_by_building_type_and_start_year
+from terra_project_ll97_dataset.calculator.cost_of_energy import get_cost_of_energy_by_year_and_energy_type
+from terra_project_ll97_dataset.util.common import EnergyTypes, StartYears
+
+
+class CoefficientTables:
+    """
+    Compiled emission factors, energy prices and carbon emissions thresholds.
+    """
+
+    def __init__(
+            self,
+            years: List[int],
+            carbon_emissions_by_year: np.ndarray,
+            cost_of_energy_by_year: np.ndarray,
+            building_types: List[str],
+            carbon_emissions_thresholds: np.ndarray):
+        """
+        Args:
+            years (List[int]): Consecutive years covered by the tables
+            carbon_emissions_by_year (np.ndarray): (years x EnergyTypes) emissions per billing unit
+            cost_of_energy_by_year (np.ndarray): (years x EnergyTypes) cost per billing unit
+            building_types (List[str]): Building types, in the row order of carbon_emissions_thresholds
+            carbon_emissions_thresholds (np.ndarray): (building types x StartYears) threshold per sq foot
+        """
+        self.years = list(years)
+        self.carbon_emissions_by_year = carbon_emissions_by_year
+        self.cost_of_energy_by_year = cost_of_energy_by_year
+        self.building_types = pd.Index(building_types)
+        self.carbon_emissions_thresholds = carbon_emissions_thresholds
+        # index into StartYears of the compliance period each year falls in
+        self.period_by_year = np.searchsorted(StartYears, self.years, side="right") - 1
+
+    @classmethod
+    def from_lookup_tables(
+            cls,
+            years: List[int],
+            carbon_emissions_lookup_table: Dict[int, Dict[str, float]],
+            cost_of_energy_lookup_table: Dict[int, Dict[str, float]],
+            carbon_emissions_threshold_lookup_table) -> "CoefficientTables":
+        """
+        Compile the dictionary lookup tables used by the row-wise calculators.
+        """
+        return cls(
+            years,
+            np.array([[carbon_emissions_lookup_table[year][energy_type] for energy_type in EnergyTypes]
+                      for year in years], dtype=float),
+            np.array([[cost_of_energy_lookup_table[year][energy_type] for energy_type in EnergyTypes]
+                      for year in years], dtype=float),
+            list(carbon_emissions_threshold_lookup_table.keys()),
+            np.array([[thresholds_by_start_year[str(start_year)] for start_year in StartYears]
+                      for thresholds_by_start_year in carbon_emissions_threshold_lookup_table.values()],
+                     dtype=float).reshape(-1, len(StartYears)))
+
+    def get_year_indexes(self, years: List[int]) -> np.ndarray:
+        """
+        Raises:
+            ValueError: If any of the years is not covered by the tables
+        """
+        year_indexes = np.asarray(years) - self.years[0]
+        if len(year_indexes) and (year_indexes.min() < 0 or year_indexes.max() >= len(self.years)):
+            raise ValueError(f"years must be between {self.years[0]} and {self.years[-1]}")
+        return year_indexes
+
+    def gather_carbon_emissions(self, years: List[int]) -> np.ndarray:
+        """(years x EnergyTypes) emissions per billing unit for the given years."""
+        return self.carbon_emissions_by_year[self.get_year_indexes(years)]
+
+    def gather_cost_of_energy(self, years: List[int]) -> np.ndarray:
+        """(years x EnergyTypes) cost per billing unit for the given years."""
+        return self.cost_of_energy_by_year[self.get_year_indexes(years)]
+
+    def encode_building_types(self, building_types: pd.Series) -> np.ndarray:
+        """
+        Integer code of each building type, -1 for missing or unknown building types.
+        """
+        return np.asarray(self.building_types.get_indexer(building_types.astype(object)), dtype=np.int64)
+
+    def gather_carbon_emissions_thresholds(self, building_type_codes: np.ndarray, years: List[int]) -> np.ndarray:
+        """
+        (buildings x years) threshold per sq foot for the given building type codes.
+        Unknown building types (code -1) get NaN.
+        """
+        periods = self.period_by_year[self.get_year_indexes(years)]
+        thresholds = self.carbon_emissions_thresholds[:, periods]
+        if len(thresholds) == 0:
+            return np.full((len(building_type_codes), len(periods)), np.nan)
+        thresholds_per_sq_foot = thresholds[np.maximum(building_type_codes, 0)]
+        thresholds_per_sq_foot[building_type_codes < 0] = np.nan
+        return thresholds_per_sq_foot
+
+
+def load_coefficient_tables(
+        start_year: int,
+        end_year_inclusive: int,
+        carbon_emissions_by_building_type: Union[str, pd.DataFrame]) -> CoefficientTables:
+    """
+    Build the coefficient tables for a range of years from the calculator configuration
+    and the carbon emissions thresholds file, or a DataFrame with its columns.
+    """
+    return CoefficientTables.from_lookup_tables(
+        list(range(start_year, end_year_inclusive + 1)),
+        get_carbon_emissions_by_year_and_energy_type(start_year, end_year_inclusive),
+        get_cost_of_energy_by_year_and_energy_type(start_year, end_year_inclusive),
+        get_carbon_emissions_threshold_by_building_type_and_start_year(carbon_emissions_by_building_type))
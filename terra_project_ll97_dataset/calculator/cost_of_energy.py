@@ -1,8 +1,14 @@
-from typing import Dict
+from typing import Dict, List, TYPE_CHECKING
 
-from terra_project_ll97_dataset.calculator.energy_unit_conversion import get_energy_consumption_in_billing_units
+import numpy as np
+
+from terra_project_ll97_dataset.calculator.energy_unit_conversion import get_energy_consumption_in_billing_units, \
+    weigh_energy_consumption
 from terra_project_ll97_dataset.util.common import EnergyTypes
 
+if TYPE_CHECKING:
+    from terra_project_ll97_dataset.calculator.coefficient_tables import CoefficientTables
+
 '''
 Cost of energy per energy type per year
 
@@ -55,3 +61,14 @@ def get_cost_of_energy(
     for energy_type in EnergyTypes:
         cost_of_energy_in_year += energy_consumption[energy_type] * cost_of_energy_by_energy_type[energy_type]
     return cost_of_energy_in_year
+
+
+def get_cost_of_energy_matrix(
+        coefficient_tables: "CoefficientTables",
+        years: List[int],
+        energy_consumption: np.ndarray) -> np.ndarray:
+    """
+    Vectorized counterpart of get_cost_of_energy.
+    Returns a (buildings x years) array of the cost of energy for every building and year.
+    """
+    return weigh_energy_consumption(energy_consumption, coefficient_tables.gather_cost_of_energy(years))
@@ -1,3 +1,6 @@
+import numpy as np
+import pandas as pd
+
 from terra_project_ll97_dataset.util.common import EnergyTypes
 
 # Conversions based on https://portfoliomanager.energystar.gov/pdf/reference/Thermal%20Conversions.pdf
@@ -24,6 +27,9 @@ energy_units_conversion_dictionary = {
     },
 }
 
+# LL84 columns read by the energy conversions
+required_columns = [conversion["source_column"] for conversion in energy_units_conversion_dictionary.values()]
+
 
 def _convert_energy_units(energy_type: str, row) -> float:
     source_column = energy_units_conversion_dictionary[energy_type]["source_column"]
@@ -37,3 +43,38 @@ def get_energy_consumption_in_billing_units(row):
     for energy_type in EnergyTypes:
         energy_consumption[energy_type] = _convert_energy_units(energy_type, row)
     return energy_consumption
+
+
+def get_energy_consumption_matrix(df: pd.DataFrame) -> np.ndarray:
+    """
+    Vectorized counterpart of get_energy_consumption_in_billing_units.
+    Returns a (buildings x EnergyTypes) array of energy consumption in billing units.
+    """
+    energy_consumption = np.zeros((len(df), len(EnergyTypes)))
+    for energy_index, energy_type in enumerate(EnergyTypes):
+        source_column = energy_units_conversion_dictionary[energy_type]["source_column"]
+        conversion_factor = float(energy_units_conversion_dictionary[energy_type]["conversion_factor"])
+        if source_column in df.columns:
+            energy_consumption[:, energy_index] = df[source_column].to_numpy(dtype=float) / conversion_factor
+    return energy_consumption
+
+
+def weigh_energy_consumption(energy_consumption: np.ndarray, coefficients_by_year: np.ndarray) -> np.ndarray:
+    """
+    Multiply the energy consumption of every building by a per-year, per-energy-type coefficient
+    (emission factor or price) and sum over the energy types.
+
+    Args:
+        energy_consumption (np.ndarray): (buildings x EnergyTypes) consumption in billing units
+        coefficients_by_year (np.ndarray): (years x EnergyTypes) coefficients, optionally with
+            leading axes such as (scenarios x years x EnergyTypes)
+
+    Returns:
+        np.ndarray: (buildings x years) weighted totals, with the same leading axes as coefficients_by_year
+    """
+    totals = np.zeros(coefficients_by_year.shape[:-2] + (energy_consumption.shape[0], coefficients_by_year.shape[-2]))
+    # accumulate in EnergyTypes order so the result matches the row-wise calculation bit for bit
+    for energy_index in range(len(EnergyTypes)):
+        totals += (energy_consumption[:, energy_index, np.newaxis] *
+                   coefficients_by_year[..., np.newaxis, :, energy_index])
+    return totals
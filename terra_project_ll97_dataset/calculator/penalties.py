@@ -1,3 +1,5 @@
+import numpy as np
+
 penalty_per_tCO2_over_threshold = 268
 
 
@@ -7,3 +9,14 @@ def calculate_penalties(row, carbon_emmissions_column_name: str, carbon_emission
 
     return penalty_per_tCO2_over_threshold * (
                 row[carbon_emmissions_column_name] - row[carbon_emissions_threshold_column_name])
+
+
+def calculate_penalties_matrix(carbon_emissions: np.ndarray, carbon_emissions_thresholds: np.ndarray,
+                               penalty_per_tCO2=penalty_per_tCO2_over_threshold) -> np.ndarray:
+    """
+    Vectorized counterpart of calculate_penalties for arrays of emissions and thresholds of the same shape.
+    penalty_per_tCO2 may be an array that broadcasts against them, e.g. one rate per scenario and year.
+    """
+    return np.where(carbon_emissions <= carbon_emissions_thresholds,
+                    0.0,
+                    penalty_per_tCO2 * (carbon_emissions - carbon_emissions_thresholds))
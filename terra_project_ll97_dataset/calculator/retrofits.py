@@ -0,0 +1,266 @@
+"""
+Retrofit and fuel switching actions, and the minimum cost action of each building.
+
+A retrofit action file is a .csv with one row per change:
+
+    action,change,energy_type,value,to_energy_type,energy_ratio,capital_cost
+    steam_reduction,reduction,Steam,0.2,,,1.50
+    heat_pump,conversion,Natural Gas,1.0,Electricity,0.3,12.00
+    heat_pump,conversion,Fuel Oil 2,1.0,Electricity,0.3,
+
+change is reduction or conversion. value is the fraction of the energy_type use that is saved, or moved
+to to_energy_type, whose site energy is energy_ratio (default 1) times the site energy that is converted,
+e.g. about 0.3 for a heat pump replacing a boiler. capital_cost is in $ per square foot of the floor area
+the thresholds apply to. The changes of an action all apply to the original energy use, and their capital
+costs add up. Every action is compared with "none", which changes nothing and costs nothing.
+"""
+
+from typing import Dict, List, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from terra_project_ll97_dataset.calculator.carbon_emissions_thresholds import PropertyUseAreas
+from terra_project_ll97_dataset.calculator.coefficient_tables import CoefficientTables
+from terra_project_ll97_dataset.calculator.energy_unit_conversion import energy_units_conversion_dictionary, \
+    get_energy_consumption_matrix
+from terra_project_ll97_dataset.calculator.penalties import calculate_penalties_matrix
+from terra_project_ll97_dataset.util.common import EnergyTypes, get_year_range_string, get_years_in_range
+
+NO_RETROFIT_ACTION = "none"
+
+RetrofitChanges: List[str] = [
+    "reduction",
+    "conversion",
+]
+
+# columns of the minimum cost retrofit dataset after BBL and year_range, the costs are over the whole year range
+RetrofitColumns: List[str] = [
+    "action",
+    "capital_cost",
+    "total_cost",
+    "carbon_emissions_per_year",
+    "cost_of_energy_per_year",
+    "carbon_emissions_threshold_per_year",
+    "baseline_estimated_penalty_per_year",
+]
+
+# the billing unit of electricity is the kWh, of the other energy types a multiple of the kBtu
+KBTU_PER_KWH = 3.412
+
+
+def _get_kbtu_per_billing_unit() -> np.ndarray:
+    return np.array([KBTU_PER_KWH if energy_type == "Electricity" else
+                     energy_units_conversion_dictionary[energy_type]["conversion_factor"]
+                     for energy_type in EnergyTypes])
+
+
+class RetrofitGrid:
+    """
+    Every retrofit action as a linear transform of the energy use of a building.
+    """
+
+    def __init__(self, names: List[str], transforms: np.ndarray, capital_cost_per_sq_foot: np.ndarray):
+        """
+        Args:
+            names (List[str]): Action names, starting with NO_RETROFIT_ACTION
+            transforms (np.ndarray): (actions x EnergyTypes x EnergyTypes) arrays mapping the energy use of a
+                building in billing units to its energy use after the action
+            capital_cost_per_sq_foot (np.ndarray): (actions) capital cost of each action per square foot
+        """
+        self.names = names
+        self.transforms = transforms
+        self.capital_cost_per_sq_foot = capital_cost_per_sq_foot
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+
+def _get_float(change: pd.Series, column: str, default: float) -> float:
+    return default if column not in change or pd.isna(change[column]) else float(change[column])
+
+
+def load_retrofit_grid(retrofit_actions: Union[str, pd.DataFrame]) -> RetrofitGrid:
+    """
+    Read a retrofit action file, or a DataFrame with its columns, into a RetrofitGrid.
+
+    Raises:
+        ValueError: If a change names an unknown change or energy type, has a value outside of 0-1,
+            or if the changes of an action remove more than all of an energy type's use
+    """
+    if isinstance(retrofit_actions, pd.DataFrame):
+        changes = retrofit_actions
+    else:
+        changes = pd.read_csv(retrofit_actions, dtype={"action": str, "change": str, "energy_type": str,
+                                                       "to_energy_type": str})
+    names = [NO_RETROFIT_ACTION] + list(dict.fromkeys(changes["action"]))
+    if NO_RETROFIT_ACTION in names[1:]:
+        raise ValueError(f"retrofit action {NO_RETROFIT_ACTION} is reserved for not changing anything")
+
+    kbtu_per_billing_unit = _get_kbtu_per_billing_unit()
+    transforms = np.repeat(np.eye(len(EnergyTypes))[np.newaxis], len(names), axis=0)
+    capital_cost_per_sq_foot = np.zeros(len(names))
+    action_indexes = {name: index for index, name in enumerate(names)}
+    for _, change in changes.iterrows():
+        action_index = action_indexes[change["action"]]
+        capital_cost_per_sq_foot[action_index] += _get_float(change, "capital_cost", 0.0)
+        if pd.isna(change["change"]):
+            continue
+        if change["change"] not in RetrofitChanges:
+            raise ValueError(f"retrofit action {change['action']}: unknown change {change['change']}, "
+                             f"expected one of {', '.join(RetrofitChanges)}")
+        energy_types = [change["energy_type"]] + ([change["to_energy_type"]] if change["change"] == "conversion"
+                                                  else [])
+        for energy_type in energy_types:
+            if energy_type not in EnergyTypes:
+                raise ValueError(f"retrofit action {change['action']}: unknown energy type {energy_type}, "
+                                 f"expected one of {', '.join(EnergyTypes)}")
+        value = float(change["value"])
+        if not 0.0 <= value <= 1.0:
+            raise ValueError(f"retrofit action {change['action']}: value {value} must be between 0 and 1")
+
+        # row i of a transform holds where one billing unit of energy type i goes
+        from_index = EnergyTypes.index(change["energy_type"])
+        transforms[action_index, from_index, from_index] -= value
+        if change["change"] == "conversion":
+            to_index = EnergyTypes.index(change["to_energy_type"])
+            transforms[action_index, from_index, to_index] += (
+                value * _get_float(change, "energy_ratio", 1.0) *
+                kbtu_per_billing_unit[from_index] / kbtu_per_billing_unit[to_index])
+
+    remaining_fractions = transforms[:, np.arange(len(EnergyTypes)), np.arange(len(EnergyTypes))]
+    if (remaining_fractions < -1e-9).any():
+        action_index, energy_index = np.argwhere(remaining_fractions < -1e-9)[0]
+        raise ValueError(f"retrofit action {names[action_index]} removes more than all of the "
+                         f"{EnergyTypes[energy_index]} use")
+    transforms[:, np.arange(len(EnergyTypes)), np.arange(len(EnergyTypes))] = np.maximum(remaining_fractions, 0.0)
+    return RetrofitGrid(names, transforms, capital_cost_per_sq_foot)
+
+
+def _get_distinct_rows(coefficients_by_year: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    The distinct rows of a (years x EnergyTypes) coefficient table, and the index of each year's row among them.
+    Coefficients change every few years at most, so each action is weighed once per distinct row.
+    """
+    distinct_rows, row_by_year = np.unique(coefficients_by_year, axis=0, return_inverse=True)
+    return distinct_rows, row_by_year.reshape(-1)
+
+
+def _weigh_distinct_rows(consumption_by_energy_type: np.ndarray, distinct_rows: np.ndarray) -> np.ndarray:
+    """
+    (distinct rows x buildings) weighted totals of (EnergyTypes x buildings) consumption, accumulated in
+    EnergyTypes order like weigh_energy_consumption so that the totals of every year are the same bit for bit.
+    """
+    totals = np.zeros((len(distinct_rows), consumption_by_energy_type.shape[1]))
+    for row_index, coefficients in enumerate(distinct_rows):
+        for energy_index in range(len(EnergyTypes)):
+            totals[row_index] += consumption_by_energy_type[energy_index] * coefficients[energy_index]
+    return totals
+
+
+def _sum_years(values: np.ndarray, row_indexes: np.ndarray) -> np.ndarray:
+    # in year order, so that the averages of the "none" action match the year range datasets bit for bit
+    total = np.zeros(values.shape[1])
+    for row_index in row_indexes:
+        total += values[row_index]
+    return total
+
+
+def calculate_minimum_cost_retrofits(
+        retrofit_grid: RetrofitGrid,
+        df: pd.DataFrame,
+        coefficient_tables: CoefficientTables,
+        year_ranges: List[Tuple[int, int]],
+        mixed_use_thresholds: bool = False) -> Dict[str, np.ndarray]:
+    """
+    Find, for every building and year range, the action with the lowest capital cost plus cost of energy
+    over the range that keeps the carbon emissions of every year of the range under its threshold.
+    Each action is evaluated for every building at once, and for each distinct emission factor, price
+    and threshold rather than for each year.
+
+    Args:
+        retrofit_grid (RetrofitGrid): The actions
+        df (pd.DataFrame): Joined and cleaned LL97/LL84 dataset
+        coefficient_tables (CoefficientTables): Emission factors, energy prices and thresholds
+        year_ranges (List[Tuple[int, int]]): (start year, end year) tuples, see get_year_ranges
+        mixed_use_thresholds (bool): Sum the thresholds of the three largest uses of each building
+
+    Returns:
+        Dict[str, np.ndarray]: (buildings x year ranges) array for each of RetrofitColumns, "action" holding
+        the index of the action in the grid, -1 and NaN values where no action complies
+
+    Raises:
+        ValueError: If a year range falls outside of the coefficient tables
+    """
+    year_indexes = [coefficient_tables.get_year_indexes(list(get_years_in_range(year_range_tuple)))
+                    for year_range_tuple in year_ranges]
+    carbon_emissions_rows, carbon_emissions_row_by_year = _get_distinct_rows(
+        coefficient_tables.carbon_emissions_by_year)
+    cost_of_energy_rows, cost_of_energy_row_by_year = _get_distinct_rows(coefficient_tables.cost_of_energy_by_year)
+
+    # one sparse product for the threshold of every compliance period and the floor area the thresholds apply to,
+    # capital costs are per square foot of it
+    property_use_areas = PropertyUseAreas.from_dataframe(coefficient_tables, df, mixed_use_thresholds)
+    areas = property_use_areas.dot(np.column_stack([coefficient_tables.carbon_emissions_thresholds,
+                                                    np.ones(len(coefficient_tables.building_types))])).T.copy()
+    carbon_emissions_threshold_by_period, floor_area = areas[:-1], areas[-1]
+    # each year of a range complies if its emissions are under the threshold of its period,
+    # years with the same emission factors and period are checked once
+    compliance_checks = [sorted(set(zip(carbon_emissions_row_by_year[indexes],
+                                        coefficient_tables.period_by_year[indexes]))) for indexes in year_indexes]
+
+    shape = (len(year_ranges), len(df))
+    solutions = {column: np.full(shape, np.nan) for column in RetrofitColumns}
+    solutions["action"] = np.full(shape, -1, dtype=np.int64)
+    for range_index, indexes in enumerate(year_indexes):
+        solutions["carbon_emissions_threshold_per_year"][range_index] = _sum_years(
+            carbon_emissions_threshold_by_period, coefficient_tables.period_by_year[indexes]) / len(indexes)
+
+    energy_consumption_by_energy_type = np.ascontiguousarray(get_energy_consumption_matrix(df).T)
+    for action_index in range(len(retrofit_grid)):
+        consumption_by_energy_type = retrofit_grid.transforms[action_index].T @ energy_consumption_by_energy_type
+        carbon_emissions = _weigh_distinct_rows(consumption_by_energy_type, carbon_emissions_rows)
+        cost_of_energy = _weigh_distinct_rows(consumption_by_energy_type, cost_of_energy_rows)
+        capital_cost = floor_area * retrofit_grid.capital_cost_per_sq_foot[action_index]
+
+        for range_index, indexes in enumerate(year_indexes):
+            carbon_emissions_per_year = _sum_years(carbon_emissions, carbon_emissions_row_by_year[indexes]) / len(
+                indexes)
+            cost_of_energy_total = _sum_years(cost_of_energy, cost_of_energy_row_by_year[indexes])
+            if action_index == 0:
+                solutions["baseline_estimated_penalty_per_year"][range_index] = calculate_penalties_matrix(
+                    carbon_emissions_per_year, solutions["carbon_emissions_threshold_per_year"][range_index])
+
+            total_cost = capital_cost + cost_of_energy_total
+            # NaN costs never compare lower, ties keep the earlier action
+            better = ~(total_cost >= solutions["total_cost"][range_index])
+            for carbon_emissions_row, period in compliance_checks[range_index]:
+                better &= carbon_emissions[carbon_emissions_row] <= carbon_emissions_threshold_by_period[period]
+            for column, values in [("capital_cost", capital_cost),
+                                   ("total_cost", total_cost),
+                                   ("carbon_emissions_per_year", carbon_emissions_per_year),
+                                   ("cost_of_energy_per_year", cost_of_energy_total / len(indexes))]:
+                solutions[column][range_index, better] = values[better]
+            solutions["action"][range_index, better] = action_index
+
+    return {column: values.T for column, values in solutions.items()}
+
+
+def retrofits_to_long_dataframe(retrofit_grid: RetrofitGrid, index: pd.Index, year_ranges: List[Tuple[int, int]],
+                                solutions: Dict[str, np.ndarray]) -> pd.DataFrame:
+    """
+    Lay out (buildings x year ranges) solutions as a long table with one row per building and year range,
+    indexed by the building's BBL.
+    """
+    number_of_year_ranges = len(year_ranges)
+    action_names = np.append(np.asarray(retrofit_grid.names, dtype=object), None)
+    columns = {
+        "year_range": np.tile(np.asarray([get_year_range_string(year_range_tuple) for year_range_tuple in year_ranges],
+                                         dtype=object), len(index)),
+        # action -1 indexes the trailing None
+        "action": action_names[solutions["action"].reshape(-1)],
+    }
+    for column in RetrofitColumns[1:]:
+        columns[column] = solutions[column].reshape(-1)
+    return pd.DataFrame(columns, index=pd.Index(np.repeat(index.to_numpy(), number_of_year_ranges),
+                                                name=index.name or "BBL"))
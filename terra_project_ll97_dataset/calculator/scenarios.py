@@ -0,0 +1,207 @@
+"""
+Price, grid decarbonization and penalty scenarios.
+
+A scenario file is a .csv with one row per override:
+
+    scenario,parameter,energy_type,start_year,end_year,value
+    baseline,,,,,
+    clean_grid_2030,carbon_emissions,Electricity,2030,2050,0.0001
+    expensive_gas,cost_of_energy,Natural Gas,,,1.50
+    higher_penalty,penalty,,2030,,300
+
+parameter is one of carbon_emissions (tCO2e per billing unit, see carbon_emissions.py), cost_of_energy
+($ per billing unit, see cost_of_energy.py) or penalty ($ per tCO2e over the threshold). energy_type is
+required for carbon_emissions and cost_of_energy. start_year and end_year default to the first and last
+year of the tables. A row without a parameter declares a scenario that uses the default coefficients.
+Every scenario starts from the default coefficients and applies its overrides in file order.
+"""
+
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from terra_project_ll97_dataset.calculator.coefficient_tables import CoefficientTables
+from terra_project_ll97_dataset.calculator.energy_unit_conversion import weigh_energy_consumption
+from terra_project_ll97_dataset.calculator.penalties import calculate_penalties_matrix, \
+    penalty_per_tCO2_over_threshold
+from terra_project_ll97_dataset.util.common import EnergyTypes, Metrics, get_required_metrics
+
+ScenarioParameters: List[str] = [
+    "carbon_emissions",
+    "cost_of_energy",
+    "penalty",
+]
+
+
+class ScenarioGrid:
+    """
+    Coefficients of every scenario stacked along a leading scenario axis.
+    """
+
+    def __init__(
+            self,
+            names: List[str],
+            years: List[int],
+            carbon_emissions_by_year: np.ndarray,
+            cost_of_energy_by_year: np.ndarray,
+            penalty_per_tCO2: np.ndarray):
+        """
+        Args:
+            names (List[str]): Scenario names
+            years (List[int]): Years covered by the coefficients
+            carbon_emissions_by_year (np.ndarray): (scenarios x years x EnergyTypes) emissions per billing unit
+            cost_of_energy_by_year (np.ndarray): (scenarios x years x EnergyTypes) cost per billing unit
+            penalty_per_tCO2 (np.ndarray): (scenarios x years) penalty per tCO2e over the threshold
+        """
+        self.names = names
+        self.years = years
+        self.carbon_emissions_by_year = carbon_emissions_by_year
+        self.cost_of_energy_by_year = cost_of_energy_by_year
+        self.penalty_per_tCO2 = penalty_per_tCO2
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def batches(self, batch_size: int) -> Iterator[Tuple[slice, List[str]]]:
+        for start in range(0, len(self.names), batch_size):
+            yield slice(start, start + batch_size), self.names[start:start + batch_size]
+
+
+def _get_year_slice(override: pd.Series, years: List[int]) -> slice:
+    start_year = years[0] if pd.isna(override["start_year"]) else int(override["start_year"])
+    end_year = years[-1] if pd.isna(override["end_year"]) else int(override["end_year"])
+    if start_year < years[0] or end_year > years[-1] or end_year < start_year:
+        raise ValueError(f"scenario {override['scenario']}: years {start_year}-{end_year} must be "
+                         f"between {years[0]} and {years[-1]}")
+    return slice(start_year - years[0], end_year - years[0] + 1)
+
+
+def _get_value(override: pd.Series) -> float:
+    if pd.isna(override["value"]):
+        raise ValueError(f"scenario {override['scenario']}: the {override['parameter']} override has no value")
+    try:
+        return float(override["value"])
+    except ValueError:
+        raise ValueError(f"scenario {override['scenario']}: the {override['parameter']} override value "
+                         f"{override['value']!r} is not a number")
+
+
+def load_scenario_grid(scenarios: Union[str, pd.DataFrame], coefficient_tables: CoefficientTables) -> ScenarioGrid:
+    """
+    Read a scenario file, or a DataFrame with its columns, and apply each scenario's overrides
+    to a copy of the coefficient tables.
+
+    Raises:
+        ValueError: If an override names an unknown parameter or energy type, or years outside of the tables,
+            or has no numeric value
+    """
+    if isinstance(scenarios, pd.DataFrame):
+        overrides = scenarios
+    else:
+        overrides = pd.read_csv(scenarios, dtype={"scenario": str, "parameter": str, "energy_type": str})
+    names = list(dict.fromkeys(overrides["scenario"]))
+    years = coefficient_tables.years
+
+    carbon_emissions_by_year = np.repeat(coefficient_tables.carbon_emissions_by_year[np.newaxis], len(names), axis=0)
+    cost_of_energy_by_year = np.repeat(coefficient_tables.cost_of_energy_by_year[np.newaxis], len(names), axis=0)
+    penalty_per_tCO2 = np.full((len(names), len(years)), float(penalty_per_tCO2_over_threshold))
+
+    scenario_indexes = {name: index for index, name in enumerate(names)}
+    for _, override in overrides.iterrows():
+        parameter = override["parameter"]
+        if pd.isna(parameter):
+            continue
+        if parameter not in ScenarioParameters:
+            raise ValueError(f"scenario {override['scenario']}: unknown parameter {parameter}, "
+                             f"expected one of {', '.join(ScenarioParameters)}")
+
+        scenario_index = scenario_indexes[override["scenario"]]
+        year_slice = _get_year_slice(override, years)
+        if parameter == "penalty":
+            penalty_per_tCO2[scenario_index, year_slice] = _get_value(override)
+            continue
+
+        if override["energy_type"] not in EnergyTypes:
+            raise ValueError(f"scenario {override['scenario']}: unknown energy type {override['energy_type']}, "
+                             f"expected one of {', '.join(EnergyTypes)}")
+        coefficients = carbon_emissions_by_year if parameter == "carbon_emissions" else cost_of_energy_by_year
+        coefficients[scenario_index, year_slice, EnergyTypes.index(override["energy_type"])] = _get_value(override)
+
+    return ScenarioGrid(names, years, carbon_emissions_by_year, cost_of_energy_by_year, penalty_per_tCO2)
+
+
+def _get_year_indexes(scenario_grid: ScenarioGrid, years: Optional[List[int]]) -> Union[slice, List[int]]:
+    if years is None:
+        return slice(None)
+    missing_years = [year for year in years if year not in scenario_grid.years]
+    if missing_years:
+        raise ValueError(f"years {', '.join(map(str, missing_years))} are outside of the scenario years "
+                         f"{scenario_grid.years[0]}-{scenario_grid.years[-1]}")
+    return [scenario_grid.years.index(year) for year in years]
+
+
+def calculate_scenario_metrics(
+        scenario_grid: ScenarioGrid,
+        scenarios: slice,
+        energy_consumption: Optional[np.ndarray],
+        carbon_emissions_threshold: Optional[np.ndarray],
+        years: Optional[List[int]] = None,
+        metrics: Optional[List[str]] = None) -> Dict[str, np.ndarray]:
+    """
+    Calculate the metrics for a batch of scenarios, every building and every year in one broadcast.
+    Only the requested metrics and the metrics they are derived from are calculated.
+
+    Args:
+        scenario_grid (ScenarioGrid): The scenarios
+        scenarios (slice): The batch of scenarios to calculate
+        energy_consumption (Optional[np.ndarray]): (buildings x EnergyTypes) consumption in billing units,
+            None if neither carbon emissions nor cost of energy are required
+        carbon_emissions_threshold (Optional[np.ndarray]): (buildings x years) thresholds, which do not vary
+            by scenario, None if the threshold is not required
+        years (Optional[List[int]]): The years to calculate (defaults to every year of the grid)
+        metrics (Optional[List[str]]): The metrics to calculate (defaults to every metric in Metrics)
+
+    Returns:
+        Dict[str, np.ndarray]: (scenarios x buildings x years) array for each required metric
+    """
+    required_metrics = get_required_metrics(metrics)
+    year_indexes = _get_year_indexes(scenario_grid, years)
+    scenario_metrics = {}
+    if "carbon_emissions" in required_metrics:
+        scenario_metrics["carbon_emissions"] = weigh_energy_consumption(
+            energy_consumption, scenario_grid.carbon_emissions_by_year[scenarios][:, year_indexes])
+    if "cost_of_energy" in required_metrics:
+        scenario_metrics["cost_of_energy"] = weigh_energy_consumption(
+            energy_consumption, scenario_grid.cost_of_energy_by_year[scenarios][:, year_indexes])
+    if "carbon_emissions_threshold" in required_metrics:
+        number_of_scenarios = len(range(*scenarios.indices(len(scenario_grid))))
+        scenario_metrics["carbon_emissions_threshold"] = np.broadcast_to(
+            carbon_emissions_threshold, (number_of_scenarios,) + carbon_emissions_threshold.shape)
+    if "estimated_penalty" in required_metrics:
+        scenario_metrics["estimated_penalty"] = calculate_penalties_matrix(
+            scenario_metrics["carbon_emissions"], scenario_metrics["carbon_emissions_threshold"],
+            scenario_grid.penalty_per_tCO2[scenarios][:, year_indexes][:, np.newaxis, :])
+    return scenario_metrics
+
+
+def scenario_metrics_to_long_dataframe(
+        scenario_names: List[str],
+        index: pd.Index,
+        years: List[int],
+        scenario_metrics: Dict[str, np.ndarray],
+        metrics: Optional[List[str]] = None) -> pd.DataFrame:
+    """
+    Lay out (scenarios x buildings x years) metrics as a long table with one row per scenario, building and year,
+    and one column per metric in metrics (defaults to every metric in Metrics).
+    """
+    number_of_buildings, number_of_years = len(index), len(years)
+    columns = {
+        "scenario": np.repeat(np.asarray(scenario_names, dtype=object), number_of_buildings * number_of_years),
+        index.name or "BBL": np.tile(np.repeat(index.to_numpy(), number_of_years), len(scenario_names)),
+        "year": np.tile(np.asarray(years), len(scenario_names) * number_of_buildings),
+    }
+    for metric in Metrics:
+        if metrics is None or metric in metrics:
+            columns[metric] = scenario_metrics[metric].reshape(-1)
+    return pd.DataFrame(columns)
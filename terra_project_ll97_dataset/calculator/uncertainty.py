@@ -0,0 +1,276 @@
+"""
+Monte Carlo bands of the yearly and year range metrics.
+
+Each sample multiplies the emission factors and the energy prices of every energy type, and the energy use
+of every building and energy type, by a random factor 1 + sd * z, with z standard normal and the factor
+clipped at zero. The factors of the coefficient tables are shared by every building and year of a sample,
+the factors of the energy use are drawn for each building. Thresholds do not depend on the energy use and
+are not perturbed.
+
+Samples are evaluated in batches, for every building of a block and every distinct emission factor or
+price row of the years and year ranges at once, and reduced to streaming quantile estimates, so that
+memory does not grow with the number of samples. A year range is evaluated as one more row, the average
+of the rows of its years, which gives the average over the range of each sample. The penalty only grows
+with the emissions, so its percentiles are the penalties of the emission percentiles.
+
+Random numbers are drawn from generators seeded with the seed and the index of each block of
+SAMPLE_BLOCK_SIZE buildings, so the bands of a building do not depend on the other buildings,
+on the batch size or on how the buildings are split over workers.
+"""
+
+import logging
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from terra_project_ll97_dataset.calculator.carbon_emissions_thresholds import PropertyUseAreas
+from terra_project_ll97_dataset.calculator.coefficient_tables import CoefficientTables
+from terra_project_ll97_dataset.calculator.energy_unit_conversion import get_energy_consumption_matrix
+from terra_project_ll97_dataset.calculator.penalties import calculate_penalties_matrix
+from terra_project_ll97_dataset.calculator.yearly_metrics import YearlyMetrics
+from terra_project_ll97_dataset.util.common import EnergyTypes, Metrics, get_required_metrics, \
+    get_year_range_string, get_years_in_range
+from terra_project_ll97_dataset.util.quantile_sketch import QuantileSketch
+
+logger = logging.getLogger(__name__)
+
+# buildings drawn from the same random number generator
+SAMPLE_BLOCK_SIZE = 1024
+
+# values of each building, year and metric kept by the quantile sketches
+QUANTILE_SKETCH_SIZE = 256
+
+# percentiles written for each metric by default
+SamplePercentiles: List[int] = [10, 50, 90]
+
+# metrics whose coefficients are perturbed, with the index of their factors in each sample
+_sampled_metrics = {
+    "carbon_emissions": 0,
+    "cost_of_energy": 1,
+}
+
+
+class Uncertainty:
+    """
+    Relative standard deviations of the random factors drawn for each sample.
+    """
+
+    def __init__(self, carbon_emissions_factors: float = 0.05, cost_of_energy_prices: float = 0.10,
+                 energy_consumption: float = 0.10):
+        """
+        Args:
+            carbon_emissions_factors (float): Of the emission factor of each energy type
+            cost_of_energy_prices (float): Of the price of each energy type
+            energy_consumption (float): Of the energy use of each building and energy type
+        """
+        for name, value in [("carbon_emissions_factors", carbon_emissions_factors),
+                            ("cost_of_energy_prices", cost_of_energy_prices),
+                            ("energy_consumption", energy_consumption)]:
+            if not value >= 0:
+                raise ValueError(f"the uncertainty of the {name} must not be negative, not {value}")
+        self.carbon_emissions_factors = carbon_emissions_factors
+        self.cost_of_energy_prices = cost_of_energy_prices
+        self.energy_consumption = energy_consumption
+
+
+def _draw_factors(rng: np.random.Generator, shape: Tuple[int, ...], relative_standard_deviation) -> np.ndarray:
+    # a negative emission factor, price or energy use has no meaning
+    return np.maximum(1.0 + relative_standard_deviation * rng.standard_normal(shape), 0.0)
+
+
+def _get_cells(coefficients_by_year: np.ndarray, periods: List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    The distinct coefficient rows of the periods, each a year or a year range, and the index of each period's row.
+    The row of a year range is the average of the rows of its years.
+    """
+    rows = np.zeros((len(periods), coefficients_by_year.shape[1]))
+    for period_index, year_indexes in enumerate(periods):
+        period_rows = coefficients_by_year[year_indexes]
+        if (period_rows == period_rows[0]).all():
+            # not averaged, so that a range of years sharing their coefficients is one cell with those years
+            rows[period_index] = period_rows[0]
+            continue
+        for row in period_rows:
+            rows[period_index] += row
+        rows[period_index] /= len(year_indexes)
+    cells, cell_by_period = np.unique(rows, axis=0, return_inverse=True)
+    return cells, cell_by_period.reshape(-1)
+
+
+def _sample_block(energy_consumption: np.ndarray, buildings: slice, rng: np.random.Generator,
+                  coefficient_factors: np.ndarray, cells: np.ndarray, cell_factors: np.ndarray,
+                  energy_consumption_uncertainty: float, percentiles: List[float], batch_size: int) -> np.ndarray:
+    """
+    Percentiles of the sampled emissions or costs of some buildings of a block, for each cell.
+
+    Args:
+        energy_consumption (np.ndarray): (block buildings x EnergyTypes) energy use in billing units
+        buildings (slice): The buildings of the block to estimate the percentiles of
+        rng (np.random.Generator): Generator of the block
+        coefficient_factors (np.ndarray): (samples x 2 x EnergyTypes) factors of the emission factors and prices
+        cells (np.ndarray): (cells x EnergyTypes) coefficient rows
+        cell_factors (np.ndarray): (cells) index of the factors of each cell in coefficient_factors
+        energy_consumption_uncertainty (float): Relative standard deviation of the energy use
+        percentiles (List[float]): The percentiles to estimate
+        batch_size (int): Number of samples evaluated at a time
+
+    Returns:
+        np.ndarray: (buildings x cells x percentiles) estimates
+    """
+    samples = len(coefficient_factors)
+    energy_consumption_by_energy_type = energy_consumption.T[:, buildings, np.newaxis]
+    number_of_buildings = energy_consumption_by_energy_type.shape[1]
+    # energy types no building uses add nothing to any sample
+    energy_indexes = [energy_index for energy_index in range(len(EnergyTypes))
+                      if energy_consumption_by_energy_type[energy_index].any()]
+    sketch = QuantileSketch(QUANTILE_SKETCH_SIZE)
+    for batch_start in range(0, samples, batch_size):
+        batch = slice(batch_start, min(batch_start + batch_size, samples))
+        # drawn for every building of the block in sample order, whatever the batch size and the buildings
+        consumption_factors = _draw_factors(rng, (batch.stop - batch.start,) + energy_consumption.shape,
+                                            energy_consumption_uncertainty)
+        # (EnergyTypes x buildings x samples)
+        perturbed_consumption = (energy_consumption_by_energy_type *
+                                 consumption_factors.transpose(2, 1, 0)[:, buildings])
+        # (cells x EnergyTypes x samples)
+        perturbed_coefficients = cells[:, :, np.newaxis] * coefficient_factors[batch, cell_factors].transpose(1, 2, 0)
+
+        # elementwise products accumulated in EnergyTypes order, the totals of a building do not depend
+        # on the other buildings of the batch as they could with a matrix product
+        totals = np.zeros((len(cells), number_of_buildings, batch.stop - batch.start))
+        for cell_index in range(len(cells)):
+            for energy_index in energy_indexes:
+                totals[cell_index] += perturbed_consumption[energy_index] * perturbed_coefficients[cell_index,
+                                                                                                   energy_index]
+        sketch.update(totals.reshape(-1, totals.shape[2]))
+    return sketch.quantiles(percentiles).reshape(len(cells), number_of_buildings, len(percentiles)).transpose(1, 0, 2)
+
+
+def calculate_sampled_metrics(
+        df: pd.DataFrame,
+        coefficient_tables: CoefficientTables,
+        years: List[int],
+        year_ranges: List[Tuple[int, int]],
+        samples: int,
+        uncertainty: Optional[Uncertainty] = None,
+        percentiles: Optional[List[float]] = None,
+        seed: int = 0,
+        metrics: Optional[List[str]] = None,
+        mixed_use_thresholds: bool = False,
+        buildings: slice = slice(None),
+        batch_size: int = 256) -> Tuple[Dict[float, YearlyMetrics], Dict[float, YearlyMetrics]]:
+    """
+    Estimate percentiles of the yearly and year range metrics of the buildings in df over random
+    perturbations of the emission factors, energy prices and energy use.
+
+    Args:
+        df (pd.DataFrame): Joined and cleaned LL97/LL84 dataset
+        coefficient_tables (CoefficientTables): Emission factors, energy prices and thresholds
+        years (List[int]): The years to estimate the yearly metrics for
+        year_ranges (List[Tuple[int, int]]): (start year, end year) tuples, see get_year_ranges
+        samples (int): Number of samples
+        uncertainty (Optional[Uncertainty]): Standard deviations of the perturbations (defaults to Uncertainty())
+        percentiles (Optional[List[float]]): Percentiles to estimate (defaults to SamplePercentiles)
+        seed (int): Seed of the random numbers, the same seed gives the same estimates
+        metrics (Optional[List[str]]): The metrics to output (defaults to every metric in Metrics)
+        mixed_use_thresholds (bool): Sum the thresholds of the three largest uses of each building
+        buildings (slice): Rows of df to estimate the metrics of, e.g. the shard of a worker
+        batch_size (int): Number of samples evaluated at a time, bounds the memory used
+
+    Returns:
+        Tuple[Dict[float, YearlyMetrics], Dict[float, YearlyMetrics]]: The (buildings x years) and
+        (buildings x year ranges) metrics of each percentile
+
+    Raises:
+        ValueError: If samples or batch_size is not positive, a percentile is outside of 0-100,
+            or a year or year range falls outside of the coefficient tables
+    """
+    if samples < 1 or batch_size < 1:
+        raise ValueError(f"samples and batch size must be positive, not {samples} and {batch_size}")
+    percentiles = SamplePercentiles if percentiles is None else percentiles
+    if not percentiles or not all(0 <= percentile <= 100 for percentile in percentiles):
+        raise ValueError(f"percentiles must be between 0 and 100, not {percentiles}")
+    uncertainty = uncertainty or Uncertainty()
+    required_metrics = get_required_metrics(metrics)
+    metrics = [metric for metric in Metrics if metrics is None or metric in metrics]
+    start, stop, _ = buildings.indices(len(df))
+    stop = max(start, stop)
+
+    # a period is a year or a year range, each with the indexes of its years in the coefficient tables
+    periods = ([coefficient_tables.get_year_indexes([year]) for year in years] +
+               [coefficient_tables.get_year_indexes(list(get_years_in_range(year_range_tuple)))
+                for year_range_tuple in year_ranges])
+    coefficients_by_metric = {
+        "carbon_emissions": coefficient_tables.carbon_emissions_by_year,
+        "cost_of_energy": coefficient_tables.cost_of_energy_by_year,
+    }
+    cells, cell_factors, cell_by_period = [], [], {}
+    for metric, factor_index in _sampled_metrics.items():
+        if metric in required_metrics:
+            metric_cells, metric_cell_by_period = _get_cells(coefficients_by_metric[metric], periods)
+            cell_by_period[metric] = len(cells) + metric_cell_by_period
+            cells.extend(metric_cells)
+            cell_factors.extend([factor_index] * len(metric_cells))
+
+    estimates = np.zeros((stop - start, len(cells), len(percentiles)))
+    if cells and stop > start:
+        cells, cell_factors = np.asarray(cells), np.asarray(cell_factors)
+        coefficient_factors = _draw_factors(
+            np.random.default_rng([seed, 0]), (samples, len(_sampled_metrics), len(EnergyTypes)),
+            np.array([[uncertainty.carbon_emissions_factors], [uncertainty.cost_of_energy_prices]]))
+        for block_index in range(start // SAMPLE_BLOCK_SIZE, (stop - 1) // SAMPLE_BLOCK_SIZE + 1):
+            block_start = block_index * SAMPLE_BLOCK_SIZE
+            block_stop = min(block_start + SAMPLE_BLOCK_SIZE, len(df))
+            sampled_start, sampled_stop = max(start, block_start), min(stop, block_stop)
+            estimates[sampled_start - start:sampled_stop - start] = _sample_block(
+                get_energy_consumption_matrix(df.iloc[block_start:block_stop]),
+                slice(sampled_start - block_start, sampled_stop - block_start),
+                np.random.default_rng([seed, 1, block_index]), coefficient_factors, cells, cell_factors,
+                uncertainty.energy_consumption, percentiles, batch_size)
+            logger.info("sampled buildings %d-%d of %d", sampled_start + 1, sampled_stop, len(df))
+
+    carbon_emissions_threshold_by_period = None
+    if "carbon_emissions_threshold" in required_metrics:
+        carbon_emissions_threshold_by_period = PropertyUseAreas.from_dataframe(
+            coefficient_tables, df.iloc[start:stop], mixed_use_thresholds).dot(
+            coefficient_tables.carbon_emissions_thresholds)
+
+    yearly_bands, year_range_bands = {}, {}
+    for bands, period_indexes, period_names, column_suffix in [
+            (yearly_bands, range(len(years)), list(years), ""),
+            (year_range_bands, range(len(years), len(periods)),
+             [get_year_range_string(year_range_tuple) for year_range_tuple in year_ranges], "_per_year")]:
+        thresholds = None
+        if carbon_emissions_threshold_by_period is not None:
+            thresholds = np.zeros((stop - start, len(period_indexes)))
+            for column_index, period_index in enumerate(period_indexes):
+                # the years in order, like the averages of calculate_year_range_metrics
+                for year_index in periods[period_index]:
+                    thresholds[:, column_index] += carbon_emissions_threshold_by_period[
+                        :, coefficient_tables.period_by_year[year_index]]
+                thresholds[:, column_index] /= len(periods[period_index])
+
+        for percentile_index, percentile in enumerate(percentiles):
+            values = {metric: estimates[:, cell_by_period[metric][list(period_indexes)], percentile_index]
+                      for metric in cell_by_period}
+            if thresholds is not None:
+                values["carbon_emissions_threshold"] = thresholds
+            if "estimated_penalty" in required_metrics:
+                values["estimated_penalty"] = calculate_penalties_matrix(
+                    values["carbon_emissions"], values["carbon_emissions_threshold"])
+            bands[percentile] = YearlyMetrics(period_names, values, column_suffix, metrics)
+    return yearly_bands, year_range_bands
+
+
+def bands_to_dataframe(bands: Dict[float, YearlyMetrics], index: pd.Index) -> pd.DataFrame:
+    """
+    Lay the metrics of each percentile out as "{year}_{metric}{column_suffix}_p{percentile}" columns,
+    grouped by year and then by metric.
+    """
+    percentile_frames = {percentile: metrics.to_dataframe(index) for percentile, metrics in bands.items()}
+    columns = {}
+    for column in next(iter(percentile_frames.values())).columns:
+        for percentile, frame in percentile_frames.items():
+            columns[f"{column}_p{percentile:g}"] = frame[column].to_numpy()
+    return pd.DataFrame(columns, index=index)
@@ -0,0 +1,174 @@
+"""
+Columnar calculation of carbon emissions, energy costs, thresholds and penalties.
+Every metric is computed for all buildings and all years at once as a (buildings x years) array.
+"""
+
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from terra_project_ll97_dataset.calculator.carbon_emissions import get_carbon_emissions_matrix
+from terra_project_ll97_dataset.calculator.carbon_emissions_thresholds import get_carbon_emissions_thresholds_matrix
+from terra_project_ll97_dataset.calculator.coefficient_tables import CoefficientTables
+from terra_project_ll97_dataset.calculator.cost_of_energy import get_cost_of_energy_matrix
+from terra_project_ll97_dataset.calculator.energy_unit_conversion import get_energy_consumption_matrix
+from terra_project_ll97_dataset.calculator.penalties import calculate_penalties_matrix
+from terra_project_ll97_dataset.util.common import Metrics, get_required_metrics, get_year_range_string, \
+    get_years_in_range
+
+
+class YearlyMetrics:
+    """
+    Holds one (buildings x years) array per calculated metric.
+    Also used for metrics averaged over year ranges, in which case years holds the year range strings.
+    """
+
+    def __init__(self, years: List[Union[int, str]], values: Dict[str, np.ndarray], column_suffix: str = "",
+                 metrics: Optional[List[str]] = None):
+        """
+        Args:
+            years (List[Union[int, str]]): The years (or year ranges) covered by the columns of every array
+            values (Dict[str, np.ndarray]): (buildings x years) array for each metric
+            column_suffix (str): Appended to every column name, e.g. "_per_year" for year ranges
+            metrics (Optional[List[str]]): The metrics to output, in Metrics order (defaults to every metric
+                in values). values may also hold the metrics they were derived from
+        """
+        self.years = years
+        self.values = values
+        self.column_suffix = column_suffix
+        self.metrics = metrics if metrics is not None else [metric for metric in Metrics if metric in values]
+
+    def select(self, years: Optional[List[Union[int, str]]] = None,
+               metrics: Optional[List[str]] = None) -> "YearlyMetrics":
+        """
+        The given years and output metrics of these metrics.
+
+        Args:
+            years (Optional[List[Union[int, str]]]): Years to keep, in output order (defaults to every year)
+            metrics (Optional[List[str]]): Metrics to keep (defaults to the output metrics)
+
+        Returns:
+            YearlyMetrics: The selected metrics, sharing the arrays when every year is kept
+
+        Raises:
+            ValueError: If a year was not calculated
+        """
+        metrics = [metric for metric in Metrics if metric in (metrics if metrics is not None else self.metrics)]
+        if years is None or list(years) == list(self.years):
+            return YearlyMetrics(self.years, {metric: self.values[metric] for metric in metrics},
+                                 self.column_suffix, metrics)
+
+        year_indexes = {year: year_index for year_index, year in enumerate(self.years)}
+        missing_years = [year for year in years if year not in year_indexes]
+        if missing_years:
+            raise ValueError(f"years {', '.join(map(str, missing_years))} were not calculated")
+        selected_indexes = [year_indexes[year] for year in years]
+        return YearlyMetrics(list(years), {metric: self.values[metric][:, selected_indexes] for metric in metrics},
+                             self.column_suffix, metrics)
+
+    def to_dataframe(self, index: pd.Index) -> pd.DataFrame:
+        """
+        Lay the output metrics out as "{year}_{metric}{column_suffix}" columns, grouped by year.
+
+        Args:
+            index (pd.Index): Index of the buildings the metrics were calculated for
+
+        Returns:
+            pd.DataFrame: One row per building and one column per year and metric
+        """
+        columns = {}
+        for year_index, year in enumerate(self.years):
+            for metric in self.metrics:
+                columns[f"{year}_{metric}{self.column_suffix}"] = self.values[metric][:, year_index]
+        return pd.DataFrame(columns, index=index)
+
+
+def calculate_yearly_metrics(
+        df: pd.DataFrame,
+        years: List[int],
+        coefficient_tables: CoefficientTables,
+        metrics: Optional[List[str]] = None,
+        mixed_use_thresholds: bool = False) -> YearlyMetrics:
+    """
+    Calculate the metrics for every building in df and every year. Only the requested metrics and
+    the metrics they are derived from are calculated, see MetricDependencies.
+
+    Args:
+        df (pd.DataFrame): Joined and cleaned LL97/LL84 dataset
+        years (List[int]): The years to calculate the metrics for
+        coefficient_tables (CoefficientTables): Emission factors, energy prices and thresholds
+        metrics (Optional[List[str]]): The metrics to output (defaults to every metric in Metrics)
+        mixed_use_thresholds (bool): Sum the thresholds of the three largest uses of each building
+            instead of applying the threshold of the largest use to its floor area only
+
+    Returns:
+        YearlyMetrics: The calculated metrics
+    """
+    required_metrics = get_required_metrics(metrics)
+    values = {}
+    if "carbon_emissions" in required_metrics or "cost_of_energy" in required_metrics:
+        energy_consumption = get_energy_consumption_matrix(df)
+        if "carbon_emissions" in required_metrics:
+            values["carbon_emissions"] = get_carbon_emissions_matrix(coefficient_tables, years, energy_consumption)
+        if "cost_of_energy" in required_metrics:
+            values["cost_of_energy"] = get_cost_of_energy_matrix(coefficient_tables, years, energy_consumption)
+    if "carbon_emissions_threshold" in required_metrics:
+        values["carbon_emissions_threshold"] = get_carbon_emissions_thresholds_matrix(
+            coefficient_tables, years, df, mixed_use_thresholds)
+    if "estimated_penalty" in required_metrics:
+        values["estimated_penalty"] = calculate_penalties_matrix(
+            values["carbon_emissions"], values["carbon_emissions_threshold"])
+
+    return YearlyMetrics(years, values, metrics=[metric for metric in Metrics if metrics is None or metric in metrics])
+
+
+def calculate_year_range_metrics(yearly_metrics: YearlyMetrics, year_ranges: List[Tuple[int, int]],
+                                 metrics: Optional[List[str]] = None) -> YearlyMetrics:
+    """
+    Average the yearly emissions, costs and thresholds over each year range and derive the penalty
+    from the averages. Nothing is recalculated: each range is a reduction over columns of the yearly arrays.
+
+    Args:
+        yearly_metrics (YearlyMetrics): Metrics for every building and year, including the metrics
+            the requested metrics are derived from
+        year_ranges (List[Tuple[int, int]]): (start year, end year) tuples, see get_year_ranges
+        metrics (Optional[List[str]]): The metrics to output (defaults to the output metrics of yearly_metrics)
+
+    Returns:
+        YearlyMetrics: (buildings x ranges) arrays, with years holding the year range strings
+
+    Raises:
+        ValueError: If a year range falls outside of the years in yearly_metrics
+    """
+    if metrics is None:
+        metrics = yearly_metrics.metrics
+    required_metrics = get_required_metrics(metrics)
+    year_indexes = {year: year_index for year_index, year in enumerate(yearly_metrics.years)}
+    number_of_buildings = next(iter(yearly_metrics.values.values())).shape[0]
+
+    averaged_metrics = [metric for metric in ["carbon_emissions", "cost_of_energy", "carbon_emissions_threshold"]
+                        if metric in required_metrics]
+    values = {metric: np.zeros((number_of_buildings, len(year_ranges))) for metric in averaged_metrics}
+    for range_index, year_range_tuple in enumerate(year_ranges):
+        year_range = get_years_in_range(year_range_tuple)
+        if len(year_range) == 0:
+            continue
+        missing_years = [year for year in year_range if year not in year_indexes]
+        if missing_years:
+            raise ValueError(f"year range {get_year_range_string(year_range_tuple)} is outside of the years "
+                             f"{yearly_metrics.years[0]}-{yearly_metrics.years[-1]} that were calculated")
+
+        for metric in averaged_metrics:
+            # sum the years in order rather than differencing a cumulative sum, which would not
+            # reproduce the per-row averages bit for bit
+            total = values[metric][:, range_index]
+            for year in year_range:
+                total += yearly_metrics.values[metric][:, year_indexes[year]]
+            total /= len(year_range)
+
+    if "estimated_penalty" in required_metrics:
+        values["estimated_penalty"] = calculate_penalties_matrix(
+            values["carbon_emissions"], values["carbon_emissions_threshold"])
+    return YearlyMetrics([get_year_range_string(year_range_tuple) for year_range_tuple in year_ranges], values,
+                         column_suffix="_per_year", metrics=[metric for metric in Metrics if metric in metrics])
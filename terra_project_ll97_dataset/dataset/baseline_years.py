@@ -0,0 +1,122 @@
+"""
+Multi-year LL84 data: reporting years and trends of the energy use across them.
+
+With several LL84 reporting years, each LL97 building is joined to its LL84 row of every year it reported
+(see join_ll97_ll84_by_baseline_year), so the projections of every baseline year are calculated in one pass
+over (BBL, baseline year) rows. The trend features fit a line through the energy use of each building over
+its reporting years, for all buildings at once with grouped sums, and the projections can start from the
+fitted line instead of the use reported in the baseline year.
+"""
+
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+from terra_project_ll97_dataset.calculator import energy_unit_conversion
+
+# column holding the LL84 reporting year each row was joined from
+BASELINE_YEAR_COLUMN = "Baseline Year"
+
+# number of reporting years the trend features of a building were fitted over
+REPORTING_YEARS_COLUMN = "Reporting Years"
+
+# LL84 columns the reporting year is read from, in order of preference: recent exports have a Calendar Year
+# column, older ones the end date of the reporting period
+LL84_YEAR_COLUMNS: List[str] = [
+    "Calendar Year",
+    "Year Ending",
+]
+
+# energy use columns the trend features are fitted for
+TrendColumns: List[str] = energy_unit_conversion.required_columns
+
+
+def get_trend_column_names(column: str) -> List[str]:
+    # the slope of the fitted line, and its value in the baseline year of the row
+    return [f"{column} - Trend per Year", f"{column} - Trend"]
+
+
+def get_reporting_years(ll84_df: pd.DataFrame) -> pd.Series:
+    """
+    Reporting year of each LL84 row, <NA> when none of LL84_YEAR_COLUMNS holds a year.
+
+    Raises:
+        ValueError: If ll84_df has none of LL84_YEAR_COLUMNS
+    """
+    year_columns = [column for column in LL84_YEAR_COLUMNS if column in ll84_df.columns]
+    if not year_columns:
+        raise ValueError(f"the LL84 data needs one of the columns {', '.join(LL84_YEAR_COLUMNS)} "
+                         f"to be joined by baseline year")
+    reporting_years = pd.Series(pd.NA, index=ll84_df.index, dtype="Int64")
+    for column in year_columns:
+        if column == "Year Ending":
+            years = pd.to_datetime(ll84_df[column], errors="coerce", format="mixed").dt.year
+        else:
+            years = pd.to_numeric(ll84_df[column], errors="coerce")
+        # files of different years may have different year columns
+        reporting_years = reporting_years.fillna(years.round().astype("Int64"))
+    return reporting_years
+
+
+def calculate_trend_features(joined_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Least squares line through the energy use of each building over its reporting years, for each of
+    TrendColumns. The trend of a year-to-year series is not thrown off by a single warm or cold year as
+    the use of a single year is.
+
+    Args:
+        joined_df (pd.DataFrame): Cleaned dataset with one row per BBL and baseline year, indexed by BBL
+
+    Returns:
+        pd.DataFrame: For each row, the number of reporting years of its building and, for each of
+        TrendColumns, the slope of the line and its value in the row's baseline year. The slope is NaN
+        for buildings with a single reporting year, whose line is their use in that year
+    """
+    building_codes, _ = pd.factorize(joined_df.index)
+    baseline_years = joined_df[BASELINE_YEAR_COLUMN].to_numpy(dtype=float, na_value=np.nan)
+    fitted = (building_codes >= 0) & ~np.isnan(baseline_years)
+    building_codes = np.where(fitted, building_codes, 0)
+    weights = fitted.astype(float)
+    number_of_buildings = building_codes.max() + 1 if len(building_codes) else 0
+
+    def sum_by_building(values: np.ndarray) -> np.ndarray:
+        return np.bincount(building_codes, weights=np.where(fitted, values, 0.0), minlength=number_of_buildings)
+
+    counts = sum_by_building(weights)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean_years = sum_by_building(baseline_years) / counts
+        year_offsets = baseline_years - mean_years[building_codes]
+        sums_of_squares = sum_by_building(year_offsets ** 2)
+
+        features = {REPORTING_YEARS_COLUMN: np.where(fitted, counts[building_codes], np.nan)}
+        for column in TrendColumns:
+            values = joined_df[column].to_numpy(dtype=float)
+            mean_values = sum_by_building(values) / counts
+            slopes = np.where(sums_of_squares > 0, sum_by_building(year_offsets * values) / sums_of_squares, np.nan)
+            slope_column, trend_column = get_trend_column_names(column)
+            features[slope_column] = np.where(fitted, slopes[building_codes], np.nan)
+            features[trend_column] = np.where(
+                fitted, mean_values[building_codes] + np.nan_to_num(slopes[building_codes]) * year_offsets, np.nan)
+    return pd.DataFrame(features, index=joined_df.index)
+
+
+def replace_energy_use_with_trend(joined_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Replace the energy use of each row with the value of its building's trend in the row's baseline year,
+    see calculate_trend_features, so that the metrics are projected from the fitted line. Rows without a
+    fitted value, e.g. of buildings without LL84 data, keep their energy use.
+    """
+    return joined_df.assign(**{column: joined_df[get_trend_column_names(column)[1]].fillna(joined_df[column])
+                               for column in TrendColumns})
+
+
+def insert_baseline_years(long_df: pd.DataFrame, joined_df: pd.DataFrame, position: int, repeats: int,
+                          tiles: int = 1) -> pd.DataFrame:
+    """
+    Insert the baseline year of each row's building into a long dataset laid out building by building,
+    with repeats rows per building, tiles times over, e.g. once per scenario.
+    """
+    building_positions = np.tile(np.repeat(np.arange(len(joined_df)), repeats), tiles)
+    long_df.insert(position, BASELINE_YEAR_COLUMN, joined_df[BASELINE_YEAR_COLUMN].array.take(building_positions))
+    return long_df
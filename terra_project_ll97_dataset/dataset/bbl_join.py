@@ -0,0 +1,169 @@
+"""
+Join of the LL97 and LL84 datasets on BBL (Borough, Block and Lot).
+BBLs are encoded as 64 bit integers and the LL84 rows are looked up through a hash index,
+so neither dataset needs to be sorted. With several LL84 reporting years, each LL97 building is joined to
+one LL84 row of every year instead, through the LL84 rows sorted by BBL and year.
+"""
+
+import logging
+import os.path
+from typing import Dict, Tuple
+
+import numpy as np
+import pandas as pd
+
+from terra_project_ll97_dataset.dataset.baseline_years import BASELINE_YEAR_COLUMN
+from terra_project_ll97_dataset.dataset.column_projection import LL84_BBL_COLUMN, LL97_BBL_COLUMN
+from terra_project_ll97_dataset.dataset.data_cleansing import encode_bbl, normalise_bbl_column
+
+logger = logging.getLogger(__name__)
+
+JOIN_DIAGNOSTICS_FILE_NAME = "dataset_join_diagnostics.csv"
+
+
+class JoinDiagnostics:
+    """
+    Counts and BBLs of the LL97 buildings and LL84 rows that could not be joined one to one.
+    """
+
+    def __init__(self):
+        self.counts: Dict[str, int] = {}
+        # one (BBL, issue) row for every problematic BBL
+        self.issues = pd.DataFrame({"BBL": pd.Series(dtype='string'), "issue": pd.Series(dtype='string')})
+
+    def add(self, issue: str, bbls: pd.Series):
+        self.counts[issue] = len(bbls)
+        if len(bbls):
+            self.issues = pd.concat(
+                [self.issues, pd.DataFrame({"BBL": normalise_bbl_column(bbls).to_numpy(), "issue": issue})],
+                ignore_index=True)
+
+    def log(self):
+        logger.info("join diagnostics: %s", ", ".join(f"{issue}={count}" for issue, count in self.counts.items()))
+        if self.counts.get("ll84_duplicate_bbl", 0):
+            logger.warning("%d LL84 rows of LL97 buildings share a BBL with an earlier row and were dropped, see %s",
+                           self.counts["ll84_duplicate_bbl"], JOIN_DIAGNOSTICS_FILE_NAME)
+        if self.counts.get("ll84_missing_year", 0):
+            logger.warning("%d LL84 rows of LL97 buildings have no reporting year and were dropped, see %s",
+                           self.counts["ll84_missing_year"], JOIN_DIAGNOSTICS_FILE_NAME)
+
+    def to_csv(self, output_dir: str):
+        self.issues.to_csv(os.path.join(output_dir, JOIN_DIAGNOSTICS_FILE_NAME), index=False)
+
+
+def _get_covered_rows(ll84_keys: pd.Series, ll97_keys: pd.Series) -> pd.Series:
+    # the LL84 rows of LL97 buildings
+    return ll84_keys.notna() & ll84_keys.isin(ll97_keys.dropna())
+
+
+def join_ll97_ll84(ll97_df: pd.DataFrame, ll84_df: pd.DataFrame) -> Tuple[pd.DataFrame, JoinDiagnostics]:
+    """
+    Left join the LL84 benchmarking data onto the LL97 buildings.
+
+    LL84 rows that are exact duplicates are dropped, and when several different LL84 rows share a BBL
+    only the first one is kept so that the join never multiplies LL97 buildings. Only the dropped rows of
+    LL97 buildings are reported, the same rows the chunked ingest keeps.
+
+    Args:
+        ll97_df (pd.DataFrame): LL97 dataset with a "BBL" column
+        ll84_df (pd.DataFrame): LL84 dataset with a "NYC Borough, Block and Lot (BBL)" column
+
+    Returns:
+        Tuple[pd.DataFrame, JoinDiagnostics]: The joined dataset in LL97 order, indexed by the
+        normalised BBL, and the diagnostics of the join
+    """
+    diagnostics = JoinDiagnostics()
+    ll97_bbls = ll97_df[LL97_BBL_COLUMN].astype('string')
+    ll97_keys = encode_bbl(ll97_bbls)
+    diagnostics.add("ll97_invalid_bbl", ll97_bbls[ll97_keys.isna()])
+    diagnostics.add("ll97_duplicate_bbl", ll97_bbls[ll97_keys.notna() & ll97_keys.duplicated()])
+
+    ll84_df = ll84_df.drop_duplicates()
+    ll84_bbls = ll84_df[LL84_BBL_COLUMN].astype('string')
+    ll84_keys = encode_bbl(ll84_bbls)
+    diagnostics.add("ll84_invalid_bbl", ll84_bbls[ll84_keys.isna()])
+    ll84_duplicate_keys = ll84_keys.duplicated()
+    covered_rows = _get_covered_rows(ll84_keys, ll97_keys)
+    diagnostics.add("ll84_duplicate_bbl", ll84_bbls[covered_rows & ll84_duplicate_keys])
+
+    keep_ll84_rows = (ll84_keys.notna() & ~ll84_duplicate_keys).to_numpy()
+    ll84_index = pd.Index(ll84_keys[keep_ll84_rows])
+    ll84_positions = ll84_index.get_indexer(ll97_keys)
+    diagnostics.add("unmatched_bbl", ll97_bbls[(ll84_positions < 0) & ll97_keys.notna().to_numpy()])
+    diagnostics.counts["matched_bbl"] = int((ll84_positions >= 0).sum())
+
+    matched_ll84_df = ll84_df[keep_ll84_rows].reset_index(drop=True).reindex(ll84_positions)
+    joined_df = pd.concat(
+        [ll97_df.drop(columns=[LL97_BBL_COLUMN]).reset_index(drop=True), matched_ll84_df.reset_index(drop=True)],
+        axis=1)
+    joined_df.index = pd.Index(normalise_bbl_column(ll97_bbls).to_numpy(), name="BBL")
+    return joined_df.fillna(pd.NA), diagnostics
+
+
+def join_ll97_ll84_by_baseline_year(ll97_df: pd.DataFrame,
+                                    ll84_df: pd.DataFrame,
+                                    reporting_years: pd.Series) -> Tuple[pd.DataFrame, JoinDiagnostics]:
+    """
+    Left join the LL84 benchmarking data of several reporting years onto the LL97 buildings, with one row
+    for each building and each year it reported, its baseline year.
+
+    LL84 rows that are exact duplicates are dropped, and when several different LL84 rows share a BBL and
+    reporting year only the first one is kept. As in join_ll97_ll84, only the dropped rows of LL97 buildings
+    are reported, and LL97 buildings with no LL84 row in any year get a single row without a baseline year.
+
+    Args:
+        ll97_df (pd.DataFrame): LL97 dataset with a "BBL" column
+        ll84_df (pd.DataFrame): LL84 dataset with a "NYC Borough, Block and Lot (BBL)" column
+        reporting_years (pd.Series): Reporting year of each LL84 row, see get_reporting_years
+
+    Returns:
+        Tuple[pd.DataFrame, JoinDiagnostics]: The joined dataset in LL97 order then baseline year order,
+        indexed by the normalised BBL with the baseline year as first column, and the diagnostics of the join
+    """
+    diagnostics = JoinDiagnostics()
+    ll97_bbls = ll97_df[LL97_BBL_COLUMN].astype('string')
+    ll97_keys = encode_bbl(ll97_bbls)
+    diagnostics.add("ll97_invalid_bbl", ll97_bbls[ll97_keys.isna()])
+    diagnostics.add("ll97_duplicate_bbl", ll97_bbls[ll97_keys.notna() & ll97_keys.duplicated()])
+
+    unique_rows = ~ll84_df.duplicated()
+    ll84_df, reporting_years = ll84_df[unique_rows], reporting_years[unique_rows]
+    ll84_bbls = ll84_df[LL84_BBL_COLUMN].astype('string')
+    ll84_keys = encode_bbl(ll84_bbls)
+    diagnostics.add("ll84_invalid_bbl", ll84_bbls[ll84_keys.isna()])
+    covered_rows = _get_covered_rows(ll84_keys, ll97_keys)
+    diagnostics.add("ll84_missing_year", ll84_bbls[covered_rows & reporting_years.isna()])
+    valid_rows = ll84_keys.notna() & reporting_years.notna()
+    ll84_duplicate_keys = pd.DataFrame({"key": ll84_keys, "year": reporting_years}).duplicated()
+    diagnostics.add("ll84_duplicate_bbl", ll84_bbls[valid_rows & covered_rows & ll84_duplicate_keys])
+
+    keep_ll84_rows = (valid_rows & ~ll84_duplicate_keys).to_numpy()
+    kept_keys = ll84_keys[keep_ll84_rows].to_numpy(dtype=np.int64)
+    kept_years = reporting_years[keep_ll84_rows].to_numpy(dtype=np.int64)
+    # the kept rows sorted by BBL then year, so that the years of a BBL are a contiguous ascending run
+    order = np.lexsort((kept_years, kept_keys))
+    sorted_keys = kept_keys[order]
+
+    searched_keys = ll97_keys.to_numpy(dtype=np.int64, na_value=-1)
+    starts = np.searchsorted(sorted_keys, searched_keys, side="left")
+    matches = np.searchsorted(sorted_keys, searched_keys, side="right") - starts
+    diagnostics.add("unmatched_bbl", ll97_bbls[(matches == 0) & ll97_keys.notna().to_numpy()])
+    diagnostics.counts["matched_bbl"] = int((matches > 0).sum())
+
+    # every LL97 building is repeated once per year it matched, or once if it matched none
+    repeats = np.maximum(matches, 1)
+    ll97_positions = np.repeat(np.arange(len(ll97_df)), repeats)
+    run_offsets = np.arange(len(ll97_positions)) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+    ll84_positions = np.where(np.repeat(matches, repeats) > 0,
+                              order[np.minimum(np.repeat(starts, repeats) + run_offsets, len(order) - 1)]
+                              if len(order) else -1, -1)
+
+    matched_ll84_df = ll84_df[keep_ll84_rows].reset_index(drop=True).reindex(ll84_positions)
+    baseline_years = pd.Series(kept_years, dtype="Int64").reindex(ll84_positions)
+    joined_df = pd.concat(
+        [baseline_years.rename(BASELINE_YEAR_COLUMN).reset_index(drop=True),
+         ll97_df.drop(columns=[LL97_BBL_COLUMN]).iloc[ll97_positions].reset_index(drop=True),
+         matched_ll84_df.reset_index(drop=True)],
+        axis=1)
+    joined_df.index = pd.Index(normalise_bbl_column(ll97_bbls).to_numpy()[ll97_positions], name="BBL")
+    return joined_df.fillna(pd.NA), diagnostics
@@ -0,0 +1,87 @@
+"""
+Column projection for the LL97 and LL84 inputs.
+Only the columns read by the calculators, plus any passthrough columns the user asks for,
+are parsed, joined and written.
+"""
+
+import logging
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+from terra_project_ll97_dataset.calculator import carbon_emissions_thresholds, energy_unit_conversion
+from terra_project_ll97_dataset.dataset import data_cleansing
+from terra_project_ll97_dataset.dataset.baseline_years import LL84_YEAR_COLUMNS
+
+logger = logging.getLogger(__name__)
+
+LL97_BBL_COLUMN = "BBL"
+LL84_BBL_COLUMN = "NYC Borough, Block and Lot (BBL)"
+
+# passed to --keep_columns to keep every input column
+KEEP_ALL_COLUMNS = "all"
+
+
+def get_required_ll84_columns(mixed_use_thresholds: bool = False, by_baseline_year: bool = False) -> List[str]:
+    """
+    LL84 columns needed to join, clean and calculate, collected from the modules that read them.
+    The mixed use thresholds also read the type of the second and third largest uses, and the join by
+    baseline year the columns the reporting year is read from.
+    """
+    required_columns = [LL84_BBL_COLUMN]
+    for columns in [energy_unit_conversion.required_columns,
+                    carbon_emissions_thresholds.mixed_use_required_columns if mixed_use_thresholds
+                    else carbon_emissions_thresholds.required_columns,
+                    data_cleansing.numerical_columns,
+                    LL84_YEAR_COLUMNS if by_baseline_year else []]:
+        required_columns.extend(column for column in columns if column not in required_columns)
+    return required_columns
+
+
+def get_ll84_dtypes() -> Dict[str, str]:
+    """Compact dtypes for the LL84 columns that are not converted to numbers."""
+    return {
+        LL84_BBL_COLUMN: 'string',
+        "Largest Property Use Type": 'category',
+    }
+
+
+def read_csv_header(file_path: str) -> List[str]:
+    return list(pd.read_csv(file_path, nrows=0).columns)
+
+
+def select_columns(available_columns: List[str],
+                   required_columns: List[str],
+                   keep_columns: Optional[List[str]]) -> List[str]:
+    """
+    Columns of a dataset to parse: the required ones plus the requested passthrough columns, in file order.
+
+    Args:
+        available_columns (List[str]): Columns in the dataset
+        required_columns (List[str]): Columns the calculations need
+        keep_columns (Optional[List[str]]): Passthrough columns, or [KEEP_ALL_COLUMNS] for every column
+
+    Returns:
+        List[str]: The columns to parse
+    """
+    if keep_columns and KEEP_ALL_COLUMNS in keep_columns:
+        return list(available_columns)
+
+    selected_columns = set(required_columns) | set(keep_columns or [])
+    return [column for column in available_columns if column in selected_columns]
+
+
+def warn_about_missing_keep_columns(keep_columns: Optional[List[str]], *datasets_columns: List[str]):
+    for column in keep_columns or []:
+        if column != KEEP_ALL_COLUMNS and not any(column in columns for columns in datasets_columns):
+            logger.warning("--keep_columns: %s is not a column of the LL97 or LL84 dataset", column)
+
+
+def drop_year_columns(ll84_df: pd.DataFrame, keep_columns: Optional[List[str]]) -> pd.DataFrame:
+    """
+    Drop the LL84 columns that were only read for the reporting year, unless they are passthrough columns.
+    """
+    if keep_columns and KEEP_ALL_COLUMNS in keep_columns:
+        return ll84_df
+    return ll84_df.drop(columns=[column for column in LL84_YEAR_COLUMNS
+                                 if column in ll84_df.columns and column not in (keep_columns or [])])
@@ -0,0 +1,198 @@
+"""
+Long format columnar output of the yearly and year range metrics.
+
+Instead of one wide row per building, the metrics are written as tidy tables with one row per
+building and year (or year range), next to a building dimension table holding the joined LL97/LL84
+columns once per building. The tables are Parquet or Arrow IPC datasets, compressed and optionally
+partitioned by year or borough, so that readers can prune columns and partitions or memory-map them.
+
+pyarrow is an optional dependency, installed with the columnar extra.
+"""
+
+import os
+import shutil
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+from terra_project_ll97_dataset.calculator.yearly_metrics import YearlyMetrics
+from terra_project_ll97_dataset.dataset.baseline_years import BASELINE_YEAR_COLUMN
+from terra_project_ll97_dataset.dataset.data_cleansing import encode_bbl
+
+CSV_FORMAT = "csv"
+
+# formats that can be passed to --output_format
+OutputFormats: List[str] = [
+    CSV_FORMAT,
+    "parquet",
+    "arrow",
+]
+
+# columns the columnar datasets can be partitioned by with --partition_by
+PartitionColumns: List[str] = [
+    "year",
+    "borough",
+]
+
+# compressions that both Parquet and Arrow IPC support
+Compressions: List[str] = [
+    "zstd",
+    "lz4",
+    "none",
+]
+
+BUILDINGS_DATASET_NAME = "dataset_buildings"
+YEARLY_METRICS_DATASET_NAME = "dataset_yearly_metrics"
+YEAR_RANGE_METRICS_DATASET_NAME = "dataset_year_range_metrics"
+
+_file_extensions = {
+    "parquet": "parquet",
+    "arrow": "arrow",
+}
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.dataset
+    except ImportError as error:
+        raise ImportError("the parquet and arrow output formats require pyarrow, install it with "
+                          "pip install 'terra-project-ll97-dataset[columnar]'") from error
+    return pyarrow, pyarrow.dataset
+
+
+def get_columnar_formats(output_formats: List[str]) -> List[str]:
+    return [output_format for output_format in output_formats if output_format != CSV_FORMAT]
+
+
+def get_dataset_dir(output_dir: str, dataset_name: str, output_format: str) -> str:
+    return os.path.join(output_dir, f"{dataset_name}.{_file_extensions[output_format]}")
+
+
+def remove_columnar_datasets(output_dir: str):
+    """
+    Remove the columnar datasets of a previous run, which are written part by part, in every format,
+    so that datasets of other formats are not left next to the datasets of this run.
+    """
+    for output_format in get_columnar_formats(OutputFormats):
+        for dataset_name in [BUILDINGS_DATASET_NAME, YEARLY_METRICS_DATASET_NAME, YEAR_RANGE_METRICS_DATASET_NAME]:
+            shutil.rmtree(get_dataset_dir(output_dir, dataset_name, output_format), ignore_errors=True)
+
+
+def get_boroughs(index: pd.Index) -> pd.Series:
+    # the borough is the first digit of the BBL, <NA> for malformed BBLs
+    return (encode_bbl(pd.Series(index.to_numpy())) // 10 ** 9).astype('Int8')
+
+
+def write_columnar_file(file_path: str, output_format: str, df: pd.DataFrame, compression: str = "zstd") -> str:
+    """
+    Write df to a single Parquet or Arrow IPC file at file_path plus the extension of output_format.
+
+    Returns:
+        str: Location of the written file
+    """
+    pyarrow, _ = _import_pyarrow()
+    import pyarrow.ipc
+    import pyarrow.parquet
+
+    file_path = f"{file_path}.{_file_extensions[output_format]}"
+    table = pyarrow.Table.from_pandas(df, preserve_index=False)
+    compression = None if compression == "none" else compression
+    if output_format == "parquet":
+        pyarrow.parquet.write_table(table, file_path, compression=compression)
+    else:
+        options = pyarrow.ipc.IpcWriteOptions(compression=compression)
+        with pyarrow.ipc.new_file(file_path, table.schema, options=options) as writer:
+            writer.write_table(table)
+    return file_path
+
+
+def _get_bbl_array(pyarrow, index: pd.Index, repeats: int):
+    return pyarrow.array(np.repeat(index.to_numpy(), repeats), type=pyarrow.string(), from_pandas=True)
+
+
+def _get_metrics_table(pyarrow, joined_df: pd.DataFrame, boroughs: pd.Series, metrics: YearlyMetrics,
+                       period_column: str):
+    # (buildings x periods) arrays are flattened building by building, matching the repeated BBLs
+    index = joined_df.index
+    number_of_periods = len(metrics.years)
+    columns = {
+        "BBL": _get_bbl_array(pyarrow, index, number_of_periods),
+        "borough": pyarrow.array(np.repeat(boroughs.to_numpy(dtype=float), number_of_periods),
+                                 type=pyarrow.int8(), from_pandas=True),
+    }
+    if BASELINE_YEAR_COLUMN in joined_df.columns:
+        # a BBL has a row per baseline year when joined by baseline year
+        columns["baseline_year"] = pyarrow.array(
+            np.repeat(joined_df[BASELINE_YEAR_COLUMN].to_numpy(dtype=float, na_value=np.nan), number_of_periods),
+            type=pyarrow.int16(), from_pandas=True)
+    columns[period_column] = pyarrow.array(np.tile(np.asarray(metrics.years), len(index)))
+    for metric in metrics.metrics:
+        columns[metric] = pyarrow.array(metrics.values[metric].reshape(-1))
+    return pyarrow.table(columns)
+
+
+def _write_table(pyarrow_dataset, table, dataset_dir: str, output_format: str, compression: str,
+                 partition_column: Optional[str], part_index: int):
+    if output_format == "parquet":
+        file_format = pyarrow_dataset.ParquetFileFormat()
+    else:
+        file_format = pyarrow_dataset.IpcFileFormat()
+    pyarrow_dataset.write_dataset(
+        table,
+        dataset_dir,
+        format=file_format,
+        file_options=file_format.make_write_options(compression=None if compression == "none" else compression),
+        partitioning=[partition_column] if partition_column else None,
+        partitioning_flavor="hive",
+        basename_template=f"part-{part_index:05d}-{{i}}.{_file_extensions[output_format]}",
+        existing_data_behavior="overwrite_or_ignore",
+        # a single thread keeps the rows of every file in building order
+        use_threads=False)
+
+
+def write_columnar_datasets(output_dir: str,
+                            output_format: str,
+                            joined_df: pd.DataFrame,
+                            yearly_metrics: YearlyMetrics,
+                            year_range_metrics: YearlyMetrics,
+                            partition_by: Optional[str] = None,
+                            compression: str = "zstd",
+                            part_index: int = 0) -> int:
+    """
+    Write the building dimension table and the long yearly and year range metrics tables of the
+    buildings in joined_df as one part of each columnar dataset.
+
+    Args:
+        output_dir (str): Directory where the datasets are written
+        output_format (str): "parquet" or "arrow"
+        joined_df (pd.DataFrame): The joined dataset, indexed by BBL
+        yearly_metrics (YearlyMetrics): (buildings x years) metrics of the buildings in joined_df
+        year_range_metrics (YearlyMetrics): (buildings x year ranges) metrics of the buildings in joined_df
+        partition_by (Optional[str]): One of PartitionColumns, or None to write unpartitioned datasets.
+            The year range table is partitioned by year_range when partitioning by year, and the
+            building table is only partitioned by borough
+        compression (str): One of Compressions
+        part_index (int): Index of the part, parts written by different workers must have different indexes
+
+    Returns:
+        int: Number of rows written to the metrics tables
+    """
+    pyarrow, pyarrow_dataset = _import_pyarrow()
+    boroughs = get_boroughs(joined_df.index)
+
+    buildings_table = pyarrow.Table.from_pandas(
+        joined_df.reset_index().assign(borough=boroughs.to_numpy()), preserve_index=False)
+    yearly_table = _get_metrics_table(pyarrow, joined_df, boroughs, yearly_metrics, "year")
+    year_range_table = _get_metrics_table(pyarrow, joined_df, boroughs, year_range_metrics, "year_range")
+
+    for dataset_name, table, partition_column in [
+            (BUILDINGS_DATASET_NAME, buildings_table, "borough" if partition_by == "borough" else None),
+            (YEARLY_METRICS_DATASET_NAME, yearly_table, partition_by),
+            (YEAR_RANGE_METRICS_DATASET_NAME, year_range_table,
+             "year_range" if partition_by == "year" else partition_by)]:
+        _write_table(pyarrow_dataset, table, get_dataset_dir(output_dir, dataset_name, output_format),
+                     output_format, compression, partition_column, part_index)
+
+    return yearly_table.num_rows + year_range_table.num_rows
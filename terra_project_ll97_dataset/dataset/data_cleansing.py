@@ -1,24 +1,58 @@
+from typing import Dict, List, Tuple
+
 import pandas as pd
 
+# LL84 columns that are converted to numbers before any calculation
+numerical_columns: List[str] = [
+    "Electricity Use - Grid Purchase (kWh)",
+    "Natural Gas Use (kBtu)",
+    "District Steam Use (kBtu)",
+    "Fuel Oil #2 Use (kBtu)",
+    "Fuel Oil #4 Use (kBtu)",
+    "Largest Property Use Type - Gross Floor Area (ft²)",
+    "2nd Largest Property Use Type - Gross Floor Area (ft²)",
+    "3rd Largest Property Use Type - Gross Floor Area (ft²)",
+]
+
 
 def clean_format_numerical_columns(clean_joined_df: pd.DataFrame) -> pd.DataFrame:
-    # Convert to numeric columns and coerce
-    columns_to_convert = [
-        "Electricity Use - Grid Purchase (kWh)",
-        "Natural Gas Use (kBtu)",
-        "District Steam Use (kBtu)",
-        "Fuel Oil #2 Use (kBtu)",
-        "Fuel Oil #4 Use (kBtu)",
-        "Largest Property Use Type - Gross Floor Area (ft²)",
-        "2nd Largest Property Use Type - Gross Floor Area (ft²)",
-        "3rd Largest Property Use Type - Gross Floor Area (ft²)",
-    ]
+    return clean_and_count_numerical_columns(clean_joined_df)[0]
 
-    for column in columns_to_convert:
-        clean_joined_df[column] = pd.to_numeric(clean_joined_df[column], errors='coerce').fillna(0.0)
 
-    return clean_joined_df
+def clean_and_count_numerical_columns(clean_joined_df: pd.DataFrame) -> Tuple[pd.DataFrame, Dict[str, Dict[str, int]]]:
+    """
+    clean_format_numerical_columns that also counts, for each numerical column, the values that were
+    missing and the non-numeric values that were coerced to NaN, all of which are replaced by 0.
+    """
+    value_counts = {}
+    for column in numerical_columns:
+        # Convert to numeric columns and coerce
+        numbers = pd.to_numeric(clean_joined_df[column], errors='coerce')
+        missing_count = int(clean_joined_df[column].isna().sum())
+        value_counts[column] = {"missing": missing_count, "coerced": int(numbers.isna().sum()) - missing_count}
+        clean_joined_df[column] = numbers.fillna(0.0)
+
+    return clean_joined_df, value_counts
 
 
 def normalise_bbl(key: str) -> str:
     return key.replace("-", "").replace("/", "").strip()
+
+
+def normalise_bbl_column(keys: pd.Series) -> pd.Series:
+    # vectorized normalise_bbl
+    return keys.str.replace("-", "", regex=False).str.replace("/", "", regex=False).str.strip()
+
+
+def encode_bbl(keys: pd.Series) -> pd.Series:
+    """
+    Pack the borough, block and lot of each BBL into a 64 bit integer, borough * 10^9 + block * 10^4 + lot.
+    Accepts 10 digit BBLs as well as borough, block and lot separated by "-" or "/".
+    Malformed BBLs are encoded as <NA>.
+    """
+    parts = keys.astype('string').str.strip().str.extract(
+        r"^(?:(\d)[-/](\d{1,5})[-/](\d{1,4})|(\d)(\d{5})(\d{4}))$")
+    borough = parts[0].fillna(parts[3]).astype('Int64')
+    block = parts[1].fillna(parts[4]).astype('Int64')
+    lot = parts[2].fillna(parts[5]).astype('Int64')
+    return borough * 10 ** 9 + block * 10 ** 4 + lot
@@ -4,21 +4,57 @@ This module processes LL97 and LL84 datasets to calculate carbon emissions,
 energy costs, and penalties for buildings in New York City.
 """
 
+import argparse
+import copy
+import logging
 import os.path
-from typing import Callable, Any
+from typing import Callable, List, Optional, Tuple
 
+import numpy as np
 import pandas as pd
 
-from terra_project_ll97_dataset.arguments import BuildDatasetArguments
+from terra_project_ll97_dataset.api import END_YEAR, START_YEAR, concat_columns, join_datasets
 from terra_project_ll97_dataset.calculator.carbon_emissions import get_carbon_emissions, \
     get_carbon_emissions_by_year_and_energy_type
 from terra_project_ll97_dataset.calculator.carbon_emissions_thresholds import \
-    get_carbon_emissions_threshold_by_building_type_and_start_year, get_carbon_emissions_thresholds
+    get_carbon_emissions_threshold_by_building_type_and_start_year, get_carbon_emissions_thresholds, \
+    get_carbon_emissions_thresholds_matrix
+from terra_project_ll97_dataset.calculator.coefficient_tables import CoefficientTables
 from terra_project_ll97_dataset.calculator.cost_of_energy import get_cost_of_energy, \
     get_cost_of_energy_by_year_and_energy_type
+from terra_project_ll97_dataset.calculator.energy_unit_conversion import get_energy_consumption_matrix
 from terra_project_ll97_dataset.calculator.penalties import calculate_penalties
-from terra_project_ll97_dataset.dataset.data_cleansing import normalise_bbl, clean_format_numerical_columns
-from terra_project_ll97_dataset.util.common import get_year_ranges
+from terra_project_ll97_dataset.calculator.retrofits import calculate_minimum_cost_retrofits, load_retrofit_grid, \
+    retrofits_to_long_dataframe
+from terra_project_ll97_dataset.calculator.scenarios import calculate_scenario_metrics, load_scenario_grid, \
+    scenario_metrics_to_long_dataframe
+from terra_project_ll97_dataset.calculator.uncertainty import Uncertainty, bands_to_dataframe, \
+    calculate_sampled_metrics
+from terra_project_ll97_dataset.calculator.yearly_metrics import YearlyMetrics, calculate_yearly_metrics, \
+    calculate_year_range_metrics
+from terra_project_ll97_dataset.dataset.baseline_years import insert_baseline_years
+from terra_project_ll97_dataset.dataset.columnar_output import CSV_FORMAT, get_columnar_formats, \
+    remove_columnar_datasets, write_columnar_datasets
+from terra_project_ll97_dataset.dataset.column_projection import LL97_BBL_COLUMN, get_ll84_dtypes, \
+    get_required_ll84_columns, read_csv_header, select_columns, warn_about_missing_keep_columns
+from terra_project_ll97_dataset.dataset.data_cleansing import encode_bbl
+from terra_project_ll97_dataset.dataset.dataset_cache import DatasetCache, get_cache_key
+from terra_project_ll97_dataset.dataset.incremental_build import FINGERPRINTS_FILE_NAME, BuildingChanges, \
+    get_building_fingerprints, get_output_bbls, get_parameters_fingerprint, patch_dataset_csv, read_fingerprints, \
+    write_fingerprints
+from terra_project_ll97_dataset.dataset.ll84_ingest import read_ll84_dataset_in_chunks
+from terra_project_ll97_dataset.dataset.portfolio_cubes import calculate_portfolio_cubes, remove_portfolio_cubes, \
+    write_portfolio_cubes
+from terra_project_ll97_dataset.dataset.sharded_execution import build_sharded
+from terra_project_ll97_dataset.dataset.sql_backend import SQL_BACKEND, SqlDatasetBuilder, check_sql_backend_arguments
+from terra_project_ll97_dataset.util.common import RETROFIT_DATASET_FILE_NAME, SCENARIO_DATASET_FILE_NAME, \
+    YEAR_RANGE_BANDS_DATASET_FILE_NAME, YEAR_RANGE_DATASET_FILE_NAME, YEARLY_BANDS_DATASET_FILE_NAME, \
+    YEARLY_DATASET_FILE_NAME, Metrics, get_required_metrics, get_year_ranges, get_year_range_string, \
+    get_years_in_range
+from terra_project_ll97_dataset.util.memory import get_peak_rss_mb
+from terra_project_ll97_dataset.util.run_report import RunReport
+
+logger = logging.getLogger(__name__)
 
 
 def _avg_over_year_range(year_range: range, row: pd.Series, func: Callable[[int, pd.Series], float]) -> float:
@@ -42,6 +78,33 @@ def _avg_over_year_range(year_range: range, row: pd.Series, func: Callable[[int,
     return total_val / len(year_range)
 
 
+def _get_selected_years(years: Optional[List[List[int]]], start_year: int, end_year: int) -> List[int]:
+    """
+    The years selected with --years, in ascending order, or every year from start_year to end_year.
+
+    Raises:
+        ValueError: If a selected year is outside of start_year and end_year
+    """
+    if not years:
+        return list(range(start_year, end_year + 1))
+    selected_years = sorted(set(year for years_in_range in years for year in years_in_range))
+    if selected_years[0] < start_year or selected_years[-1] > end_year:
+        raise ValueError(f"--years must be between {start_year} and {end_year}")
+    return selected_years
+
+
+def _check_year_ranges(year_ranges: List[Tuple[int, int]], start_year: int, end_year: int):
+    """
+    Raises:
+        ValueError: If a year of a year range is outside of start_year and end_year
+    """
+    for year_range_tuple in year_ranges:
+        year_range = get_years_in_range(year_range_tuple)
+        if year_range[0] < start_year or year_range[-1] > end_year:
+            raise ValueError(f"--year_ranges must be between {start_year} and {end_year}, "
+                             f"not {get_year_range_string(year_range_tuple)}")
+
+
 class DatasetBuilder:
     """
     Main class for building the LL97 compliance dataset.
@@ -57,8 +120,21 @@ class DatasetBuilder:
             arguments (argparse.Namespace): Parsed command line arguments
         """
         self.arguments = arguments
-        self.start_year = 2024
-        self.end_year = 2050
+        self.start_year = START_YEAR
+        self.end_year = END_YEAR
+        self.year_ranges = arguments.year_ranges or get_year_ranges()
+        self.metrics = [metric for metric in Metrics if arguments.metrics is None or metric in arguments.metrics]
+        _check_year_ranges(self.year_ranges, self.start_year, self.end_year)
+        self.years = _get_selected_years(arguments.years, self.start_year, self.end_year)
+        # the yearly metrics are calculated for the selected years and the years of every year range
+        self._calculated_years = sorted(set(self.years).union(
+            *[get_years_in_range(year_range_tuple) for year_range_tuple in self.year_ranges]).intersection(
+            range(self.start_year, self.end_year + 1)))
+        self._yearly_metrics = None
+        self._year_range_metrics = None
+        self._scenario_inputs = None
+        self.join_diagnostics = None
+        self.run_report = RunReport(arguments.profile)
 
         # Initialize lookup tables for calculations
         self._carbon_emissions_lookup_table = get_carbon_emissions_by_year_and_energy_type(
@@ -68,6 +144,52 @@ class DatasetBuilder:
         self._carbon_emissions_threshold_lookup_table = (
             get_carbon_emissions_threshold_by_building_type_and_start_year(
                 arguments.carbon_emissions_by_building_type))
+        self._coefficient_tables = CoefficientTables.from_lookup_tables(
+            list(range(self.start_year, self.end_year + 1)),
+            self._carbon_emissions_lookup_table,
+            self._cost_of_energy_lookup_table,
+            self._carbon_emissions_threshold_lookup_table)
+        if arguments.row_wise and get_columnar_formats(arguments.output_format):
+            raise ValueError("--row_wise only writes the csv datasets")
+        if arguments.row_wise and arguments.portfolio_cubes:
+            raise ValueError("--portfolio_cubes are aggregated from the vectorized metrics, not with --row_wise")
+        if arguments.trend_features and not arguments.by_baseline_year:
+            raise ValueError("--trend_features are calculated over the baseline years, they require "
+                             "--by_baseline_year")
+        if arguments.project_from_trend and not arguments.trend_features:
+            raise ValueError("--project_from_trend projects from the fitted values of the --trend_features, it "
+                             "requires --trend_features")
+        if arguments.by_baseline_year and arguments.portfolio_cubes:
+            raise ValueError("--portfolio_cubes sum each building once, not once per baseline year, "
+                             "they cannot be combined with --by_baseline_year")
+        if arguments.backend == SQL_BACKEND:
+            check_sql_backend_arguments(arguments)
+        self._scenario_grid = None
+        if arguments.scenarios:
+            self._scenario_grid = load_scenario_grid(arguments.scenarios, self._coefficient_tables)
+        self._retrofit_grid = None
+        if arguments.retrofit_actions:
+            self._retrofit_grid = load_retrofit_grid(arguments.retrofit_actions)
+        self._uncertainty = Uncertainty(arguments.emission_factor_uncertainty, arguments.energy_price_uncertainty,
+                                        arguments.energy_use_uncertainty)
+
+    def _for_buildings(self, buildings) -> "DatasetBuilder":
+        """
+        A builder that shares this builder's arguments and lookup tables and calculates
+        only a subset of the joined buildings.
+
+        Args:
+            buildings: Slice or boolean mask selecting rows of the joined dataset
+
+        Returns:
+            DatasetBuilder: The builder for the subset
+        """
+        subset_builder = copy.copy(self)
+        subset_builder._joined_dataset = self._joined_dataset.iloc[buildings]
+        subset_builder._yearly_metrics = None
+        subset_builder._year_range_metrics = None
+        subset_builder._scenario_inputs = None
+        return subset_builder
 
     def _get_carbon_emissions(self, year: int, row: pd.Series) -> float:
         """
@@ -106,98 +228,525 @@ class DatasetBuilder:
         Returns:
             float: Carbon emissions threshold value
         """
-        return get_carbon_emissions_thresholds(self._carbon_emissions_threshold_lookup_table, year, row)
+        return get_carbon_emissions_thresholds(self._carbon_emissions_threshold_lookup_table, year, row,
+                                               self.arguments.mixed_use_thresholds)
+
+    def _calculate_and_write_dataset(self, stage_name: str, calculate: Callable[[], pd.DataFrame], file_name: str,
+                                     output_dir: Optional[str] = None, header: bool = True):
+        """
+        Calculate a dataset and save it to CSV, as two stages of the run report.
+
+        Args:
+            stage_name (str): Name of the calculation stage, the write stage is named write_<stage_name>
+            calculate (Callable): Function that calculates the dataset
+            file_name (str): Name of the output file
+            output_dir (Optional[str]): Directory to save the file to, by default --output_dir
+            header (bool): Whether to write the header row
+        """
+        with self.run_report.stage(stage_name, rows_in=len(self._joined_dataset)) as stage:
+            df = calculate()
+            stage.rows_out = len(df)
+        with self.run_report.stage(f"write_{stage_name}", rows_in=len(df)) as stage:
+            df.to_csv(os.path.join(output_dir or self.arguments.output_dir, file_name), header=header)
+            stage.rows_out = len(df)
+
+    def _writes_csv(self) -> bool:
+        return CSV_FORMAT in self.arguments.output_format
 
     def _build_yearly_dataset(self):
         """
-        Build dataset with yearly calculations for each building.
-        Calculates and stores carbon emissions, energy costs, thresholds, and penalties
-        for each year from start_year to end_year.
+        Build dataset with yearly calculations for each building and save it to CSV.
+        """
+        if self._writes_csv():
+            self._calculate_and_write_dataset("yearly", self._calculate_yearly_dataset, YEARLY_DATASET_FILE_NAME)
+        else:
+            with self.run_report.stage("yearly", rows_in=len(self._joined_dataset)):
+                self._calculate_yearly_metrics()
+
+    def _calculate_yearly_metrics(self):
+        self._yearly_metrics = calculate_yearly_metrics(
+            self._joined_dataset,
+            self._calculated_years,
+            self._coefficient_tables,
+            self.metrics,
+            self.arguments.mixed_use_thresholds)
+
+    def _calculate_yearly_dataset(self) -> pd.DataFrame:
+        """
+        Calculate the --metrics (by default carbon emissions, energy costs, thresholds, and penalties)
+        for each of the --years (by default every year from start_year to end_year).
+
+        Returns:
+            pd.DataFrame: The joined dataset with the yearly metric columns appended
+        """
+        if self.arguments.row_wise:
+            return self._calculate_yearly_dataset_row_wise()
+
+        self._calculate_yearly_metrics()
+        return concat_columns([self._joined_dataset,
+                               self._yearly_metrics.select(self.years).to_dataframe(self._joined_dataset.index)])
+
+    def _calculate_yearly_dataset_row_wise(self) -> pd.DataFrame:
+        """
+        Reference implementation of the yearly calculations that evaluates every building,
+        year and metric with DataFrame.apply. Selected with --row_wise.
+
+        Returns:
+            pd.DataFrame: The joined dataset with the yearly metric columns appended
         """
-        df_with_yearly_values = self._joined_dataset.copy()
+        # the metrics are collected in their own frame and appended to the joined dataset without copying it
+        yearly_values = pd.DataFrame(index=self._joined_dataset.index)
+        required_metrics = get_required_metrics(self.metrics)
 
-        for year in range(self.start_year, self.end_year + 1):
+        for year in self.years:
             # Calculate and store yearly metrics
             carbon_emissions_column_name = f"{year}_carbon_emissions"
-            df_with_yearly_values[carbon_emissions_column_name] = df_with_yearly_values.apply(
-                lambda x: self._get_carbon_emissions(year, x), axis=1)
+            if "carbon_emissions" in required_metrics:
+                yearly_values[carbon_emissions_column_name] = self._joined_dataset.apply(
+                    lambda x: self._get_carbon_emissions(year, x), axis=1)
 
-            cost_of_energy_column_name = f"{year}_cost_of_energy"
-            df_with_yearly_values[cost_of_energy_column_name] = df_with_yearly_values.apply(
-                lambda x: self._get_cost_of_energy(year, x), axis=1)
+            if "cost_of_energy" in required_metrics:
+                cost_of_energy_column_name = f"{year}_cost_of_energy"
+                yearly_values[cost_of_energy_column_name] = self._joined_dataset.apply(
+                    lambda x: self._get_cost_of_energy(year, x), axis=1)
 
             carbon_emissions_threshold_column_name = f"{year}_carbon_emissions_threshold"
-            df_with_yearly_values[carbon_emissions_threshold_column_name] = df_with_yearly_values.apply(
-                lambda x: self._get_carbon_emissions_thresholds(year, x), axis=1)
+            if "carbon_emissions_threshold" in required_metrics:
+                yearly_values[carbon_emissions_threshold_column_name] = self._joined_dataset.apply(
+                    lambda x: self._get_carbon_emissions_thresholds(year, x), axis=1)
 
-            estimated_penalty_column_name = f"{year}_estimated_penalty"
-            df_with_yearly_values[estimated_penalty_column_name] = df_with_yearly_values.apply(
-                lambda x: calculate_penalties(x, carbon_emissions_column_name, carbon_emissions_threshold_column_name),
-                axis=1)
+            if "estimated_penalty" in required_metrics:
+                estimated_penalty_column_name = f"{year}_estimated_penalty"
+                yearly_values[estimated_penalty_column_name] = yearly_values.apply(
+                    lambda x: calculate_penalties(x, carbon_emissions_column_name,
+                                                  carbon_emissions_threshold_column_name),
+                    axis=1)
 
-        # Save yearly dataset to CSV
-        df_with_yearly_values.to_csv(
-            os.path.join(self.arguments.output_dir, "dataset_estimated_emissions_cost_penalties_for_each_year.csv"))
+        # drop the metrics that were only calculated to derive the requested ones
+        yearly_values = yearly_values[[f"{year}_{metric}" for year in self.years for metric in self.metrics]]
+        return concat_columns([self._joined_dataset, yearly_values])
 
     def _build_dataset_for_range_of_years(self):
         """
-        Build dataset with calculations averaged over specified year ranges.
-        Calculates and stores average carbon emissions, energy costs, thresholds, and penalties
-        for predefined year ranges.
+        Build dataset with calculations averaged over year ranges and save it to CSV.
         """
-        df_for_range_of_years = self._joined_dataset.copy()
+        if self._writes_csv():
+            self._calculate_and_write_dataset(
+                "ranges", self._calculate_dataset_for_range_of_years, YEAR_RANGE_DATASET_FILE_NAME)
+        else:
+            with self.run_report.stage("ranges", rows_in=len(self._joined_dataset)):
+                self._calculate_year_range_metrics()
 
-        for year_range_tuple in get_year_ranges():
-            year_range_string = f"{year_range_tuple[0]}{'-' + str(year_range_tuple[1]) if year_range_tuple[1] > 0 else '+'}"
-            year_range = range(year_range_tuple[0],
-                             year_range_tuple[1] + 1 if year_range_tuple[1] > 0 else year_range_tuple[0] + 1)
+    def _calculate_year_range_metrics(self):
+        self._year_range_metrics = calculate_year_range_metrics(self._yearly_metrics, self.year_ranges)
+
+    def _calculate_dataset_for_range_of_years(self) -> pd.DataFrame:
+        """
+        Calculate average carbon emissions, energy costs, thresholds, and penalties
+        for the year ranges, reusing the metrics computed by _calculate_yearly_dataset.
+
+        Returns:
+            pd.DataFrame: The joined dataset with the year range metric columns appended
+        """
+        if self.arguments.row_wise:
+            return self._calculate_dataset_for_range_of_years_row_wise()
+
+        self._calculate_year_range_metrics()
+        return concat_columns(
+            [self._joined_dataset, self._year_range_metrics.to_dataframe(self._joined_dataset.index)])
+
+    def _calculate_dataset_for_range_of_years_row_wise(self) -> pd.DataFrame:
+        """
+        Reference implementation of the year range calculations that recomputes every year
+        of every range for each building with DataFrame.apply. Selected with --row_wise.
+
+        Returns:
+            pd.DataFrame: The joined dataset with the year range metric columns appended
+        """
+        year_range_values = pd.DataFrame(index=self._joined_dataset.index)
+        required_metrics = get_required_metrics(self.metrics)
+
+        for year_range_tuple in self.year_ranges:
+            year_range_string = get_year_range_string(year_range_tuple)
+            year_range = get_years_in_range(year_range_tuple)
 
             # Calculate and store range-based metrics
             carbon_emissions_column_name = f"{year_range_string}_carbon_emissions_per_year"
-            df_for_range_of_years[carbon_emissions_column_name] = df_for_range_of_years.apply(
-                lambda x: _avg_over_year_range(year_range, x, self._get_carbon_emissions), axis=1)
+            if "carbon_emissions" in required_metrics:
+                year_range_values[carbon_emissions_column_name] = self._joined_dataset.apply(
+                    lambda x: _avg_over_year_range(year_range, x, self._get_carbon_emissions), axis=1)
 
-            cost_of_energy_column_name = f"{year_range_string}_cost_of_energy_per_year"
-            df_for_range_of_years[cost_of_energy_column_name] = df_for_range_of_years.apply(
-                lambda x: _avg_over_year_range(year_range, x, self._get_cost_of_energy), axis=1)
+            if "cost_of_energy" in required_metrics:
+                cost_of_energy_column_name = f"{year_range_string}_cost_of_energy_per_year"
+                year_range_values[cost_of_energy_column_name] = self._joined_dataset.apply(
+                    lambda x: _avg_over_year_range(year_range, x, self._get_cost_of_energy), axis=1)
 
             carbon_emissions_threshold_column_name = f"{year_range_string}_carbon_emissions_threshold_per_year"
-            df_for_range_of_years[carbon_emissions_threshold_column_name] = df_for_range_of_years.apply(
-                lambda x: _avg_over_year_range(year_range, x, self._get_carbon_emissions_thresholds), axis=1)
+            if "carbon_emissions_threshold" in required_metrics:
+                year_range_values[carbon_emissions_threshold_column_name] = self._joined_dataset.apply(
+                    lambda x: _avg_over_year_range(year_range, x, self._get_carbon_emissions_thresholds), axis=1)
+
+            if "estimated_penalty" in required_metrics:
+                estimated_penalty_column_name = f"{year_range_string}_estimated_penalty_per_year"
+                year_range_values[estimated_penalty_column_name] = year_range_values.apply(
+                    lambda x: calculate_penalties(x, carbon_emissions_column_name,
+                                                  carbon_emissions_threshold_column_name),
+                    axis=1)
+
+        # drop the metrics that were only calculated to derive the requested ones
+        year_range_values = year_range_values[[
+            f"{get_year_range_string(year_range_tuple)}_{metric}_per_year"
+            for year_range_tuple in self.year_ranges for metric in self.metrics]]
+        return concat_columns([self._joined_dataset, year_range_values])
+
+    def _build_columnar_datasets(self, part_index: int = 0):
+        """
+        Write the building table and the long yearly and year range metrics tables in each columnar
+        --output_format, from the metrics calculated by _build_yearly_dataset and _build_dataset_for_range_of_years.
 
-            estimated_penalty_column_name = f"{year_range_string}_estimated_penalty_per_year"
-            df_for_range_of_years[estimated_penalty_column_name] = df_for_range_of_years.apply(
-                lambda x: calculate_penalties(x, carbon_emissions_column_name, carbon_emissions_threshold_column_name),
-                axis=1)
+        Args:
+            part_index (int): Index of the part of the datasets written by this builder
+        """
+        with self.run_report.stage("write_columnar", rows_in=len(self._joined_dataset)) as stage:
+            stage.rows_out = 0
+            for output_format in get_columnar_formats(self.arguments.output_format):
+                stage.rows_out += write_columnar_datasets(
+                    self.arguments.output_dir, output_format, self._joined_dataset,
+                    self._yearly_metrics.select(self.years), self._year_range_metrics, self.arguments.partition_by,
+                    self.arguments.columnar_compression, part_index)
 
-        # Save range-based dataset to CSV
-        df_for_range_of_years.to_csv(
-            os.path.join(self.arguments.output_dir, "dataset_estimated_emissions_cost_penalties_for_year_range.csv"))
+    def _get_year_range_strings(self) -> List[str]:
+        return [get_year_range_string(year_range_tuple) for year_range_tuple in self.year_ranges]
+
+    def _build_portfolio_cubes(self, yearly_metrics: Optional[YearlyMetrics] = None,
+                               year_range_metrics: Optional[YearlyMetrics] = None):
+        """
+        Aggregate the yearly and year range metrics over boroughs and property types and write the
+        cubes in each --output_format.
+
+        Args:
+            yearly_metrics (Optional[YearlyMetrics]): Yearly metrics of every building, defaults to the
+                metrics calculated by _build_yearly_dataset
+            year_range_metrics (Optional[YearlyMetrics]): Year range metrics of every building, defaults
+                to the metrics calculated by _build_dataset_for_range_of_years
+        """
+        with self.run_report.stage("portfolio_cubes", rows_in=len(self._joined_dataset)) as stage:
+            cubes_df = calculate_portfolio_cubes(
+                self._joined_dataset,
+                yearly_metrics or self._yearly_metrics.select(self.years),
+                year_range_metrics or self._year_range_metrics)
+            write_portfolio_cubes(self.arguments.output_dir, self.arguments.output_format, cubes_df,
+                                  self.arguments.columnar_compression)
+            stage.rows_out = len(cubes_df)
+
+    def _build_scenario_dataset(self):
+        """
+        Build a long dataset with the yearly calculations for each scenario in the --scenarios file.
+        Scenarios are evaluated in batches, each batch in a single broadcast over buildings and years,
+        and appended to the output as they are calculated.
+        """
+        output_file_path = os.path.join(self.arguments.output_dir, SCENARIO_DATASET_FILE_NAME)
+        with self.run_report.stage("scenarios", rows_in=len(self._joined_dataset)) as stage:
+            stage.rows_out = 0
+            for batch_index, (scenarios, scenario_names) in enumerate(
+                    self._scenario_grid.batches(self.arguments.scenario_batch_size)):
+                scenario_df = self._calculate_scenario_dataset(scenarios, scenario_names)
+                scenario_df.to_csv(
+                    output_file_path, index=False, mode="w" if batch_index == 0 else "a", header=batch_index == 0)
+                stage.rows_out += len(scenario_df)
+                logger.info("calculated scenarios %d-%d of %d",
+                            scenarios.start + 1, scenarios.start + len(scenario_names), len(self._scenario_grid))
+
+    def _calculate_scenario_dataset(self, scenarios: slice, scenario_names: List[str]) -> pd.DataFrame:
+        """
+        Calculate a batch of scenarios for every building and year.
+
+        Args:
+            scenarios (slice): The batch of scenarios in the scenario grid
+            scenario_names (List[str]): Names of the scenarios in the batch
+
+        Returns:
+            pd.DataFrame: One row per scenario, building and year
+        """
+        required_metrics = get_required_metrics(self.metrics)
+        if self._scenario_inputs is None:
+            energy_consumption, carbon_emissions_threshold = None, None
+            if "carbon_emissions" in required_metrics or "cost_of_energy" in required_metrics:
+                energy_consumption = get_energy_consumption_matrix(self._joined_dataset)
+            if "carbon_emissions_threshold" in required_metrics and self._yearly_metrics is not None:
+                carbon_emissions_threshold = self._yearly_metrics.select(
+                    self.years, ["carbon_emissions_threshold"]).values["carbon_emissions_threshold"]
+            elif "carbon_emissions_threshold" in required_metrics:
+                carbon_emissions_threshold = get_carbon_emissions_thresholds_matrix(
+                    self._coefficient_tables, self.years, self._joined_dataset, self.arguments.mixed_use_thresholds)
+            self._scenario_inputs = (energy_consumption, carbon_emissions_threshold)
+
+        energy_consumption, carbon_emissions_threshold = self._scenario_inputs
+        scenario_metrics = calculate_scenario_metrics(
+            self._scenario_grid, scenarios, energy_consumption, carbon_emissions_threshold, self.years, self.metrics)
+        scenario_df = scenario_metrics_to_long_dataframe(
+            scenario_names, self._joined_dataset.index, self.years, scenario_metrics, self.metrics)
+        if self.arguments.by_baseline_year:
+            insert_baseline_years(scenario_df, self._joined_dataset, 2, len(self.years), len(scenario_names))
+        return scenario_df
+
+    def _build_retrofit_dataset(self):
+        """
+        Build a long dataset with the minimum cost action of the --retrofit_actions file for each building
+        and year range, and save it to CSV.
+        """
+        self._calculate_and_write_dataset("retrofits", self._calculate_retrofit_dataset, RETROFIT_DATASET_FILE_NAME)
+
+    def _calculate_retrofit_dataset(self) -> pd.DataFrame:
+        """
+        Evaluate every retrofit action for every building and year, and keep the cheapest complying action.
+
+        Returns:
+            pd.DataFrame: One row per building and year range
+        """
+        solutions = calculate_minimum_cost_retrofits(
+            self._retrofit_grid, self._joined_dataset, self._coefficient_tables, self.year_ranges,
+            self.arguments.mixed_use_thresholds)
+        retrofit_df = retrofits_to_long_dataframe(self._retrofit_grid, self._joined_dataset.index, self.year_ranges,
+                                                  solutions)
+        if self.arguments.by_baseline_year:
+            insert_baseline_years(retrofit_df, self._joined_dataset, 0, len(self.year_ranges))
+        return retrofit_df
+
+    def _build_sampled_datasets(self):
+        """
+        Build the yearly and year range datasets with the percentiles of every metric over --samples Monte Carlo
+        samples, and save them to CSV.
+        """
+        with self.run_report.stage("samples", rows_in=len(self._joined_dataset)) as stage:
+            yearly_bands_df, year_range_bands_df = self._calculate_sampled_datasets()
+            stage.rows_out = len(yearly_bands_df)
+        with self.run_report.stage("write_samples", rows_in=len(yearly_bands_df)) as stage:
+            yearly_bands_df.to_csv(os.path.join(self.arguments.output_dir, YEARLY_BANDS_DATASET_FILE_NAME))
+            year_range_bands_df.to_csv(os.path.join(self.arguments.output_dir, YEAR_RANGE_BANDS_DATASET_FILE_NAME))
+            stage.rows_out = len(yearly_bands_df)
+
+    def _calculate_sampled_datasets(self, buildings: slice = slice(None)) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """
+        Estimate the percentiles of the yearly and year range metrics of some of the joined buildings.
+        The random numbers are drawn for blocks of the whole joined dataset, so the estimates of a building
+        are the same whichever buildings are calculated with it.
+
+        Args:
+            buildings (slice): Rows of the joined dataset to calculate
+
+        Returns:
+            Tuple[pd.DataFrame, pd.DataFrame]: The joined dataset rows with the yearly and the year range
+            percentile columns appended
+        """
+        yearly_bands, year_range_bands = calculate_sampled_metrics(
+            self._joined_dataset, self._coefficient_tables, self.years, self.year_ranges, self.arguments.samples,
+            self._uncertainty, self.arguments.sample_percentiles, self.arguments.seed, self.metrics,
+            self.arguments.mixed_use_thresholds, buildings, self.arguments.sample_batch_size)
+        joined_df = self._joined_dataset.iloc[buildings]
+        return (concat_columns([joined_df, bands_to_dataframe(yearly_bands, joined_df.index)]),
+                concat_columns([joined_df, bands_to_dataframe(year_range_bands, joined_df.index)]))
 
     def _join_ll97_ll84_datasets(self):
         """
         Join LL97 and LL84 datasets using BBL (Borough, Block, Lot) as the key.
-        Performs data cleaning and normalization during the join process.
+        Performs data cleaning and normalization during the join process, and writes
+        the BBLs that could not be joined one to one to the output directory.
+        The joined dataset is reused from the cache when the inputs have not changed.
         """
-        # Read and process LL97 dataset
-        ll97_df = pd.read_csv(self.arguments.ll97_dataset, dtype={"BBL": 'string'})
-        ll97_df["BBL"] = ll97_df["BBL"].apply(normalise_bbl)
-        ll97_df_indexed = ll97_df.set_index("BBL").sort_index().fillna(pd.NA)
+        cache, cache_key = None, None
+        if not self.arguments.no_cache:
+            cache = DatasetCache(self.arguments.cache_dir, self.arguments.cache_max_size_mb)
+            cache_key = get_cache_key([self.arguments.ll97_dataset] + self.arguments.ll84_dataset,
+                                      self.arguments.keep_columns, self.arguments.mixed_use_thresholds,
+                                      self.arguments.by_baseline_year, self.arguments.trend_features,
+                                      self.arguments.project_from_trend)
+            with self.run_report.stage("load_cache") as stage:
+                cached_datasets = cache.get(cache_key)
+                if cached_datasets is not None:
+                    logger.info("using the cached joined dataset %s", cache_key)
+                    self._joined_dataset, self.join_diagnostics, self.run_report.coerced_values = cached_datasets
+                    self.join_diagnostics.to_csv(self.arguments.output_dir)
+                    stage.rows_out = len(self._joined_dataset)
+                    return
 
-        # Read and process LL84 dataset
-        ll84_df = pd.read_csv(self.arguments.ll84_dataset, dtype={"NYC Borough, Block and Lot (BBL)": 'string'})
-        ll84_df["BBL"] = ll84_df["NYC Borough, Block and Lot (BBL)"].apply(normalise_bbl)
-        ll84_df_indexed = ll84_df.drop_duplicates().set_index("BBL").sort_index().fillna(pd.NA)
+        self._read_and_join_ll97_ll84_datasets()
+        self.join_diagnostics.to_csv(self.arguments.output_dir)
+        if cache is not None:
+            with self.run_report.stage("store_cache", rows_in=len(self._joined_dataset)):
+                cache.put(cache_key, (self._joined_dataset, self.join_diagnostics, self.run_report.coerced_values))
 
-        # Join datasets and clean numerical columns
-        self._joined_dataset = ll97_df_indexed.join(ll84_df_indexed, how='left').fillna(pd.NA)
-        self._joined_dataset = clean_format_numerical_columns(self._joined_dataset)
+    def _read_and_join_ll97_ll84_datasets(self):
+        """
+        Read only the needed columns of the LL97 and LL84 datasets, join them and clean the numerical columns.
+        """
+        with self.run_report.stage("ingest") as stage:
+            ll97_df, ll84_df = self._read_ll97_ll84_datasets()
+            stage.rows_out = len(ll97_df) + len(ll84_df)
+        with self.run_report.stage("join", rows_in=len(ll97_df) + len(ll84_df)) as stage:
+            self._join_and_clean_ll97_ll84_datasets(ll97_df, ll84_df)
+            stage.rows_out = len(self._joined_dataset)
+
+    def _read_ll97_ll84_datasets(self) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """
+        Read the columns the calculations need, plus the requested passthrough columns, of the LL97 and LL84 datasets.
+        Several LL84 datasets, e.g. one per reporting year, are read one after the other and concatenated.
+
+        Returns:
+            Tuple[pd.DataFrame, pd.DataFrame]: The LL97 and LL84 datasets
+        """
+        # Only parse the columns the calculations need and the requested passthrough columns
+        ll97_available_columns = read_csv_header(self.arguments.ll97_dataset)
+        ll84_available_columns = [read_csv_header(file_path) for file_path in self.arguments.ll84_dataset]
+        warn_about_missing_keep_columns(self.arguments.keep_columns, ll97_available_columns, *ll84_available_columns)
+        ll97_columns = select_columns(ll97_available_columns, [LL97_BBL_COLUMN], self.arguments.keep_columns)
+        required_ll84_columns = get_required_ll84_columns(self.arguments.mixed_use_thresholds,
+                                                          self.arguments.by_baseline_year)
+
+        # Read LL97 dataset
+        ll97_df = pd.read_csv(self.arguments.ll97_dataset, usecols=ll97_columns, dtype={LL97_BBL_COLUMN: 'string'})
+
+        # Read LL84 datasets
+        ll84_frames = []
+        for file_path, available_columns in zip(self.arguments.ll84_dataset, ll84_available_columns):
+            ll84_columns = select_columns(available_columns, required_ll84_columns, self.arguments.keep_columns)
+            if self.arguments.ll84_chunksize:
+                ll84_frames.append(read_ll84_dataset_in_chunks(
+                    file_path,
+                    encode_bbl(ll97_df[LL97_BBL_COLUMN]).dropna().unique(),
+                    self.arguments.ll84_chunksize,
+                    ll84_columns))
+            else:
+                ll84_frames.append(pd.read_csv(file_path, usecols=ll84_columns, dtype=get_ll84_dtypes()))
+        ll84_df = pd.concat(ll84_frames, ignore_index=True) if len(ll84_frames) > 1 else ll84_frames[0]
+
+        return ll97_df, ll84_df
+
+    def _join_and_clean_ll97_ll84_datasets(self, ll97_df: pd.DataFrame, ll84_df: pd.DataFrame):
+        """
+        Join the LL97 and LL84 datasets on BBL and clean the numerical columns,
+        counting the values that could not be converted to numbers.
+
+        Args:
+            ll97_df (pd.DataFrame): The LL97 dataset
+            ll84_df (pd.DataFrame): The LL84 dataset
+        """
+        self._joined_dataset, self.join_diagnostics, self.run_report.coerced_values = join_datasets(
+            ll97_df, ll84_df, self.arguments.keep_columns, self.arguments.mixed_use_thresholds,
+            self.arguments.by_baseline_year, self.arguments.trend_features, self.arguments.project_from_trend)
+        self.join_diagnostics.log()
+        logger.info("joined %d LL97 buildings with LL84 data, peak RSS %.1f MB",
+                    len(self._joined_dataset), get_peak_rss_mb())
+
+    def _build_incrementally(self, parameters_fingerprint: str, building_fingerprints) -> bool:
+        """
+        Recalculate only the buildings whose joined LL97/LL84 rows changed since the run that wrote
+        --previous_output_dir, and patch them into that run's yearly and year range datasets.
+        Writes a report of the changed buildings either way.
+
+        Returns:
+            bool: False if the previous run cannot be patched and a full build is needed
+        """
+        previous_output_dir = self.arguments.previous_output_dir
+        previous_fingerprints = read_fingerprints(previous_output_dir)
+        if previous_fingerprints is None:
+            logger.warning("no %s in %s, building every building", FINGERPRINTS_FILE_NAME, previous_output_dir)
+            return False
+        for file_name in [YEARLY_DATASET_FILE_NAME, YEAR_RANGE_DATASET_FILE_NAME]:
+            if not os.path.exists(os.path.join(previous_output_dir, file_name)):
+                logger.warning("no %s in %s, building every building", file_name, previous_output_dir)
+                return False
+
+        changes = BuildingChanges(previous_fingerprints["buildings"], building_fingerprints)
+        patched = previous_fingerprints["parameters"] == parameters_fingerprint
+        if not patched:
+            logger.warning("the calculation parameters changed since the previous run, building every building")
+
+        recalculated_bbls = changes.get_recalculated_bbls()
+        bbls_in_order = get_output_bbls(self._joined_dataset)
+        recalculated_builder = self._for_buildings(np.array([bbl in recalculated_bbls for bbl in bbls_in_order],
+                                                            dtype=bool))
+        for file_name, calculate in [
+                (YEARLY_DATASET_FILE_NAME, recalculated_builder._calculate_yearly_dataset),
+                (YEAR_RANGE_DATASET_FILE_NAME, recalculated_builder._calculate_dataset_for_range_of_years)]:
+            if not patched:
+                break
+            patched = patch_dataset_csv(os.path.join(previous_output_dir, file_name), calculate(), recalculated_bbls,
+                                        bbls_in_order, os.path.join(self.arguments.output_dir, file_name))
+            if not patched:
+                logger.warning("the columns of %s changed since the previous run, building every building", file_name)
+
+        changes.write_report(self.arguments.output_dir, full_rebuild=not patched)
+        return patched
 
     def run(self):
         """
         Execute the complete dataset building process.
-        Performs dataset joining, yearly calculations, and range-based calculations.
+        Performs dataset joining, yearly calculations, range-based calculations and,
+        when scenario or retrofit action files are given, the scenario and retrofit calculations, and with
+        --samples the Monte Carlo bands. With --workers the calculations and CSV serialization are spread
+        over a pool of processes, and with --previous_output_dir only the buildings whose inputs changed
+        are recalculated. With --backend duckdb the join and the calculations run in an embedded SQL engine.
+        Each stage is measured and the run report is written next to the outputs, also when a stage fails.
         """
+        self.run_report.start()
+        try:
+            self._run_stages()
+        except BaseException as error:
+            self.run_report.error = repr(error)
+            raise
+        finally:
+            self.run_report.stop()
+            self.run_report.write(self.arguments.output_dir, vars(self.arguments))
+
+    def _run_stages(self):
+        # cubes are only written with --portfolio_cubes, those of a previous run would be read as this run's
+        remove_portfolio_cubes(self.arguments.output_dir)
+        remove_columnar_datasets(self.arguments.output_dir)
+        if self.arguments.backend == SQL_BACKEND:
+            # the engine reads the input files itself, without the cache of the joined dataset
+            SqlDatasetBuilder(self).run()
+            return
+
         self._join_ll97_ll84_datasets()
-        self._build_yearly_dataset()
-        self._build_dataset_for_range_of_years()
+        with self.run_report.stage("fingerprints", rows_in=len(self._joined_dataset)):
+            parameters_fingerprint = get_parameters_fingerprint(
+                self._coefficient_tables, self.year_ranges, self.metrics, self.years,
+                self.arguments.mixed_use_thresholds)
+            building_fingerprints = get_building_fingerprints(self._joined_dataset)
+
+        built_incrementally = False
+        if self.arguments.previous_output_dir and (get_columnar_formats(self.arguments.output_format) or
+                                                   self.arguments.portfolio_cubes):
+            logger.warning("--previous_output_dir only patches the csv datasets, building every building")
+        elif self.arguments.previous_output_dir:
+            with self.run_report.stage("incremental", rows_in=len(self._joined_dataset)):
+                built_incrementally = self._build_incrementally(parameters_fingerprint, building_fingerprints)
+
+        if built_incrementally:
+            if self._scenario_grid is not None:
+                self._build_scenario_dataset()
+            if self._retrofit_grid is not None:
+                self._build_retrofit_dataset()
+            if self.arguments.samples:
+                self._build_sampled_datasets()
+        elif self.arguments.workers > 1:
+            with self.run_report.stage("sharded", rows_in=len(self._joined_dataset)):
+                build_sharded(self, self.arguments.workers)
+        else:
+            self._build_yearly_dataset()
+            self._build_dataset_for_range_of_years()
+            if get_columnar_formats(self.arguments.output_format):
+                self._build_columnar_datasets()
+            if self.arguments.portfolio_cubes:
+                self._build_portfolio_cubes()
+            if self._scenario_grid is not None:
+                self._build_scenario_dataset()
+            if self._retrofit_grid is not None:
+                self._build_retrofit_dataset()
+            if self.arguments.samples:
+                self._build_sampled_datasets()
+
+        if self._writes_csv():
+            # the fingerprints describe the rows of the csv datasets, which a later run patches
+            write_fingerprints(self.arguments.output_dir, parameters_fingerprint, building_fingerprints)
@@ -0,0 +1,205 @@
+"""
+Content-addressed cache of the joined and cleaned LL97/LL84 dataset.
+
+Entries are keyed by a hash of the input files, the ingest options and the source of the ingest code,
+so changing a calculation parameter (prices, emission factors, thresholds, scenarios) reuses the cached
+dataset while changing an input file or the cleaning code does not. Entries are Feather (Arrow IPC) files
+when pyarrow is installed, which are read without running any code from the file, and pickled DataFrames
+otherwise. The least recently used entries are evicted once the cache grows over its size limit.
+"""
+
+import hashlib
+import inspect
+import json
+import logging
+import os
+import pickle
+import tempfile
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from terra_project_ll97_dataset import api
+from terra_project_ll97_dataset.dataset import baseline_years, bbl_join, column_projection, data_cleansing, \
+    ll84_ingest
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "terra_project_ll97_dataset")
+
+FEATHER_ENTRY_SUFFIX = ".feather"
+PICKLE_ENTRY_SUFFIX = ".pickle"
+
+# schema metadata key of the join diagnostics and value counts stored with a Feather entry
+_METADATA_KEY = b"terra_project_ll97_dataset"
+
+# missing values of object columns, which Arrow stores as nulls, by the name recorded in the entry
+_missing_values = {
+    "None": None,
+    "NaN": np.nan,
+    "NA": pd.NA,
+}
+
+# modules whose code determines the content of the joined dataset
+_INGEST_MODULES = [api, baseline_years, bbl_join, column_projection, data_cleansing, ll84_ingest]
+
+
+def _hash_file(hasher, file_path: str):
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            hasher.update(block)
+
+
+def _import_feather():
+    # None without pyarrow, the entries are then pickled
+    try:
+        import pyarrow
+        import pyarrow.feather
+    except ImportError:
+        return None
+    return pyarrow
+
+
+def _write_feather_entry(pyarrow, file_path: str, joined_df: pd.DataFrame, join_diagnostics: bbl_join.JoinDiagnostics,
+                         coerced_values: Dict):
+    table = pyarrow.Table.from_pandas(joined_df, preserve_index=True)
+    missing_values = {}
+    for column in joined_df.columns[joined_df.dtypes == object]:
+        missing = joined_df[column][joined_df[column].isna()]
+        if len(missing):
+            missing_value = missing.iloc[0]
+            missing_values[column] = "None" if missing_value is None else "NA" if missing_value is pd.NA else "NaN"
+    metadata = {
+        "missing_values": missing_values,
+        "join_diagnostics": {"counts": join_diagnostics.counts,
+                             "issues": join_diagnostics.issues.astype(object).to_dict("list")},
+        "coerced_values": coerced_values,
+    }
+    table = table.replace_schema_metadata({**table.schema.metadata, _METADATA_KEY: json.dumps(metadata).encode()})
+    pyarrow.feather.write_feather(table, file_path)
+
+
+def _read_feather_entry(pyarrow, file_path: str) -> Tuple[pd.DataFrame, bbl_join.JoinDiagnostics, Dict]:
+    table = pyarrow.feather.read_table(file_path)
+    metadata = json.loads(table.schema.metadata[_METADATA_KEY])
+    joined_df = table.to_pandas()
+    # Arrow nulls come back as None, whereas read_csv and the join leave NaN or <NA> in object columns
+    for column, missing_value in metadata["missing_values"].items():
+        joined_df[column] = joined_df[column].where(joined_df[column].notna(), _missing_values[missing_value])
+
+    join_diagnostics = bbl_join.JoinDiagnostics()
+    join_diagnostics.counts = metadata["join_diagnostics"]["counts"]
+    if metadata["join_diagnostics"]["issues"]["BBL"]:
+        join_diagnostics.issues = pd.DataFrame(metadata["join_diagnostics"]["issues"])
+    return joined_df, join_diagnostics, metadata["coerced_values"]
+
+
+def get_cache_key(input_file_paths: List[str], keep_columns: Optional[List[str]],
+                  mixed_use_thresholds: bool = False, by_baseline_year: bool = False,
+                  trend_features: bool = False, project_from_trend: bool = False) -> str:
+    """
+    Hash of everything the joined dataset depends on.
+
+    Args:
+        input_file_paths (List[str]): The LL97 file followed by the LL84 files
+        keep_columns (Optional[List[str]]): Passthrough columns requested with --keep_columns
+        mixed_use_thresholds (bool): Whether the columns of the mixed use thresholds are read
+        by_baseline_year (bool): Whether the LL84 rows are joined by baseline year
+        trend_features (bool): Whether the trend features are calculated
+        project_from_trend (bool): Whether the energy use is replaced with its trend
+
+    Returns:
+        str: Hex digest identifying the joined dataset
+    """
+    hasher = hashlib.sha256()
+    for file_path in input_file_paths:
+        # the size separates the contents of consecutive files
+        hasher.update(str(os.path.getsize(file_path)).encode())
+        _hash_file(hasher, file_path)
+    hasher.update(repr(sorted(keep_columns or [])).encode())
+    hasher.update(repr(column_projection.get_required_ll84_columns(mixed_use_thresholds, by_baseline_year)).encode())
+    hasher.update(repr((by_baseline_year, trend_features, project_from_trend)).encode())
+    for module in _INGEST_MODULES:
+        hasher.update(inspect.getsource(module).encode())
+    hasher.update(pd.__version__.encode())
+    return hasher.hexdigest()
+
+
+class DatasetCache:
+    """
+    Directory of cache entries of the joined dataset, its join diagnostics and value counts,
+    with size-based LRU eviction.
+    """
+
+    def __init__(self, cache_dir: str, max_size_mb: float):
+        """
+        Args:
+            cache_dir (str): Directory holding the cache entries, created if needed
+            max_size_mb (float): Total size of the entries above which the least recently used are evicted
+        """
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_mb * 1024 * 1024
+        self._pyarrow = _import_feather()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _get_entry_path(self, key: str) -> str:
+        # pickled entries are only read without pyarrow, as loading them can run code
+        suffix = FEATHER_ENTRY_SUFFIX if self._pyarrow is not None else PICKLE_ENTRY_SUFFIX
+        return os.path.join(self.cache_dir, key + suffix)
+
+    def get(self, key: str) -> Optional[Tuple[pd.DataFrame, bbl_join.JoinDiagnostics, Dict]]:
+        entry_path = self._get_entry_path(key)
+        try:
+            if self._pyarrow is not None:
+                value = _read_feather_entry(self._pyarrow, entry_path)
+            else:
+                with open(entry_path, "rb") as entry_file:
+                    value = pickle.load(entry_file)
+        except FileNotFoundError:
+            return None
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError, KeyError, ValueError) as error:
+            # pyarrow raises ArrowInvalid, a ValueError, for a corrupt file
+            logger.warning("ignoring unreadable cache entry %s: %s", entry_path, error)
+            return None
+
+        # the modification time records when an entry was last used
+        os.utime(entry_path)
+        return value
+
+    def put(self, key: str, value: Tuple[pd.DataFrame, bbl_join.JoinDiagnostics, Dict]):
+        # write to a temporary file first so that concurrent runs never read a partial entry
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            if self._pyarrow is not None:
+                os.close(file_descriptor)
+                try:
+                    _write_feather_entry(self._pyarrow, temporary_path, *value)
+                except (self._pyarrow.ArrowInvalid, self._pyarrow.ArrowTypeError) as error:
+                    # Arrow cannot hold object columns of mixed types, such as some passthrough columns
+                    logger.warning("not caching the joined dataset: %s", error)
+                    os.remove(temporary_path)
+                    return
+            else:
+                with os.fdopen(file_descriptor, "wb") as entry_file:
+                    pickle.dump(value, entry_file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary_path, self._get_entry_path(key))
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith((FEATHER_ENTRY_SUFFIX, PICKLE_ENTRY_SUFFIX)):
+                entry_stat = entry.stat()
+                entries.append((entry_stat.st_mtime, entry_stat.st_size, entry.path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry_path in sorted(entries):
+            if total_size <= self.max_size_bytes:
+                break
+            logger.info("evicting cache entry %s", entry_path)
+            os.remove(entry_path)
+            total_size -= size
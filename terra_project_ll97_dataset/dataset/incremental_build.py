@@ -0,0 +1,159 @@
+"""
+Incremental rebuilds from the outputs of a previous run.
+
+Every run writes a fingerprint of the calculation parameters and of each building's joined LL97/LL84 row
+next to its outputs. An incremental run compares the fingerprints of its inputs with the previous ones,
+recalculates only the added and changed buildings, and patches their rows into the previous output files.
+Unchanged rows are copied verbatim, so the patched files are identical to the files a full rebuild writes.
+"""
+
+import csv
+import hashlib
+import inspect
+import io
+import json
+import logging
+import os
+from collections import defaultdict, deque
+from typing import Dict, List, Optional, Set
+
+import numpy as np
+import pandas as pd
+
+from terra_project_ll97_dataset.calculator import carbon_emissions, carbon_emissions_thresholds, cost_of_energy, \
+    energy_unit_conversion, penalties, yearly_metrics
+from terra_project_ll97_dataset.calculator.coefficient_tables import CoefficientTables
+
+logger = logging.getLogger(__name__)
+
+FINGERPRINTS_FILE_NAME = "dataset_fingerprints.json"
+INCREMENTAL_REPORT_FILE_NAME = "dataset_incremental_report.json"
+
+# modules whose code determines the calculated metrics
+_CALCULATOR_MODULES = [carbon_emissions, carbon_emissions_thresholds, cost_of_energy, energy_unit_conversion,
+                       penalties, yearly_metrics]
+
+
+def get_parameters_fingerprint(coefficient_tables: CoefficientTables, year_ranges: List, metrics: List[str],
+                               years: List[int], mixed_use_thresholds: bool = False) -> str:
+    """
+    Hash of the coefficient tables, year ranges, selected metrics and years, threshold method and
+    calculator code, which together with a building's joined row determine its output rows.
+    """
+    hasher = hashlib.sha256()
+    for table in [coefficient_tables.carbon_emissions_by_year, coefficient_tables.cost_of_energy_by_year,
+                  coefficient_tables.carbon_emissions_thresholds]:
+        hasher.update(np.ascontiguousarray(table).tobytes())
+    hasher.update(repr([coefficient_tables.years, list(coefficient_tables.building_types),
+                        year_ranges, metrics, years, mixed_use_thresholds]).encode())
+    for module in _CALCULATOR_MODULES:
+        hasher.update(inspect.getsource(module).encode())
+    return hasher.hexdigest()
+
+
+def get_output_bbls(joined_df: pd.DataFrame) -> List[str]:
+    # BBLs as they appear in the first column of the output files
+    return [bbl if isinstance(bbl, str) else "" for bbl in joined_df.index.to_numpy()]
+
+
+def get_building_fingerprints(joined_df: pd.DataFrame) -> Dict[str, List[str]]:
+    """
+    Fingerprints of each building's joined rows, by BBL. A BBL has several fingerprints
+    when it appears more than once in the LL97 dataset.
+    """
+    row_hashes = pd.util.hash_pandas_object(joined_df, index=True).to_numpy()
+    fingerprints = defaultdict(list)
+    for bbl, row_hash in zip(get_output_bbls(joined_df), row_hashes):
+        fingerprints[bbl].append(f"{row_hash:016x}")
+    return dict(fingerprints)
+
+
+def write_fingerprints(output_dir: str, parameters_fingerprint: str, building_fingerprints: Dict[str, List[str]]):
+    with open(os.path.join(output_dir, FINGERPRINTS_FILE_NAME), "w") as fingerprints_file:
+        json.dump({"parameters": parameters_fingerprint, "buildings": building_fingerprints}, fingerprints_file)
+
+
+def read_fingerprints(output_dir: str) -> Optional[dict]:
+    try:
+        with open(os.path.join(output_dir, FINGERPRINTS_FILE_NAME)) as fingerprints_file:
+            return json.load(fingerprints_file)
+    except FileNotFoundError:
+        return None
+
+
+class BuildingChanges:
+    """
+    BBLs that were added, changed, removed or left unchanged since the previous run.
+    """
+
+    def __init__(self, previous_fingerprints: Dict[str, List[str]], current_fingerprints: Dict[str, List[str]]):
+        self.added = [bbl for bbl in current_fingerprints if bbl not in previous_fingerprints]
+        self.removed = [bbl for bbl in previous_fingerprints if bbl not in current_fingerprints]
+        self.changed = [bbl for bbl, fingerprints in current_fingerprints.items()
+                        if bbl in previous_fingerprints and previous_fingerprints[bbl] != fingerprints]
+        self.unchanged_count = len(current_fingerprints) - len(self.added) - len(self.changed)
+        self.full_rebuild = False
+
+    def get_recalculated_bbls(self) -> Set[str]:
+        return set(self.added) | set(self.changed)
+
+    def to_dict(self) -> dict:
+        return {
+            "full_rebuild": self.full_rebuild,
+            "added": len(self.added),
+            "changed": len(self.changed),
+            "removed": len(self.removed),
+            "unchanged": self.unchanged_count,
+            "added_bbls": self.added,
+            "changed_bbls": self.changed,
+            "removed_bbls": self.removed,
+        }
+
+    def write_report(self, output_dir: str, full_rebuild: bool):
+        """
+        Args:
+            output_dir (str): Directory to write the report to
+            full_rebuild (bool): Whether every building had to be recalculated
+        """
+        self.full_rebuild = full_rebuild
+        logger.info("incremental build: %d added, %d changed, %d removed and %d unchanged buildings",
+                    len(self.added), len(self.changed), len(self.removed), self.unchanged_count)
+        with open(os.path.join(output_dir, INCREMENTAL_REPORT_FILE_NAME), "w") as report_file:
+            json.dump(self.to_dict(), report_file, indent=2)
+
+
+def patch_dataset_csv(previous_file_path: str,
+                      recalculated_df: pd.DataFrame,
+                      recalculated_bbls: Set[str],
+                      bbls_in_order: List[str],
+                      output_file_path: str) -> bool:
+    """
+    Write the rows of the previous output file, with the rows of the recalculated buildings replaced by
+    recalculated_df, in the order of bbls_in_order. Rows of BBLs that are not in bbls_in_order are dropped.
+
+    Returns:
+        bool: False, without writing anything, if the columns of the previous file do not match
+    """
+    rows_by_bbl = defaultdict(deque)
+    with open(previous_file_path, newline="") as previous_file:
+        reader = csv.reader(previous_file)
+        header = next(reader)
+        for row in reader:
+            if row[0] not in recalculated_bbls:
+                rows_by_bbl[row[0]].append(row)
+
+    reader = csv.reader(io.StringIO(recalculated_df.to_csv(), newline=""))
+    if next(reader) != header:
+        return False
+    for row in reader:
+        rows_by_bbl[row[0]].append(row)
+
+    # write next to the output first, previous_file_path and output_file_path may be the same file
+    temporary_file_path = output_file_path + ".tmp"
+    with open(temporary_file_path, "w", newline="") as output_file:
+        writer = csv.writer(output_file, lineterminator=os.linesep)
+        writer.writerow(header)
+        for bbl in bbls_in_order:
+            writer.writerow(rows_by_bbl[bbl].popleft())
+    os.replace(temporary_file_path, output_file_path)
+    return True
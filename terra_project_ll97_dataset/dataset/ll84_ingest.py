@@ -0,0 +1,49 @@
+"""
+Bounded-memory ingest of the LL84 benchmarking dataset.
+Reads the file in chunks and keeps only the rows of buildings covered by LL97, and the rows with
+malformed BBLs which the join diagnostics report, so peak memory grows with the number of covered
+buildings rather than the size of the file.
+"""
+
+import io
+import logging
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+from terra_project_ll97_dataset.dataset.column_projection import LL84_BBL_COLUMN, get_ll84_dtypes
+from terra_project_ll97_dataset.dataset.data_cleansing import encode_bbl
+
+logger = logging.getLogger(__name__)
+
+
+def read_ll84_dataset_in_chunks(ll84_dataset_file_path: str, bbl_keys: np.ndarray, chunksize: int,
+                                columns: List[str]) -> pd.DataFrame:
+    """
+    Read the LL84 dataset chunk by chunk, keeping and de-duplicating only the rows whose
+    BBL is in bbl_keys or is malformed.
+
+    Args:
+        ll84_dataset_file_path (str): Location of the LL84 .csv file
+        bbl_keys (np.ndarray): BBLs of the buildings to keep, encoded with encode_bbl
+        chunksize (int): Number of rows to parse at a time
+        columns (List[str]): Columns to parse
+
+    Returns:
+        pd.DataFrame: The de-duplicated LL84 rows of the requested buildings and with malformed BBLs
+    """
+    kept_chunks = []
+    rows_read = 0
+    # parse every column as text so that duplicates are detected consistently across chunks,
+    # the column types are inferred once over the kept rows below
+    for chunk in pd.read_csv(ll84_dataset_file_path, usecols=columns, dtype=str, chunksize=chunksize):
+        rows_read += len(chunk)
+        chunk_keys = encode_bbl(chunk[LL84_BBL_COLUMN])
+        chunk = chunk[(chunk_keys.isna() | chunk_keys.isin(bbl_keys)).to_numpy()]
+        kept_chunks.append(chunk.drop_duplicates())
+
+    kept_rows = pd.concat(kept_chunks, ignore_index=True).drop_duplicates()
+    logger.info("kept %d of %d LL84 rows for %d LL97 buildings", len(kept_rows), rows_read, len(bbl_keys))
+
+    return pd.read_csv(io.StringIO(kept_rows.to_csv(index=False)), dtype=get_ll84_dtypes())
@@ -0,0 +1,221 @@
+"""
+Portfolio cubes: the yearly and year range metrics aggregated over groups of buildings.
+
+Each cube row holds the number of buildings, the sum and the percentiles of one metric for one
+group of buildings and one year or year range. Buildings are grouped by borough, by largest
+property use type, by both, and all together, so that totals such as the penalties of each borough
+per year are read from a few hundred rows instead of aggregating the per-building datasets.
+
+The cubes are reduced from the (buildings x years) metric arrays the builder has already calculated.
+"""
+
+import os
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from terra_project_ll97_dataset.calculator.yearly_metrics import YearlyMetrics
+from terra_project_ll97_dataset.dataset.columnar_output import CSV_FORMAT, OutputFormats, get_boroughs, \
+    write_columnar_file
+
+PORTFOLIO_CUBES_FILE_NAME = "dataset_portfolio_cubes"
+
+PROPERTY_TYPE_COLUMN = "Largest Property Use Type"
+
+# building dimensions of each cube, the cube without dimensions ("all") aggregates every building
+CubeDimensions: List[List[str]] = [
+    [],
+    ["borough"],
+    ["property_type"],
+    ["borough", "property_type"],
+]
+
+# percentiles of each metric over the buildings of a group
+CubePercentiles: List[int] = [10, 25, 50, 75, 90]
+
+
+class _BuildingGroups:
+    """
+    Groups of the buildings that share the values of some dimensions. The buildings are sorted
+    by group, so that each group is a contiguous run of rows, and groups are in key order.
+    """
+
+    def __init__(self, dimension_codes: np.ndarray):
+        """
+        Args:
+            dimension_codes (np.ndarray): (buildings x dimensions) integer codes of each building
+        """
+        self.keys, group_ids = np.unique(dimension_codes, axis=0, return_inverse=True)
+        group_ids = group_ids.reshape(-1)
+        self.order = np.argsort(group_ids, kind="stable")
+        self.starts = np.searchsorted(group_ids[self.order], np.arange(len(self.keys)))
+        self.counts = np.diff(np.append(self.starts, len(group_ids)))
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def aggregate(self, values_by_column: np.ndarray) -> List[np.ndarray]:
+        """
+        (groups x columns) sums of a (columns x buildings) array, followed by its (groups x columns)
+        percentiles for each of CubePercentiles.
+        """
+        if len(self) == 0:
+            return [np.zeros((0, values_by_column.shape[0]))] * (1 + len(CubePercentiles))
+        # the buildings of each group are contiguous along the rows, where reductions and partitions are fastest
+        # take keeps the rows contiguous, indexing with [:, order] would return a Fortran ordered array
+        sorted_values = np.take(values_by_column, self.order, axis=1)
+        sums = np.add.reduceat(sorted_values, self.starts, axis=1).T
+        percentiles = np.stack([np.percentile(sorted_values[:, start:start + count], CubePercentiles, axis=1)
+                                for start, count in zip(self.starts, self.counts)], axis=2)
+        return [sums] + list(percentiles.transpose(0, 2, 1))
+
+
+def _get_dimension_codes(joined_df: pd.DataFrame) -> Tuple[Dict[str, np.ndarray], Dict[str, np.ndarray]]:
+    """
+    Integer code of each building's borough and property type, -1 when missing,
+    and the value of each code.
+    """
+    borough_codes = get_boroughs(joined_df.index).fillna(-1).to_numpy(dtype=np.int64)
+    property_type_codes, property_types = pd.factorize(joined_df[PROPERTY_TYPE_COLUMN].astype(object), sort=True)
+    codes = {
+        "borough": borough_codes,
+        "property_type": property_type_codes.astype(np.int64),
+    }
+    # code -1 indexes the trailing missing value
+    values = {
+        "borough": np.append(np.arange(10, dtype=object), None),
+        "property_type": np.append(np.asarray(property_types, dtype=object), None),
+    }
+    return codes, values
+
+
+def _get_cube(groups: _BuildingGroups, group_values: Dict[str, np.ndarray], dimensions: List[str],
+              aggregates: List[np.ndarray], metric_blocks: List[Tuple[str, str, List]]) -> List[pd.DataFrame]:
+    """
+    Lay out the aggregates of one cube, (groups x metric blocks) arrays, as one frame per metric block.
+    """
+    frames = []
+    block_start = 0
+    for period_type, metric, periods in metric_blocks:
+        number_of_periods = len(periods)
+        block = slice(block_start, block_start + number_of_periods)
+        block_start += number_of_periods
+
+        # rows run over the groups, and over the periods within each group
+        frame = pd.DataFrame({
+            "dimensions": ",".join(dimensions) or "all",
+            "borough": np.repeat(group_values["borough"], number_of_periods) if "borough" in group_values else None,
+            "property_type": (np.repeat(group_values["property_type"], number_of_periods)
+                              if "property_type" in group_values else None),
+            "period_type": period_type,
+            "period": np.tile(np.asarray([str(period) for period in periods], dtype=object), len(groups)),
+            "metric": metric,
+            "count": np.repeat(groups.counts, number_of_periods),
+            "sum": aggregates[0][:, block].reshape(-1),
+        }, index=range(len(groups) * number_of_periods))
+        for percentile, values in zip(CubePercentiles, aggregates[1:]):
+            frame[f"p{percentile}"] = values[:, block].reshape(-1)
+        frames.append(frame)
+    return frames
+
+
+def calculate_portfolio_cubes(joined_df: pd.DataFrame,
+                              yearly_metrics: YearlyMetrics,
+                              year_range_metrics: YearlyMetrics) -> pd.DataFrame:
+    """
+    Aggregate the yearly and year range metrics of the buildings in joined_df over every cube of CubeDimensions.
+
+    Args:
+        joined_df (pd.DataFrame): The joined dataset, indexed by BBL
+        yearly_metrics (YearlyMetrics): (buildings x years) metrics of the buildings in joined_df
+        year_range_metrics (YearlyMetrics): (buildings x year ranges) metrics of the buildings in joined_df
+
+    Returns:
+        pd.DataFrame: One row per cube, group, year or year range and metric, with the number of buildings,
+        the sum and the percentiles of the metric. borough and property_type are null in the cubes that
+        do not group by them, and for the buildings where they are missing
+    """
+    dimension_codes, dimension_values = _get_dimension_codes(joined_df)
+
+    # the periods of every metric stacked as the rows of one (columns x buildings) array,
+    # so that each group is aggregated in one call
+    metric_blocks = [(period_type, metric, metrics.years)
+                     for metrics, period_type in [(yearly_metrics, "year"), (year_range_metrics, "year_range")]
+                     for metric in metrics.metrics]
+    values_by_column = np.vstack([yearly_metrics.values[metric].T for metric in yearly_metrics.metrics] +
+                                 [year_range_metrics.values[metric].T for metric in year_range_metrics.metrics])
+
+    frames = []
+    for dimensions in CubeDimensions:
+        groups = _BuildingGroups(np.column_stack(
+            [dimension_codes[dimension] for dimension in dimensions] or [np.zeros(len(joined_df), dtype=np.int64)]))
+        group_values = {dimension: dimension_values[dimension][groups.keys[:, dimension_index]]
+                        for dimension_index, dimension in enumerate(dimensions)}
+        frames.extend(_get_cube(groups, group_values, dimensions, groups.aggregate(values_by_column), metric_blocks))
+
+    cubes_df = pd.concat(frames, ignore_index=True)
+    cubes_df["borough"] = cubes_df["borough"].astype("Int8")
+    cubes_df["property_type"] = cubes_df["property_type"].astype(object)
+    return cubes_df
+
+
+def write_portfolio_cubes(output_dir: str, output_formats: List[str], cubes_df: pd.DataFrame,
+                          compression: str = "zstd"):
+    """
+    Write the cubes to a dataset_portfolio_cubes file in each of output_formats.
+    """
+    file_path = os.path.join(output_dir, PORTFOLIO_CUBES_FILE_NAME)
+    for output_format in output_formats:
+        if output_format == CSV_FORMAT:
+            cubes_df.to_csv(f"{file_path}.csv", index=False)
+        else:
+            write_columnar_file(file_path, output_format, cubes_df, compression)
+
+
+def remove_portfolio_cubes(output_dir: str):
+    """
+    Remove the dataset_portfolio_cubes files of a previous run, in every format, so that cubes of other
+    arguments are not left next to the datasets of this run.
+    """
+    for output_format in OutputFormats:
+        file_path = os.path.join(output_dir, f"{PORTFOLIO_CUBES_FILE_NAME}.{output_format}")
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+
+def _get_metrics_part_file_path(parts_dir: str, part_index: int) -> str:
+    return os.path.join(parts_dir, f"{PORTFOLIO_CUBES_FILE_NAME}.part-{part_index:05d}.npz")
+
+
+def save_metrics_part(parts_dir: str, part_index: int, yearly_metrics: YearlyMetrics,
+                      year_range_metrics: YearlyMetrics):
+    """
+    Save the metrics of a shard of buildings, to be concatenated by load_metrics_parts.
+    """
+    np.savez(_get_metrics_part_file_path(parts_dir, part_index),
+             **{f"year_{metric}": yearly_metrics.values[metric] for metric in yearly_metrics.metrics},
+             **{f"year_range_{metric}": year_range_metrics.values[metric] for metric in year_range_metrics.metrics})
+
+
+def load_metrics_parts(parts_dir: str, number_of_parts: int, years: List[int], year_ranges: List[str],
+                       metrics: List[str]) -> Tuple[YearlyMetrics, YearlyMetrics]:
+    """
+    Concatenate the metrics saved by save_metrics_part for every shard, in shard order.
+
+    Args:
+        parts_dir (str): Directory the parts were saved to
+        number_of_parts (int): Number of shards
+        years (List[int]): Years of the yearly metrics
+        year_ranges (List[str]): Year range strings of the year range metrics
+        metrics (List[str]): The saved metrics
+
+    Returns:
+        Tuple[YearlyMetrics, YearlyMetrics]: The yearly and year range metrics of every building
+    """
+    parts = [np.load(_get_metrics_part_file_path(parts_dir, part_index)) for part_index in range(number_of_parts)]
+    return tuple(
+        YearlyMetrics(periods, {metric: np.concatenate([part[f"{period_type}_{metric}"] for part in parts])
+                                for metric in metrics},
+                      column_suffix, metrics)
+        for period_type, periods, column_suffix in [("year", years, ""), ("year_range", year_ranges, "_per_year")])
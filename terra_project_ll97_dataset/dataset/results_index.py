@@ -0,0 +1,305 @@
+"""
+Read-only index of the datasets written by the dataset builder, for serving lookups.
+
+The wide yearly and year range CSV files are parsed once into one (buildings x periods) array per
+metric. The arrays are saved as .npy files under .serve_cache in the output directory and memory-mapped,
+so that reloading the same build, or serving it from several processes, shares one copy through the
+page cache instead of parsing the CSV files again. Buildings are indexed by BBL, property type and borough.
+"""
+
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+import shutil
+import tempfile
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from terra_project_ll97_dataset.dataset.columnar_output import OutputFormats, get_boroughs
+from terra_project_ll97_dataset.dataset.data_cleansing import normalise_bbl
+from terra_project_ll97_dataset.dataset.portfolio_cubes import PORTFOLIO_CUBES_FILE_NAME, PROPERTY_TYPE_COLUMN
+from terra_project_ll97_dataset.util.common import Metrics, YEAR_RANGE_DATASET_FILE_NAME, YEARLY_DATASET_FILE_NAME
+from terra_project_ll97_dataset.util.run_report import RUN_REPORT_FILE_NAME
+
+logger = logging.getLogger(__name__)
+
+SERVE_CACHE_DIR_NAME = ".serve_cache"
+
+# cube columns that queries can filter on
+CubeFilterColumns: List[str] = [
+    "dimensions",
+    "borough",
+    "property_type",
+    "period_type",
+    "period",
+    "metric",
+]
+
+_metric_column_pattern = re.compile(rf"^(?P<period>.+?)_(?P<metric>{'|'.join(Metrics)})(?P<suffix>_per_year)?$")
+
+
+def _to_json_value(value):
+    # numpy scalars to Python values, and NaN and <NA> to null, which JSON cannot represent otherwise
+    if isinstance(value, np.generic):
+        value = value.item()
+    if value is None or value is pd.NA or (isinstance(value, float) and math.isnan(value)):
+        return None
+    return value
+
+
+def _get_cache_version(file_paths: List[str]) -> str:
+    # a new build rewrites the files, which changes their size or modification time
+    hasher = hashlib.sha256()
+    for file_path in file_paths:
+        stat = os.stat(file_path)
+        hasher.update(repr((os.path.basename(file_path), stat.st_size, stat.st_mtime_ns)).encode())
+    return hasher.hexdigest()[:16]
+
+
+def _split_metric_columns(columns: List[str]):
+    """
+    The periods and metrics of the "{period}_{metric}[_per_year]" columns, in column order,
+    and the remaining building columns.
+    """
+    periods, metrics, building_columns = [], [], []
+    for column in columns:
+        match = _metric_column_pattern.match(column)
+        if match is None:
+            building_columns.append(column)
+            continue
+        if match["period"] not in periods:
+            periods.append(match["period"])
+        if match["metric"] not in metrics:
+            metrics.append(match["metric"])
+    return periods, metrics, building_columns
+
+
+def _read_metrics_csv(file_path: str, column_suffix: str):
+    """
+    Read a wide dataset written by the builder.
+
+    Returns:
+        Tuple: The building columns as a DataFrame, the periods, and a (buildings x periods) array per metric
+    """
+    df = pd.read_csv(file_path, dtype={"BBL": str}, keep_default_na=False, na_values=[""],
+                     float_precision="round_trip", low_memory=False)
+    periods, metrics, building_columns = _split_metric_columns(list(df.columns))
+    values = {metric: df[[f"{period}_{metric}{column_suffix}" for period in periods]].to_numpy(dtype=float)
+              for metric in metrics}
+    return df[building_columns], periods, values
+
+
+class ResultsIndex:
+    """
+    The buildings and metrics of one build, indexed for lookups.
+    """
+
+    def __init__(self,
+                 version: str,
+                 buildings: pd.DataFrame,
+                 years: List[str],
+                 yearly_values: Dict[str, np.ndarray],
+                 year_ranges: List[str],
+                 year_range_values: Dict[str, np.ndarray],
+                 cubes: Optional[pd.DataFrame] = None):
+        """
+        Args:
+            version (str): Identifies the build the index was loaded from
+            buildings (pd.DataFrame): The building columns, one row per building in output order
+            years (List[str]): The years of the yearly arrays
+            yearly_values (Dict[str, np.ndarray]): (buildings x years) array of each metric
+            year_ranges (List[str]): The year ranges of the year range arrays
+            year_range_values (Dict[str, np.ndarray]): (buildings x year ranges) array of each metric
+            cubes (Optional[pd.DataFrame]): The portfolio cubes, when the build wrote them
+        """
+        self.version = version
+        self.buildings = buildings
+        self.years = years
+        self.yearly_values = yearly_values
+        self.year_ranges = year_ranges
+        self.year_range_values = year_range_values
+        self.cubes = cubes
+
+        # building rows are kept as Python records, so that a lookup does not touch pandas
+        self._building_records = [{column: _to_json_value(value) for column, value in zip(buildings.columns, row)}
+                                  for row in buildings.itertuples(index=False, name=None)]
+        self._rows_by_bbl: Dict[str, List[int]] = {}
+        for row, bbl in enumerate(buildings["BBL"]):
+            if isinstance(bbl, str):
+                self._rows_by_bbl.setdefault(bbl, []).append(row)
+
+        property_types = buildings[PROPERTY_TYPE_COLUMN] if PROPERTY_TYPE_COLUMN in buildings else pd.Series(
+            [None] * len(buildings))
+        self._property_type_codes, self.property_types = pd.factorize(property_types.astype(object), sort=True)
+        self._boroughs = get_boroughs(pd.Index(buildings["BBL"])).fillna(-1).to_numpy(dtype=np.int64)
+
+        if cubes is not None:
+            self._cube_columns = {column: cubes[column].astype(object).where(cubes[column].notna(), None).to_numpy()
+                                  for column in CubeFilterColumns}
+
+    def __len__(self) -> int:
+        return len(self.buildings)
+
+    @classmethod
+    def load(cls, output_dir: str) -> "ResultsIndex":
+        """
+        Load the datasets of the build in output_dir, from the memory-mapped cache when it is up to date.
+
+        Raises:
+            FileNotFoundError: If output_dir does not hold the yearly and year range CSV datasets
+        """
+        file_paths = [os.path.join(output_dir, file_name)
+                      for file_name in [YEARLY_DATASET_FILE_NAME, YEAR_RANGE_DATASET_FILE_NAME]]
+        for file_path in file_paths:
+            if not os.path.exists(file_path):
+                raise FileNotFoundError(f"{file_path} not found, serving needs the csv datasets of a build")
+
+        cubes_file_path = _get_cubes_file_path(output_dir, file_paths)
+        cubes = _read_cubes(cubes_file_path) if cubes_file_path is not None else None
+        version = _get_cache_version(file_paths + ([cubes_file_path] if cubes_file_path is not None else []))
+        cache_dir = os.path.join(output_dir, SERVE_CACHE_DIR_NAME, version)
+        if not os.path.exists(os.path.join(cache_dir, "index.json")):
+            try:
+                _write_cache(cache_dir, file_paths)
+            except OSError as error:
+                logger.warning("cannot write the serving cache in %s, serving from memory: %s", output_dir, error)
+                buildings, years, yearly_values = _read_metrics_csv(file_paths[0], "")
+                _, year_ranges, year_range_values = _read_metrics_csv(file_paths[1], "_per_year")
+                return cls(version, buildings, years, yearly_values, year_ranges, year_range_values, cubes)
+            _remove_other_cache_versions(output_dir, version)
+
+        with open(os.path.join(cache_dir, "index.json")) as index_file:
+            index = json.load(index_file)
+        buildings = pd.read_pickle(os.path.join(cache_dir, "buildings.pkl"))
+        yearly_values, year_range_values = [
+            {metric: np.load(os.path.join(cache_dir, f"{prefix}_{metric}.npy"), mmap_mode="r")
+             for metric in index["metrics"][prefix]}
+            for prefix in ["yearly", "year_range"]]
+        return cls(version, buildings, index["years"], yearly_values, index["year_ranges"], year_range_values, cubes)
+
+    def get_rows(self, bbls: Iterable[str]) -> List[int]:
+        """Rows of the buildings with the given BBLs, which may be written with dashes or slashes."""
+        rows = []
+        for bbl in bbls:
+            rows.extend(self._rows_by_bbl.get(normalise_bbl(str(bbl)), []))
+        return rows
+
+    def filter_rows(self, property_type: Optional[str] = None, borough: Optional[int] = None) -> np.ndarray:
+        """Rows of the buildings with the given largest property use type and borough, in output order."""
+        mask = np.ones(len(self), dtype=bool)
+        if property_type is not None:
+            code = self.property_types.get_indexer([property_type])[0]
+            mask &= self._property_type_codes == code if code >= 0 else False
+        if borough is not None:
+            mask &= self._boroughs == borough
+        return np.flatnonzero(mask)
+
+    def get_buildings(self, rows: Iterable[int], years: Optional[List[str]] = None) -> List[dict]:
+        """
+        The building columns and the metrics of each row, optionally restricted to some years.
+        """
+        year_indexes = [(year, index) for index, year in enumerate(self.years) if years is None or year in years]
+        buildings = []
+        for row in rows:
+            # one row of each memory-mapped array is read at once, indexing single values is much slower
+            yearly = {metric: values[row].tolist() for metric, values in self.yearly_values.items()}
+            year_range = {metric: values[row].tolist() for metric, values in self.year_range_values.items()}
+            buildings.append({
+                "building": self._building_records[row],
+                "yearly": {year: {metric: _to_json_value(values[index]) for metric, values in yearly.items()}
+                           for year, index in year_indexes},
+                "year_ranges": {year_range_string: {metric: _to_json_value(values[index])
+                                                    for metric, values in year_range.items()}
+                                for index, year_range_string in enumerate(self.year_ranges)},
+            })
+        return buildings
+
+    def query_cubes(self, filters: Dict[str, str]) -> List[dict]:
+        """
+        The cube rows matching every filter, a value of one of CubeFilterColumns.
+
+        Raises:
+            LookupError: If the build did not write portfolio cubes
+        """
+        if self.cubes is None:
+            raise LookupError("the build did not write portfolio cubes, run it with --portfolio_cubes")
+        mask = np.ones(len(self.cubes), dtype=bool)
+        for column, value in filters.items():
+            column_values = self._cube_columns[column]
+            mask &= column_values == (int(value) if column == "borough" else value)
+        return [{column: _to_json_value(value) for column, value in record.items()}
+                for record in self.cubes.iloc[np.flatnonzero(mask)].to_dict("records")]
+
+
+def _get_cubes_file_path(output_dir: str, file_paths: List[str]) -> Optional[str]:
+    """
+    The portfolio cubes file of the build, None when the run report of the build does not show that it wrote
+    cubes or when the cubes file is older than the datasets, which a build without --portfolio_cubes
+    left behind.
+    """
+    try:
+        with open(os.path.join(output_dir, RUN_REPORT_FILE_NAME)) as run_report_file:
+            arguments = json.load(run_report_file).get("arguments") or {}
+    except (OSError, ValueError):
+        return None
+    if not arguments.get("portfolio_cubes"):
+        return None
+
+    datasets_mtime = max(os.stat(file_path).st_mtime_ns for file_path in file_paths)
+    for output_format in OutputFormats:
+        file_path = os.path.join(output_dir, f"{PORTFOLIO_CUBES_FILE_NAME}.{output_format}")
+        if os.path.exists(file_path):
+            if os.stat(file_path).st_mtime_ns < datasets_mtime:
+                logger.warning("not loading %s, it is older than the datasets", file_path)
+                return None
+            return file_path
+    return None
+
+
+def _read_cubes(file_path: str) -> pd.DataFrame:
+    if file_path.endswith(".csv"):
+        return pd.read_csv(file_path, dtype={"period": str, "property_type": str, "borough": "Int8"},
+                           keep_default_na=False, na_values=[""], float_precision="round_trip")
+    if file_path.endswith(".parquet"):
+        return pd.read_parquet(file_path)
+    import pyarrow.ipc
+    with pyarrow.ipc.open_file(file_path) as reader:
+        return reader.read_pandas()
+
+
+def _write_cache(cache_dir: str, file_paths: List[str]):
+    """
+    Parse the CSV datasets into the cache, written to a temporary directory that is renamed into place
+    so that concurrent loads never see a partial cache.
+    """
+    buildings, years, yearly_values = _read_metrics_csv(file_paths[0], "")
+    _, year_ranges, year_range_values = _read_metrics_csv(file_paths[1], "_per_year")
+
+    os.makedirs(os.path.dirname(cache_dir), exist_ok=True)
+    temporary_dir = tempfile.mkdtemp(dir=os.path.dirname(cache_dir), prefix=".tmp-")
+    try:
+        buildings.to_pickle(os.path.join(temporary_dir, "buildings.pkl"))
+        for prefix, values in [("yearly", yearly_values), ("year_range", year_range_values)]:
+            for metric, metric_values in values.items():
+                np.save(os.path.join(temporary_dir, f"{prefix}_{metric}.npy"), metric_values)
+        with open(os.path.join(temporary_dir, "index.json"), "w") as index_file:
+            json.dump({"years": years, "year_ranges": year_ranges,
+                       "metrics": {"yearly": list(yearly_values), "year_range": list(year_range_values)}}, index_file)
+        os.rename(temporary_dir, cache_dir)
+    except OSError:
+        shutil.rmtree(temporary_dir, ignore_errors=True)
+        if not os.path.exists(os.path.join(cache_dir, "index.json")):
+            raise
+
+
+def _remove_other_cache_versions(output_dir: str, version: str):
+    # the caches of earlier builds, files that are still mapped stay readable until they are unmapped
+    serve_cache_dir = os.path.join(output_dir, SERVE_CACHE_DIR_NAME)
+    for entry in os.listdir(serve_cache_dir):
+        if entry != version and not entry.startswith(".tmp-"):
+            shutil.rmtree(os.path.join(serve_cache_dir, entry), ignore_errors=True)
@@ -0,0 +1,174 @@
+"""
+Multi-process execution of the calculation and serialization stages of the dataset builder.
+
+The joined dataset is split into contiguous shards of buildings and each worker calculates and
+writes the yearly, year range, retrofit and Monte Carlo band rows of one shard to a part file.
+Scenario batches are spread over the workers in the same way. The parts are concatenated in order,
+so the output files are byte-identical to a single process run whatever the number of workers.
+Each task records its stages in a run report of its own, which are merged into the builder's report.
+"""
+
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, TYPE_CHECKING
+
+import numpy as np
+
+from terra_project_ll97_dataset.dataset.columnar_output import get_columnar_formats
+from terra_project_ll97_dataset.dataset.portfolio_cubes import load_metrics_parts, save_metrics_part
+from terra_project_ll97_dataset.util.common import RETROFIT_DATASET_FILE_NAME, SCENARIO_DATASET_FILE_NAME, \
+    YEAR_RANGE_BANDS_DATASET_FILE_NAME, YEAR_RANGE_DATASET_FILE_NAME, YEARLY_BANDS_DATASET_FILE_NAME, \
+    YEARLY_DATASET_FILE_NAME
+from terra_project_ll97_dataset.util.run_report import RunReport, StageRecord
+
+if TYPE_CHECKING:
+    from terra_project_ll97_dataset.dataset.dataset_builder import DatasetBuilder
+
+logger = logging.getLogger(__name__)
+
+# shards per worker, so that workers that finish early can pick up more work
+SHARDS_PER_WORKER = 4
+
+# builder shared by all tasks of a worker process, set by _initialize_worker
+_builder = None
+
+
+def _initialize_worker(builder: "DatasetBuilder"):
+    global _builder
+    _builder = builder
+
+
+def _get_part_file_name(file_name: str, part_index: int) -> str:
+    return f"{file_name}.part-{part_index:05d}"
+
+
+def _get_part_file_path(parts_dir: str, file_name: str, part_index: int) -> str:
+    return os.path.join(parts_dir, _get_part_file_name(file_name, part_index))
+
+
+def _build_building_shard(shard_index: int, start: int, stop: int, parts_dir: str) -> List[StageRecord]:
+    """
+    Calculate and write the yearly, year range, retrofit and band rows of the buildings in [start, stop).
+    Only the first shard writes the CSV header. The columnar datasets are written directly
+    to the output directory, one part per shard.
+
+    Returns:
+        List[StageRecord]: The stages of the shard, named as the stages of a single process run
+    """
+    shard_builder = _builder._for_buildings(slice(start, stop))
+    run_report = shard_builder.run_report = RunReport()
+    header = shard_index == 0
+
+    if shard_builder._writes_csv():
+        shard_builder._calculate_and_write_dataset(
+            "yearly", shard_builder._calculate_yearly_dataset,
+            _get_part_file_name(YEARLY_DATASET_FILE_NAME, shard_index), parts_dir, header)
+        shard_builder._calculate_and_write_dataset(
+            "ranges", shard_builder._calculate_dataset_for_range_of_years,
+            _get_part_file_name(YEAR_RANGE_DATASET_FILE_NAME, shard_index), parts_dir, header)
+    else:
+        with run_report.stage("yearly", rows_in=stop - start):
+            shard_builder._calculate_yearly_metrics()
+        with run_report.stage("ranges", rows_in=stop - start):
+            shard_builder._calculate_year_range_metrics()
+
+    if shard_builder._retrofit_grid is not None:
+        shard_builder._calculate_and_write_dataset(
+            "retrofits", shard_builder._calculate_retrofit_dataset,
+            _get_part_file_name(RETROFIT_DATASET_FILE_NAME, shard_index), parts_dir, header)
+
+    if shard_builder.arguments.samples:
+        with run_report.stage("samples", rows_in=stop - start) as stage:
+            # the random numbers are drawn for blocks of every building, which the full builder holds
+            bands_dfs = _builder._calculate_sampled_datasets(slice(start, stop))
+            stage.rows_out = len(bands_dfs[0])
+        with run_report.stage("write_samples", rows_in=len(bands_dfs[0])) as stage:
+            for file_name, bands_df in zip([YEARLY_BANDS_DATASET_FILE_NAME, YEAR_RANGE_BANDS_DATASET_FILE_NAME],
+                                           bands_dfs):
+                bands_df.to_csv(_get_part_file_path(parts_dir, file_name, shard_index), header=header)
+            stage.rows_out = len(bands_dfs[0])
+
+    if get_columnar_formats(shard_builder.arguments.output_format):
+        shard_builder._build_columnar_datasets(shard_index)
+    if shard_builder.arguments.portfolio_cubes:
+        # the percentiles need the metrics of every building, the cubes are aggregated once all shards are done
+        save_metrics_part(parts_dir, shard_index, shard_builder._yearly_metrics.select(shard_builder.years),
+                          shard_builder._year_range_metrics)
+    return run_report.stages
+
+
+def _build_scenario_batch(batch_index: int, scenarios: slice, scenario_names: List[str],
+                          parts_dir: str) -> List[StageRecord]:
+    run_report = RunReport()
+    # every batch reads all buildings, which are counted once as in a single process run
+    rows_in = len(_builder._joined_dataset) if batch_index == 0 else 0
+    with run_report.stage("scenarios", rows_in=rows_in) as stage:
+        scenario_df = _builder._calculate_scenario_dataset(scenarios, scenario_names)
+        scenario_df.to_csv(_get_part_file_path(parts_dir, SCENARIO_DATASET_FILE_NAME, batch_index), index=False,
+                           header=batch_index == 0)
+        stage.rows_out = len(scenario_df)
+    return run_report.stages
+
+
+def _merge_parts(parts_dir: str, file_name: str, number_of_parts: int, output_dir: str):
+    with open(os.path.join(output_dir, file_name), "wb") as output_file:
+        for part_index in range(number_of_parts):
+            with open(_get_part_file_path(parts_dir, file_name, part_index), "rb") as part_file:
+                shutil.copyfileobj(part_file, output_file)
+
+
+def _get_multiprocessing_context():
+    # fork shares the joined dataset and coefficient tables with the workers without pickling them
+    if "fork" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("fork")
+    return multiprocessing.get_context()
+
+
+def build_sharded(builder: "DatasetBuilder", workers: int):
+    """
+    Build the yearly, year range, retrofit, band and scenario datasets of a builder whose datasets have been joined,
+    using a pool of worker processes. The stages of the workers are added to the builder's run report.
+
+    Args:
+        builder (DatasetBuilder): The builder, after _join_ll97_ll84_datasets
+        workers (int): Number of worker processes
+    """
+    number_of_buildings = len(builder._joined_dataset)
+    number_of_shards = max(1, min(number_of_buildings, workers * SHARDS_PER_WORKER))
+    shard_bounds = np.linspace(0, number_of_buildings, num=number_of_shards + 1, dtype=int)
+
+    with tempfile.TemporaryDirectory(dir=builder.arguments.output_dir, prefix=".parts-") as parts_dir:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=_get_multiprocessing_context(),
+                                 initializer=_initialize_worker, initargs=(builder,)) as executor:
+            futures = [executor.submit(_build_building_shard, shard_index, int(shard_bounds[shard_index]),
+                                       int(shard_bounds[shard_index + 1]), parts_dir)
+                       for shard_index in range(number_of_shards)]
+
+            scenario_batches = []
+            if builder._scenario_grid is not None:
+                scenario_batches = list(builder._scenario_grid.batches(builder.arguments.scenario_batch_size))
+                futures += [executor.submit(_build_scenario_batch, batch_index, scenarios, scenario_names, parts_dir)
+                            for batch_index, (scenarios, scenario_names) in enumerate(scenario_batches)]
+
+            builder.run_report.add_worker_stages([stage for future in futures for stage in future.result()])
+
+        logger.info("calculated %d shards of buildings and %d scenario batches on %d workers",
+                    number_of_shards, len(scenario_batches), workers)
+        if builder._writes_csv():
+            _merge_parts(parts_dir, YEARLY_DATASET_FILE_NAME, number_of_shards, builder.arguments.output_dir)
+            _merge_parts(parts_dir, YEAR_RANGE_DATASET_FILE_NAME, number_of_shards, builder.arguments.output_dir)
+        if builder._retrofit_grid is not None:
+            _merge_parts(parts_dir, RETROFIT_DATASET_FILE_NAME, number_of_shards, builder.arguments.output_dir)
+        if builder.arguments.samples:
+            _merge_parts(parts_dir, YEARLY_BANDS_DATASET_FILE_NAME, number_of_shards, builder.arguments.output_dir)
+            _merge_parts(parts_dir, YEAR_RANGE_BANDS_DATASET_FILE_NAME, number_of_shards,
+                         builder.arguments.output_dir)
+        if scenario_batches:
+            _merge_parts(parts_dir, SCENARIO_DATASET_FILE_NAME, len(scenario_batches), builder.arguments.output_dir)
+        if builder.arguments.portfolio_cubes:
+            builder._build_portfolio_cubes(*load_metrics_parts(
+                parts_dir, number_of_shards, builder.years, builder._get_year_range_strings(), builder.metrics))
@@ -0,0 +1,507 @@
+"""
+Out-of-core backend that runs the join and the calculations in DuckDB, an embedded analytical SQL engine.
+
+The LL97 and LL84 files are loaded into engine tables, and the steps of the pandas backend are expressed
+as SQL over them: BBL normalisation, the one to one join and the cleaning of the numerical columns, the
+yearly metrics and the year range averages. The datasets are then copied from the engine straight to
+CSV or Parquet files, so no step holds the whole dataset in Python memory. The engine uses every core,
+and spills to a temporary directory next to the outputs once it reaches its memory limit.
+
+The metrics are the same floating point operations as the vectorized engine, in the same order: the
+coefficients are exact double literals, the weighted energy use is summed in EnergyTypes order, the
+thresholds from the largest use down, and the year range averages year by year. The values written
+are therefore identical to the pandas backend: the CSV files are byte-identical and the Parquet metrics
+tables hold the same values. The Parquet building table holds the same values as well, but its text
+columns are plain strings, where the pandas backend writes the property use type as a dictionary and
+records the pandas dtypes of the columns.
+
+duckdb is an optional dependency, installed with the sql extra.
+"""
+
+import csv
+import logging
+import os
+import shutil
+import tempfile
+from typing import TYPE_CHECKING, Dict, List
+
+import pandas as pd
+
+from terra_project_ll97_dataset.calculator.carbon_emissions_thresholds import PropertyUseColumns
+from terra_project_ll97_dataset.calculator.coefficient_tables import CoefficientTables
+from terra_project_ll97_dataset.calculator.energy_unit_conversion import energy_units_conversion_dictionary
+from terra_project_ll97_dataset.calculator.penalties import penalty_per_tCO2_over_threshold
+from terra_project_ll97_dataset.dataset.bbl_join import JoinDiagnostics
+from terra_project_ll97_dataset.dataset.column_projection import LL84_BBL_COLUMN, LL97_BBL_COLUMN, \
+    get_required_ll84_columns, read_csv_header, select_columns
+from terra_project_ll97_dataset.dataset.columnar_output import BUILDINGS_DATASET_NAME, CSV_FORMAT, \
+    YEAR_RANGE_METRICS_DATASET_NAME, YEARLY_METRICS_DATASET_NAME, get_columnar_formats, get_dataset_dir
+from terra_project_ll97_dataset.dataset.data_cleansing import numerical_columns
+from terra_project_ll97_dataset.util.common import EnergyTypes, Metrics, YEAR_RANGE_DATASET_FILE_NAME, \
+    YEARLY_DATASET_FILE_NAME, get_required_metrics, get_year_range_string, get_years_in_range
+
+if TYPE_CHECKING:
+    from terra_project_ll97_dataset.dataset.dataset_builder import DatasetBuilder
+
+logger = logging.getLogger(__name__)
+
+PANDAS_BACKEND = "pandas"
+SQL_BACKEND = "duckdb"
+
+# backends that can be passed to --backend
+Backends: List[str] = [
+    PANDAS_BACKEND,
+    SQL_BACKEND,
+]
+
+# output formats the engine writes directly
+SqlOutputFormats: List[str] = [
+    CSV_FORMAT,
+    "parquet",
+]
+
+# arguments of the pandas backend that the SQL backend does not implement, with the value that disables them
+_unsupported_arguments = {
+    "row_wise": False,
+    "scenarios": None,
+    "retrofit_actions": None,
+    "samples": None,
+    "portfolio_cubes": False,
+    "previous_output_dir": None,
+    "by_baseline_year": False,
+    # passthrough columns would be written as the text of the input files, not as parsed by pandas
+    "keep_columns": None,
+}
+
+# strings read as missing values, the defaults of pandas.read_csv, so that both backends see the same values
+_null_strings: List[str] = [
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN", "<NA>", "N/A",
+    "NA", "NULL", "NaN", "None", "n/a", "nan", "null",
+]
+
+# the borough, block and lot patterns of encode_bbl, on BBLs stripped of surrounding whitespace
+_create_macros_sql = r"""
+CREATE MACRO strip_whitespace(value) AS regexp_replace(value, '^\s+|\s+$', '', 'g');
+CREATE MACRO encode_bbl(bbl) AS CASE
+    WHEN regexp_full_match(strip_whitespace(bbl), '\d[-/]\d{1,5}[-/]\d{1,4}') THEN
+        CAST(regexp_extract(strip_whitespace(bbl), '^(\d)', 1) AS BIGINT) * 1000000000
+        + CAST(regexp_extract(strip_whitespace(bbl), '^\d[-/](\d+)', 1) AS BIGINT) * 10000
+        + CAST(regexp_extract(strip_whitespace(bbl), '(\d+)$', 1) AS BIGINT)
+    WHEN regexp_full_match(strip_whitespace(bbl), '\d{10}') THEN CAST(strip_whitespace(bbl) AS BIGINT)
+    END;
+CREATE MACRO normalise_bbl(bbl) AS strip_whitespace(replace(replace(bbl, '-', ''), '/', ''));
+"""
+
+
+def _import_duckdb():
+    try:
+        import duckdb
+    except ImportError as error:
+        raise ImportError("the duckdb backend requires duckdb, install it with "
+                          "pip install 'terra-project-ll97-dataset[sql]'") from error
+    return duckdb
+
+
+def check_sql_backend_arguments(arguments):
+    """
+    Raises:
+        ValueError: If the arguments request a feature or output format the SQL backend does not implement
+    """
+    unsupported = [f"--{name}" for name, disabled in _unsupported_arguments.items()
+                   if getattr(arguments, name) not in (disabled, None)]
+    unsupported += [f"--output_format {output_format}" for output_format in arguments.output_format
+                    if output_format not in SqlOutputFormats]
+    if unsupported:
+        raise ValueError(f"the {SQL_BACKEND} backend does not support {', '.join(unsupported)}, "
+                         f"use --backend {PANDAS_BACKEND}")
+
+
+def _quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _string_literal(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _double_literal(value: float) -> str:
+    # the shortest repr of a double parses back to the same double, a decimal literal may not
+    return f"CAST('{float(value)!r}' AS DOUBLE)"
+
+
+def _read_csv_sql(file_paths: List[str]) -> str:
+    # every column is read as text, the numerical columns are converted like pandas.to_numeric when joined
+    return (f"read_csv([{', '.join(_string_literal(file_path) for file_path in file_paths)}], header = true, "
+            f"all_varchar = true, union_by_name = true, "
+            f"nullstr = [{', '.join(_string_literal(value) for value in _null_strings)}])")
+
+
+def _get_energy_use_expressions() -> List[str]:
+    # (buildings x EnergyTypes) consumption in billing units, see get_energy_consumption_matrix
+    return [f"{_quote(energy_units_conversion_dictionary[energy_type]['source_column'])} / "
+            f"{_double_literal(energy_units_conversion_dictionary[energy_type]['conversion_factor'])}"
+            for energy_type in EnergyTypes]
+
+
+def _get_weighted_energy_use_expression(coefficients: List[float]) -> str:
+    # accumulated in EnergyTypes order like weigh_energy_consumption
+    return " + ".join(f"energy_use_{energy_index} * {_double_literal(coefficient)}"
+                      for energy_index, coefficient in enumerate(coefficients))
+
+
+def _get_threshold_expression(period: int, mixed_use: bool) -> str:
+    # the floor area of each use times the threshold of its building type, from the largest use down,
+    # see PropertyUseAreas.dot; uses of unknown building types add nothing
+    property_use_columns = PropertyUseColumns if mixed_use else PropertyUseColumns[:1]
+    return " + ".join(
+        f"CASE WHEN use_{use_index}.building_type IS NULL THEN 0.0 "
+        f"ELSE {_quote(gross_floor_area_column)} * use_{use_index}.period_{period} END"
+        for use_index, (_, gross_floor_area_column) in enumerate(property_use_columns))
+
+
+def _get_penalty_expression(carbon_emissions: str, carbon_emissions_threshold: str) -> str:
+    # NaN compares greater than any number in SQL, the NaN checks keep the NaN penalties of calculate_penalties_matrix
+    return (f"CASE WHEN {carbon_emissions} <= {carbon_emissions_threshold} AND NOT isnan({carbon_emissions}) "
+            f"AND NOT isnan({carbon_emissions_threshold}) THEN 0.0 "
+            f"ELSE {_double_literal(penalty_per_tCO2_over_threshold)} * "
+            f"({carbon_emissions} - {carbon_emissions_threshold}) END")
+
+
+def get_yearly_metrics_sql(coefficient_tables: CoefficientTables, years: List[int], metrics: List[str],
+                           mixed_use_thresholds: bool) -> str:
+    """
+    SELECT of the required metrics of every year from the joined table, one "{year}_{metric}" column
+    each, see calculate_yearly_metrics.
+    """
+    required_metrics = get_required_metrics(metrics)
+    year_indexes = coefficient_tables.get_year_indexes(years)
+    columns = ["building_row"]
+    for year, year_index in zip(years, year_indexes):
+        period = coefficient_tables.period_by_year[year_index]
+        if "carbon_emissions" in required_metrics:
+            carbon_emissions = _get_weighted_energy_use_expression(
+                coefficient_tables.carbon_emissions_by_year[year_index])
+            columns.append(f"{carbon_emissions} AS {_quote(f'{year}_carbon_emissions')}")
+        if "cost_of_energy" in required_metrics:
+            cost_of_energy = _get_weighted_energy_use_expression(coefficient_tables.cost_of_energy_by_year[year_index])
+            columns.append(f"{cost_of_energy} AS {_quote(f'{year}_cost_of_energy')}")
+        if "carbon_emissions_threshold" in required_metrics:
+            columns.append(f"{_get_threshold_expression(period, mixed_use_thresholds)} "
+                           f"AS {_quote(f'{year}_carbon_emissions_threshold')}")
+
+    property_use_columns = PropertyUseColumns if mixed_use_thresholds else PropertyUseColumns[:1]
+    threshold_joins = "".join(
+        f" LEFT JOIN thresholds AS use_{use_index} ON joined.{_quote(building_type_column)} = "
+        f"use_{use_index}.building_type" for use_index, (building_type_column, _) in enumerate(property_use_columns))
+    energy_use = ", ".join(f"{expression} AS energy_use_{energy_index}"
+                           for energy_index, expression in enumerate(_get_energy_use_expressions()))
+    select_sql = (f"SELECT {', '.join(columns)} FROM (SELECT *, {energy_use} FROM joined) AS joined"
+                  f"{threshold_joins if 'carbon_emissions_threshold' in required_metrics else ''}")
+    if "estimated_penalty" not in required_metrics:
+        return select_sql
+    # the penalties are derived from the emissions and thresholds columns
+    penalties = ", ".join(
+        f"{_get_penalty_expression(_quote(f'{year}_carbon_emissions'), _quote(f'{year}_carbon_emissions_threshold'))}"
+        f" AS {_quote(f'{year}_estimated_penalty')}" for year in years)
+    return f"SELECT *, {penalties} FROM ({select_sql})"
+
+
+def get_year_range_metrics_sql(coefficient_tables: CoefficientTables, year_ranges: List, metrics: List[str]) -> str:
+    """
+    SELECT of the metrics averaged over each year range from the yearly_metrics table, see
+    calculate_year_range_metrics.
+
+    Raises:
+        ValueError: If a year range falls outside of the coefficient tables
+    """
+    required_metrics = get_required_metrics(metrics)
+    averaged_metrics = [metric for metric in ["carbon_emissions", "cost_of_energy", "carbon_emissions_threshold"]
+                        if metric in required_metrics]
+    averages, penalties = ["building_row"], []
+    for year_range_tuple in year_ranges:
+        year_range = get_years_in_range(year_range_tuple)
+        year_range_string = get_year_range_string(year_range_tuple)
+        if len(year_range) and (year_range[0] < coefficient_tables.years[0] or
+                                year_range[-1] > coefficient_tables.years[-1]):
+            raise ValueError(f"year range {year_range_string} is outside of the years "
+                             f"{coefficient_tables.years[0]}-{coefficient_tables.years[-1]} that were calculated")
+        for metric in averaged_metrics:
+            # summed year by year and then divided, like the pandas backend
+            total = " + ".join(_quote(f"{year}_{metric}") for year in year_range)
+            average = f"({total}) / {_double_literal(len(year_range))}" if len(year_range) else "0.0"
+            averages.append(f"{average} AS {_quote(f'{year_range_string}_{metric}_per_year')}")
+        if "estimated_penalty" in required_metrics:
+            penalty = _get_penalty_expression(
+                _quote(f"{year_range_string}_carbon_emissions_per_year"),
+                _quote(f"{year_range_string}_carbon_emissions_threshold_per_year"))
+            penalties.append(f"{penalty} AS {_quote(f'{year_range_string}_estimated_penalty_per_year')}")
+    select_sql = f"SELECT {', '.join(averages)} FROM yearly_metrics"
+    if not penalties:
+        return select_sql
+    # the penalties are derived from the averaged emissions and thresholds
+    return f"SELECT *, {', '.join(penalties)} FROM ({select_sql})"
+
+
+class SqlDatasetBuilder:
+    """
+    Runs the join and the calculations of a DatasetBuilder in an embedded DuckDB database, and writes
+    its yearly and year range datasets.
+    """
+
+    def __init__(self, builder: "DatasetBuilder"):
+        """
+        Args:
+            builder (DatasetBuilder): The builder whose arguments, years, metrics, coefficient tables
+                and run report are used
+        """
+        self.builder = builder
+        self.arguments = builder.arguments
+        self.connection = None
+
+    def run(self):
+        """
+        Load, join and calculate in the engine, and write the datasets in every --output_format.
+        The engine spills to a temporary directory in the output directory, removed afterwards.
+        """
+        duckdb = _import_duckdb()
+        with tempfile.TemporaryDirectory(prefix=".sql_spill_", dir=self.arguments.output_dir) as spill_dir:
+            self.connection = duckdb.connect()
+            try:
+                self.connection.execute(f"SET temp_directory = {_string_literal(spill_dir)}")
+                if self.arguments.sql_memory_limit:
+                    self.connection.execute(f"SET memory_limit = {_string_literal(self.arguments.sql_memory_limit)}")
+                # the tables keep the order of the input files, which the outputs follow
+                self.connection.execute("SET preserve_insertion_order = true")
+                self.connection.execute(_create_macros_sql)
+                self._load_datasets()
+                self._join_datasets()
+                self._calculate_metrics()
+                self._write_datasets()
+            finally:
+                self.connection.close()
+
+    def _count(self, table: str) -> int:
+        return self.connection.execute(f"SELECT count(*) FROM {table}").fetchone()[0]
+
+    def _load_datasets(self):
+        """
+        Load the columns the calculations need of the LL97 dataset and of every LL84 dataset into the ll97
+        and ll84 tables, with the encoded BBL of each row.
+        """
+        run_report = self.builder.run_report
+        ll97_available_columns = read_csv_header(self.arguments.ll97_dataset)
+        ll84_available_columns = [read_csv_header(file_path) for file_path in self.arguments.ll84_dataset]
+        ll97_columns = select_columns(ll97_available_columns, [LL97_BBL_COLUMN], None)
+        required_ll84_columns = get_required_ll84_columns(self.arguments.mixed_use_thresholds)
+        # the union of the columns of every LL84 file, in order of appearance like pandas.concat
+        self._ll84_columns = []
+        for available_columns in ll84_available_columns:
+            self._ll84_columns.extend(
+                column for column in select_columns(available_columns, required_ll84_columns, None)
+                if column not in self._ll84_columns)
+        self._ll97_columns = [column for column in ll97_columns if column != LL97_BBL_COLUMN]
+
+        with run_report.stage("ingest") as stage:
+            self.connection.execute(
+                f"CREATE TABLE ll97 AS SELECT {', '.join(map(_quote, ll97_columns))}, "
+                f"encode_bbl({_quote(LL97_BBL_COLUMN)}) AS bbl_key "
+                f"FROM {_read_csv_sql([self.arguments.ll97_dataset])}")
+            self.connection.execute(
+                f"CREATE TABLE ll84 AS SELECT {', '.join(map(_quote, self._ll84_columns))} "
+                f"FROM {_read_csv_sql(self.arguments.ll84_dataset)}")
+            stage.rows_out = self._count("ll97") + self._count("ll84")
+
+    def _join_datasets(self):
+        """
+        Left join the first LL84 row of each BBL onto the LL97 buildings into the joined table, in LL97 order,
+        and convert the numerical columns like clean_and_count_numerical_columns. The diagnostics and the
+        value counts are those of join_ll97_ll84.
+        """
+        run_report = self.builder.run_report
+        ll84_columns = ", ".join(map(_quote, self._ll84_columns))
+        with run_report.stage("join", rows_in=self._count("ll97") + self._count("ll84")) as stage:
+            # exact duplicates are dropped before looking for BBLs that appear more than once
+            self.connection.execute(
+                f"CREATE TABLE ll84_rows AS SELECT *, encode_bbl({_quote(LL84_BBL_COLUMN)}) AS bbl_key, "
+                f"row_number() OVER (PARTITION BY encode_bbl({_quote(LL84_BBL_COLUMN)}) ORDER BY ll84_row) "
+                f"AS bbl_occurrence FROM (SELECT *, rowid AS ll84_row FROM ll84 "
+                f"QUALIFY row_number() OVER (PARTITION BY {ll84_columns} ORDER BY rowid) = 1)")
+            self._add_join_diagnostics()
+
+            ll84_values = []
+            for column in self._ll84_columns:
+                if column in numerical_columns:
+                    ll84_values.append(f"coalesce(TRY_CAST(ll84_rows.{_quote(column)} AS DOUBLE), 0.0) "
+                                       f"AS {_quote(column)}")
+                else:
+                    ll84_values.append(f"ll84_rows.{_quote(column)}")
+            ll97_values = "".join(f", ll97.{_quote(column)}" for column in self._ll97_columns)
+            self.connection.execute(
+                f"CREATE TABLE joined AS SELECT ll97.rowid AS building_row, "
+                f"normalise_bbl(ll97.{_quote(LL97_BBL_COLUMN)}) AS {_quote('BBL')}{ll97_values}, "
+                f"{', '.join(ll84_values)} FROM ll97 LEFT JOIN ll84_rows "
+                f"ON ll97.bbl_key = ll84_rows.bbl_key AND ll84_rows.bbl_occurrence = 1 "
+                f"ORDER BY ll97.rowid")
+            self._count_coerced_values()
+            stage.rows_out = self._count("joined")
+        logger.info("joined %d LL97 buildings with LL84 data", stage.rows_out)
+
+    def _get_bbls(self, query: str) -> pd.Series:
+        return self.connection.execute(query).df().iloc[:, 0].astype('string')
+
+    def _add_join_diagnostics(self):
+        diagnostics = JoinDiagnostics()
+        ll97_bbl, ll84_bbl = f"ll97.{_quote(LL97_BBL_COLUMN)}", _quote(LL84_BBL_COLUMN)
+        diagnostics.add("ll97_invalid_bbl", self._get_bbls(
+            f"SELECT {ll97_bbl} FROM ll97 WHERE bbl_key IS NULL ORDER BY rowid"))
+        diagnostics.add("ll97_duplicate_bbl", self._get_bbls(
+            f"SELECT {ll97_bbl} FROM ll97 WHERE bbl_key IS NOT NULL "
+            f"QUALIFY row_number() OVER (PARTITION BY bbl_key ORDER BY rowid) > 1 ORDER BY rowid"))
+        diagnostics.add("ll84_invalid_bbl", self._get_bbls(
+            f"SELECT {ll84_bbl} FROM ll84_rows WHERE bbl_key IS NULL ORDER BY ll84_row"))
+        diagnostics.add("ll84_duplicate_bbl", self._get_bbls(
+            f"SELECT {ll84_bbl} FROM ll84_rows WHERE bbl_occurrence > 1 AND bbl_key IN (SELECT bbl_key FROM ll97) "
+            f"ORDER BY ll84_row"))
+        diagnostics.add("unmatched_bbl", self._get_bbls(
+            f"SELECT {ll97_bbl} FROM ll97 WHERE bbl_key IS NOT NULL AND bbl_key NOT IN "
+            f"(SELECT bbl_key FROM ll84_rows WHERE bbl_key IS NOT NULL) ORDER BY rowid"))
+        diagnostics.counts["matched_bbl"] = self.connection.execute(
+            "SELECT count(*) FROM ll97 WHERE bbl_key IN "
+            "(SELECT bbl_key FROM ll84_rows WHERE bbl_key IS NOT NULL)").fetchone()[0]
+        diagnostics.log()
+        diagnostics.to_csv(self.arguments.output_dir)
+        self.builder.join_diagnostics = diagnostics
+
+    def _count_coerced_values(self):
+        # the missing values of each numerical column of the joined rows, and the values that are not numbers
+        value_counts: Dict[str, Dict[str, int]] = {}
+        for column in numerical_columns:
+            if column not in self._ll84_columns:
+                continue
+            missing_count, null_count = self.connection.execute(
+                f"SELECT count(*) FILTER (WHERE ll84_rows.{_quote(column)} IS NULL), "
+                f"count(*) FILTER (WHERE TRY_CAST(ll84_rows.{_quote(column)} AS DOUBLE) IS NULL) FROM ll97 "
+                f"LEFT JOIN ll84_rows ON ll97.bbl_key = ll84_rows.bbl_key AND ll84_rows.bbl_occurrence = 1"
+            ).fetchone()
+            value_counts[column] = {"missing": missing_count, "coerced": null_count - missing_count}
+        self.builder.run_report.coerced_values = value_counts
+
+    def _calculate_metrics(self):
+        """
+        Calculate the yearly metrics of every calculated year into the yearly_metrics table, and their
+        year range averages into the year_range_metrics table.
+        """
+        builder = self.builder
+        coefficient_tables = builder._coefficient_tables
+        thresholds = pd.DataFrame(coefficient_tables.carbon_emissions_thresholds,
+                                  columns=[f"period_{period}" for period in
+                                           range(coefficient_tables.carbon_emissions_thresholds.shape[1])])
+        thresholds.insert(0, "building_type", coefficient_tables.building_types.astype(str))
+        self.connection.register("thresholds", thresholds)
+
+        number_of_buildings = self._count("joined")
+        with builder.run_report.stage("yearly", rows_in=number_of_buildings) as stage:
+            self.connection.execute("CREATE TABLE yearly_metrics AS " + get_yearly_metrics_sql(
+                coefficient_tables, builder._calculated_years, builder.metrics,
+                self.arguments.mixed_use_thresholds))
+            stage.rows_out = number_of_buildings
+        with builder.run_report.stage("ranges", rows_in=number_of_buildings) as stage:
+            self.connection.execute("CREATE TABLE year_range_metrics AS " + get_year_range_metrics_sql(
+                coefficient_tables, builder.year_ranges, builder.metrics))
+            stage.rows_out = number_of_buildings
+
+    def _get_metric_columns(self, periods: List, column_suffix: str) -> List[str]:
+        # "{year}_{metric}{column_suffix}" columns grouped by year, like YearlyMetrics.to_dataframe
+        return [f"{period}_{metric}{column_suffix}" for period in periods for metric in self.builder.metrics]
+
+    def _write_datasets(self):
+        year_range_strings = [get_year_range_string(year_range_tuple) for year_range_tuple in self.builder.year_ranges]
+        number_of_buildings = self._count("joined")
+        for stage_name, table, periods, column_suffix, file_name in [
+                ("write_yearly", "yearly_metrics", self.builder.years, "", YEARLY_DATASET_FILE_NAME),
+                ("write_ranges", "year_range_metrics", year_range_strings, "_per_year", YEAR_RANGE_DATASET_FILE_NAME)]:
+            if CSV_FORMAT not in self.arguments.output_format:
+                continue
+            with self.builder.run_report.stage(stage_name, rows_in=number_of_buildings) as stage:
+                metric_columns = ", ".join(f"metrics.{_quote(column)}"
+                                           for column in self._get_metric_columns(periods, column_suffix))
+                self._copy_csv(f"SELECT joined.* EXCLUDE (building_row), {metric_columns} FROM joined "
+                               f"JOIN {table} AS metrics USING (building_row) ORDER BY building_row",
+                               os.path.join(self.arguments.output_dir, file_name))
+                stage.rows_out = number_of_buildings
+
+        if get_columnar_formats(self.arguments.output_format):
+            with self.builder.run_report.stage("write_columnar", rows_in=number_of_buildings) as stage:
+                stage.rows_out = self._write_parquet_datasets(year_range_strings)
+
+    def _copy(self, query: str, file_path: str, options: str):
+        self.connection.execute(f"COPY ({query}) TO {_string_literal(file_path)} {options}")
+
+    def _copy_csv(self, query: str, file_path: str):
+        # the engine quotes names such as "Fuel Oil #2 Use (kBtu)", which DataFrame.to_csv leaves unquoted,
+        # so the header is written by the csv module as pandas does and the rows copied by the engine appended
+        columns = [column[0] for column in self.connection.execute(f"SELECT * FROM ({query}) LIMIT 0").description]
+        rows_file_path = f"{file_path}.rows"
+        try:
+            self._copy(query, rows_file_path, "(FORMAT CSV, HEADER false)")
+            with open(file_path, "w", newline="") as output_file:
+                csv.writer(output_file, lineterminator="\n").writerow(columns)
+            with open(file_path, "ab") as output_file, open(rows_file_path, "rb") as rows_file:
+                shutil.copyfileobj(rows_file, output_file)
+        finally:
+            if os.path.exists(rows_file_path):
+                os.remove(rows_file_path)
+
+    def _write_parquet_datasets(self, year_range_strings: List[str]) -> int:
+        """
+        Write the building table and the long yearly and year range metrics tables laid out like
+        write_columnar_datasets, as a single part.
+
+        Returns:
+            int: Number of rows written to the metrics tables
+        """
+        compression = "uncompressed" if self.arguments.columnar_compression == "none" else \
+            self.arguments.columnar_compression
+        borough = "CAST(encode_bbl(joined.\"BBL\") // 1000000000 AS TINYINT) AS borough"
+        metrics = [metric for metric in Metrics if metric in self.builder.metrics]
+        partition_by = self.arguments.partition_by
+        rows_written = 0
+        for dataset_name, query, partition_column in [
+                (BUILDINGS_DATASET_NAME,
+                 f"SELECT joined.* EXCLUDE (building_row), {borough} FROM joined ORDER BY building_row",
+                 "borough" if partition_by == "borough" else None),
+                (YEARLY_METRICS_DATASET_NAME,
+                 self._get_long_metrics_sql("yearly_metrics", self.builder.years, "year", "", metrics, borough),
+                 partition_by),
+                (YEAR_RANGE_METRICS_DATASET_NAME,
+                 self._get_long_metrics_sql("year_range_metrics", year_range_strings, "year_range", "_per_year",
+                                            metrics, borough),
+                 "year_range" if partition_by == "year" else partition_by)]:
+            dataset_dir = get_dataset_dir(self.arguments.output_dir, dataset_name, "parquet")
+            if partition_column:
+                options = (f"(FORMAT PARQUET, COMPRESSION {_string_literal(compression)}, "
+                           f"PARTITION_BY ({partition_column}), FILENAME_PATTERN 'part-00000-{{i}}')")
+                self._copy(query, dataset_dir, options)
+            else:
+                os.makedirs(dataset_dir, exist_ok=True)
+                self._copy(query, os.path.join(dataset_dir, "part-00000-0.parquet"),
+                           f"(FORMAT PARQUET, COMPRESSION {_string_literal(compression)})")
+            if dataset_name != BUILDINGS_DATASET_NAME:
+                rows_written += self._count("joined") * len(
+                    self.builder.years if dataset_name == YEARLY_METRICS_DATASET_NAME else year_range_strings)
+        return rows_written
+
+    @staticmethod
+    def _get_long_metrics_sql(table: str, periods: List, period_column: str, column_suffix: str,
+                              metrics: List[str], borough: str) -> str:
+        # one row per building and period, building by building, like _get_metrics_table
+        selects = []
+        for period_index, period in enumerate(periods):
+            period_value = _string_literal(period) if isinstance(period, str) else f"CAST({period} AS BIGINT)"
+            metric_columns = ", ".join(f"metrics.{_quote(f'{period}_{metric}{column_suffix}')} AS {metric}"
+                                       for metric in metrics)
+            selects.append(f"SELECT joined.building_row, {period_index} AS period_index, joined.\"BBL\", {borough}, "
+                           f"{period_value} AS {period_column}, {metric_columns} "
+                           f"FROM joined JOIN {table} AS metrics USING (building_row)")
+        return (f"SELECT * EXCLUDE (building_row, period_index) FROM ({' UNION ALL '.join(selects)}) "
+                f"ORDER BY building_row, period_index")
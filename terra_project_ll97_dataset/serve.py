@@ -0,0 +1,289 @@
+#!/usr/bin/python3
+"""
+Local HTTP/JSON server answering lookups over the datasets of a build.
+
+The results are loaded once into a ResultsIndex (see dataset/results_index.py) and every request is
+answered from memory. When a new build succeeds in the output directory, the index is reloaded in the
+background and swapped in, so that requests never wait for a reload or see a partially written build.
+
+Routes:
+    GET  /health                               the loaded build and its number of buildings
+    GET  /buildings/<bbl>                      one building, 404 when it is not in the build
+    GET  /buildings?bbls=<bbl>,<bbl>           some buildings by BBL
+    GET  /buildings?property_type=&borough=    buildings by largest property use type and borough,
+                                               paged with limit and offset
+    POST /buildings {"bbls": [...]}            a batch of buildings by BBL
+    GET  /portfolio?dimensions=&metric=...     rows of the portfolio cubes, filtered by any cube column
+
+The building routes take years=<year>,<year> to return only some of the yearly metrics.
+"""
+
+import argparse
+import json
+import logging
+import os
+import threading
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from terra_project_ll97_dataset.dataset.results_index import CubeFilterColumns, ResultsIndex
+from terra_project_ll97_dataset.util.run_report import RUN_REPORT_FILE_NAME
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = 8097
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 10000
+
+
+class _RequestError(Exception):
+    def __init__(self, status: HTTPStatus, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def _get_list(query: dict, name: str) -> Optional[List[str]]:
+    # comma separated values, also accepted as repeated parameters
+    if name not in query:
+        return None
+    return [value for values in query[name] for value in values.split(",") if value]
+
+
+def _get_int(query: dict, name: str, default: Optional[int] = None) -> Optional[int]:
+    if name not in query:
+        return default
+    try:
+        return int(query[name][-1])
+    except ValueError:
+        raise _RequestError(HTTPStatus.BAD_REQUEST, f"{name} must be an integer")
+
+
+class ResultsServer(ThreadingHTTPServer):
+    """
+    HTTP server holding the ResultsIndex of the build in output_dir.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, output_dir: str, reload_interval: float = 5.0):
+        """
+        Args:
+            address: (host, port) to listen on
+            output_dir (str): Output directory of build_dataset
+            reload_interval (float): Seconds between checks for a new build, 0 to never reload
+        """
+        self.output_dir = output_dir
+        self.reload_interval = reload_interval
+        self.results = ResultsIndex.load(output_dir)
+        self._run_report_mtime = self._get_run_report_mtime()
+        self._stop_reloading = threading.Event()
+        super().__init__(address, _RequestHandler)
+        logger.info("serving %d buildings from %s", len(self.results), output_dir)
+
+    def _get_run_report_mtime(self) -> Optional[int]:
+        try:
+            return os.stat(os.path.join(self.output_dir, RUN_REPORT_FILE_NAME)).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def reload_if_rebuilt(self) -> bool:
+        """
+        Reload the results when a build has succeeded since the last load.
+        The run report is written last, once every dataset of the build is in place.
+
+        Returns:
+            bool: Whether new results were loaded
+        """
+        run_report_mtime = self._get_run_report_mtime()
+        if run_report_mtime is None or run_report_mtime == self._run_report_mtime:
+            return False
+        try:
+            with open(os.path.join(self.output_dir, RUN_REPORT_FILE_NAME)) as run_report_file:
+                status = json.load(run_report_file).get("status")
+        except (OSError, ValueError):
+            # the report is being written, read it at the next check
+            return False
+        self._run_report_mtime = run_report_mtime
+        if status != "succeeded":
+            logger.info("not reloading, the last build did not succeed (%s)", status)
+            return False
+
+        results = ResultsIndex.load(self.output_dir)
+        if results.version == self.results.version:
+            return False
+        # requests in flight keep the index they started with
+        self.results = results
+        logger.info("reloaded %d buildings from %s", len(results), self.output_dir)
+        return True
+
+    def _reload_loop(self):
+        while not self._stop_reloading.wait(self.reload_interval):
+            try:
+                self.reload_if_rebuilt()
+            except Exception:
+                logger.exception("reloading %s failed, still serving the previous build", self.output_dir)
+
+    def serve_forever(self, poll_interval: float = 0.5):
+        if self.reload_interval > 0:
+            threading.Thread(target=self._reload_loop, name="reload", daemon=True).start()
+        try:
+            super().serve_forever(poll_interval)
+        finally:
+            self._stop_reloading.set()
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    # keep-alive connections, clients issuing many lookups do not reconnect for each one
+    protocol_version = "HTTP/1.1"
+    # the headers and the body are separate writes, with Nagle's algorithm the body waits for a delayed ack
+    disable_nagle_algorithm = True
+    server: ResultsServer
+
+    def log_message(self, format, *args):
+        logger.debug("%s %s", self.address_string(), format % args)
+
+    def _send_json(self, status: HTTPStatus, body):
+        payload = json.dumps(body, separators=(",", ":")).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _handle(self, method: str):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        path = url.path.rstrip("/")
+        results = self.server.results
+        try:
+            if method == "GET" and path == "/health":
+                body = {"status": "ok", "version": results.version, "buildings": len(results)}
+            elif method == "GET" and path.startswith("/buildings/"):
+                body = self._get_building(results, unquote(path[len("/buildings/"):]), query)
+            elif path == "/buildings":
+                body = self._get_buildings(results, query, self._read_json() if method == "POST" else None)
+            elif method == "GET" and path == "/portfolio":
+                body = self._get_portfolio(results, query)
+            else:
+                raise _RequestError(HTTPStatus.NOT_FOUND, f"no route for {method} {url.path}")
+        except _RequestError as error:
+            self._send_json(error.status, {"error": str(error)})
+            return
+        self._send_json(HTTPStatus.OK, body)
+
+    def _read_json(self) -> dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            raise _RequestError(HTTPStatus.BAD_REQUEST, "the request body is not valid JSON")
+        if not isinstance(body, dict):
+            raise _RequestError(HTTPStatus.BAD_REQUEST, "the request body must be a JSON object")
+        return body
+
+    @staticmethod
+    def _get_building(results: ResultsIndex, bbl: str, query: dict) -> dict:
+        rows = results.get_rows([bbl])
+        if not rows:
+            raise _RequestError(HTTPStatus.NOT_FOUND, f"BBL {bbl} not found")
+        # a BBL appears once per LL97 row, usually a single one
+        buildings = results.get_buildings(rows, _get_list(query, "years"))
+        return buildings[0] if len(buildings) == 1 else {"buildings": buildings}
+
+    @staticmethod
+    def _get_buildings(results: ResultsIndex, query: dict, body: Optional[dict]) -> dict:
+        years = _get_list(query, "years")
+        if body is not None:
+            bbls = body.get("bbls")
+            if not isinstance(bbls, list):
+                raise _RequestError(HTTPStatus.BAD_REQUEST, "bbls must be a list of BBLs")
+            if body.get("years") is not None:
+                if not isinstance(body["years"], list):
+                    raise _RequestError(HTTPStatus.BAD_REQUEST, "years must be a list of years")
+                years = [str(year) for year in body["years"]]
+            return {"buildings": results.get_buildings(results.get_rows(bbls), years)}
+
+        bbls = _get_list(query, "bbls")
+        if bbls is not None:
+            return {"buildings": results.get_buildings(results.get_rows(bbls), years)}
+
+        property_type = query["property_type"][-1] if "property_type" in query else None
+        rows = results.filter_rows(property_type, _get_int(query, "borough"))
+        limit = min(_get_int(query, "limit", DEFAULT_LIMIT), MAX_LIMIT)
+        offset = _get_int(query, "offset", 0)
+        if limit < 0 or offset < 0:
+            raise _RequestError(HTTPStatus.BAD_REQUEST, "limit and offset must not be negative")
+        return {
+            "total": len(rows),
+            "offset": offset,
+            "buildings": results.get_buildings(rows[offset:offset + limit], years),
+        }
+
+    @staticmethod
+    def _get_portfolio(results: ResultsIndex, query: dict) -> dict:
+        unknown = set(query) - set(CubeFilterColumns)
+        if unknown:
+            raise _RequestError(HTTPStatus.BAD_REQUEST, f"unknown filters {sorted(unknown)}, "
+                                                        f"filter on {CubeFilterColumns}")
+        try:
+            rows = results.query_cubes({column: values[-1] for column, values in query.items()})
+        except LookupError as error:
+            raise _RequestError(HTTPStatus.NOT_FOUND, str(error))
+        except ValueError:
+            raise _RequestError(HTTPStatus.BAD_REQUEST, "borough must be an integer")
+        return {"rows": rows}
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the LL97 datasets of a build over HTTP/JSON")
+    parser.add_argument(
+        "-v", "--verbose",
+        action="store_true",
+        help="increase output verbosity"
+    )
+    parser.add_argument(
+        "--output_dir",
+        required=True,
+        help="output directory of build_dataset holding the csv datasets, reloaded when a new build succeeds"
+    )
+    parser.add_argument(
+        "--host",
+        default="127.0.0.1",
+        help="address to listen on"
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=DEFAULT_PORT,
+        help="port to listen on"
+    )
+    parser.add_argument(
+        "--reload_interval",
+        type=float,
+        default=5.0,
+        help="seconds between checks for a new build, 0 to never reload"
+    )
+    arguments = parser.parse_args()
+    logging.basicConfig(
+        level=logging.INFO if arguments.verbose else logging.WARNING,
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    server = ResultsServer((arguments.host, arguments.port), arguments.output_dir, arguments.reload_interval)
+    print(f"serving {len(server.results)} buildings on http://{arguments.host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,5 @@
 # Common enums and constants
-from typing import List
+from typing import Dict, List, Optional, Tuple
 
 EnergyTypes: List[str] = [
     "Electricity",
@@ -9,6 +9,27 @@ EnergyTypes: List[str] = [
     "Fuel Oil 4",
 ]
 
+# metrics calculated for each building and year, in output column order
+Metrics: List[str] = [
+    "carbon_emissions",
+    "cost_of_energy",
+    "carbon_emissions_threshold",
+    "estimated_penalty",
+]
+
+# metrics each metric is derived from, the other metrics are calculated from the energy use and floor area
+MetricDependencies: Dict[str, List[str]] = {
+    "estimated_penalty": ["carbon_emissions", "carbon_emissions_threshold"],
+}
+
+# output files written by the dataset builder
+YEARLY_DATASET_FILE_NAME = "dataset_estimated_emissions_cost_penalties_for_each_year.csv"
+YEAR_RANGE_DATASET_FILE_NAME = "dataset_estimated_emissions_cost_penalties_for_year_range.csv"
+SCENARIO_DATASET_FILE_NAME = "dataset_estimated_emissions_cost_penalties_for_each_scenario_and_year.csv"
+RETROFIT_DATASET_FILE_NAME = "dataset_minimum_cost_retrofit_for_year_range.csv"
+YEARLY_BANDS_DATASET_FILE_NAME = "dataset_estimated_emissions_cost_penalties_bands_for_each_year.csv"
+YEAR_RANGE_BANDS_DATASET_FILE_NAME = "dataset_estimated_emissions_cost_penalties_bands_for_year_range.csv"
+
 # years when the carbon emissions threshold change
 StartYears: List[int] = [2024, 2030, 2035, 2040, 2050]
 
@@ -23,3 +44,36 @@ def get_year_ranges():
             year_ranges.append((year, -1))
 
     return year_ranges
+
+
+def get_year_range_string(year_range_tuple: Tuple[int, int]) -> str:
+    return f"{year_range_tuple[0]}{'-' + str(year_range_tuple[1]) if year_range_tuple[1] > 0 else '+'}"
+
+
+def get_years_in_range(year_range_tuple: Tuple[int, int]) -> range:
+    # an open ended range such as (2050, -1) only covers its start year
+    return range(year_range_tuple[0],
+                 year_range_tuple[1] + 1 if year_range_tuple[1] > 0 else year_range_tuple[0] + 1)
+
+
+def get_required_metrics(metrics: Optional[List[str]] = None) -> List[str]:
+    """
+    The metrics that have to be calculated to output the given metrics (all metrics when None),
+    including the metrics they are derived from, in Metrics order.
+
+    Raises:
+        ValueError: If metrics is empty or names an unknown metric
+    """
+    if metrics is None:
+        metrics = Metrics
+    unknown_metrics = [metric for metric in metrics if metric not in Metrics]
+    if not metrics or unknown_metrics:
+        raise ValueError(f"unknown metrics {unknown_metrics}, expected one or more of {', '.join(Metrics)}")
+    required_metrics = set()
+    pending_metrics = list(metrics)
+    while pending_metrics:
+        metric = pending_metrics.pop()
+        if metric not in required_metrics:
+            required_metrics.add(metric)
+            pending_metrics.extend(MetricDependencies.get(metric, []))
+    return [metric for metric in Metrics if metric in required_metrics]
@@ -0,0 +1,15 @@
+# Memory usage helpers
+import resource
+import sys
+
+
+def get_peak_rss_mb(who: int = resource.RUSAGE_SELF) -> float:
+    """
+    Peak resident set size of the current process in megabytes, or with resource.RUSAGE_CHILDREN
+    of its largest terminated child process.
+    """
+    peak_rss = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes elsewhere
+    if sys.platform == "darwin":
+        return peak_rss / (1024 * 1024)
+    return peak_rss / 1024
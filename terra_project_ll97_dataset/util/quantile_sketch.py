@@ -0,0 +1,109 @@
+"""
+Streaming quantile estimates of many rows of values at once.
+
+QuantileSketch keeps a fixed number of values per row, whatever the number of values it is updated with.
+Values are collected until a row holds size of them, which are sorted and pushed to level 0. Whenever a level
+would hold two sorted buffers, they are merged and every other value is kept, alternating between the even
+and the odd values, and pushed to the next level: a value at level l stands for 2 ** l of the values seen.
+This is the compactor of the KLL and Munro-Paterson sketches, applied to every row with the same
+compactions, so that each row costs a few sorts of size values per size values seen.
+
+The rank error of a quantile is about 0.5% of the number of values for size 256 and halves
+when size doubles. The estimates are exact while no more than size values have been seen.
+Rows are independent and the estimates do not depend on how the values are split into updates.
+"""
+
+from typing import List
+
+import numpy as np
+
+
+class QuantileSketch:
+    """
+    Quantile estimates of each row of a stream of (rows x values) arrays.
+    """
+
+    def __init__(self, size: int = 256):
+        """
+        Args:
+            size (int): Number of values per row kept at each level, an even number
+        """
+        if size < 2 or size % 2:
+            raise ValueError(f"the sketch size must be an even number, not {size}")
+        self.size = size
+        self.count = 0
+        # a (rows x size) sorted buffer or None at each level
+        self._levels: List = []
+        self._pending: List[np.ndarray] = []
+        self._pending_count = 0
+        # compactions alternate between keeping the even and the odd values, which cancels out their bias
+        self._keep_odd = 0
+
+    def _push(self, level: int, values: np.ndarray):
+        while True:
+            if level == len(self._levels):
+                self._levels.append(None)
+            if self._levels[level] is None:
+                self._levels[level] = values
+                return
+            merged = np.sort(np.concatenate([self._levels[level], values], axis=1), axis=1)
+            self._levels[level] = None
+            values = merged[:, self._keep_odd::2]
+            self._keep_odd ^= 1
+            level += 1
+
+    def update(self, values: np.ndarray):
+        """
+        Add the values of a (rows x values) array, every update must have the same rows.
+        """
+        self.count += values.shape[1]
+        self._pending.append(values)
+        self._pending_count += values.shape[1]
+        while self._pending_count >= self.size:
+            pending = np.concatenate(self._pending, axis=1) if len(self._pending) > 1 else self._pending[0]
+            self._push(0, np.sort(pending[:, :self.size], axis=1))
+            remaining = pending[:, self.size:]
+            self._pending = [remaining] if remaining.shape[1] else []
+            self._pending_count = remaining.shape[1]
+
+    def quantiles(self, percentiles: List[float]) -> np.ndarray:
+        """
+        Estimate percentiles of every row, interpolated between the midpoints of the weighted values
+        like np.percentile(..., method="hazen").
+
+        Args:
+            percentiles (List[float]): Percentiles between 0 and 100
+
+        Returns:
+            np.ndarray: (rows x percentiles) estimates
+
+        Raises:
+            ValueError: If no values were added
+        """
+        if self.count == 0:
+            raise ValueError("no values were added to the sketch")
+        buffers = [(values, 2.0 ** level) for level, values in enumerate(self._levels) if values is not None]
+        buffers += [(values, 1.0) for values in self._pending]
+        values = np.concatenate([values for values, _ in buffers], axis=1)
+        weights = np.concatenate([np.full(values.shape[1], weight) for values, weight in buffers])
+
+        order = np.argsort(values, axis=1, kind="stable")
+        values = np.take_along_axis(values, order, axis=1)
+        weights = weights[order]
+        # the position of each value is the middle of the run of values it stands for
+        positions = np.cumsum(weights, axis=1) - weights / 2
+        rows = np.arange(len(values))
+        last = values.shape[1] - 1
+
+        estimates = np.empty((len(values), len(percentiles)))
+        for percentile_index, percentile in enumerate(percentiles):
+            target = percentile / 100 * self.count
+            upper = (positions < target).sum(axis=1)
+            lower = np.maximum(upper - 1, 0)
+            upper = np.minimum(upper, last)
+            lower_position, upper_position = positions[rows, lower], positions[rows, upper]
+            span = upper_position - lower_position
+            fraction = np.clip((target - lower_position) / np.where(span > 0, span, 1.0), 0.0, 1.0)
+            estimates[:, percentile_index] = values[rows, lower] + fraction * (
+                values[rows, upper] - values[rows, lower])
+        return estimates
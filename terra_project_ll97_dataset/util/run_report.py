@@ -0,0 +1,190 @@
+"""
+Instrumentation of the stages of a dataset build.
+
+Each stage records its wall time, the CPU time of the process and of the worker processes that
+finished during the stage, the rows it read and wrote, and the peak RSS reached by the end of the
+stage. The report is written as JSON next to the outputs, optionally together with a cProfile
+profile of the whole run or the peak traced Python allocations of each stage.
+"""
+
+import contextlib
+import cProfile
+import datetime
+import json
+import logging
+import os
+import resource
+import time
+import tracemalloc
+from typing import Iterator, List, Optional
+
+from terra_project_ll97_dataset.util.memory import get_peak_rss_mb
+
+logger = logging.getLogger(__name__)
+
+RUN_REPORT_FILE_NAME = "dataset_run_report.json"
+PROFILE_FILE_NAME = "dataset_run_profile.prof"
+
+# profilers that can be enabled with --profile
+Profilers: List[str] = [
+    "cprofile",
+    "tracemalloc",
+]
+
+
+def _get_cpu_seconds() -> float:
+    # user and system time of this process and of its terminated child processes
+    return sum(usage.ru_utime + usage.ru_stime
+               for usage in [resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)])
+
+
+class StageRecord:
+    """
+    Measurements of one stage. rows_out is set by the stage once its output is known.
+    """
+
+    def __init__(self, name: str, rows_in: Optional[int]):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out: Optional[int] = None
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.peak_rss_mb = 0.0
+        self.traced_peak_mb: Optional[float] = None
+
+    def to_dict(self) -> dict:
+        stage = {
+            "wall_seconds": self.wall_seconds,
+            "cpu_seconds": self.cpu_seconds,
+            "rows_in": self.rows_in,
+            "rows_out": self.rows_out,
+            "rows_per_second": self.rows_in / self.wall_seconds if self.rows_in and self.wall_seconds else None,
+            "peak_rss_mb": self.peak_rss_mb,
+        }
+        if self.traced_peak_mb is not None:
+            stage["traced_peak_mb"] = self.traced_peak_mb
+        return stage
+
+
+def _add_rows(rows: Optional[int], more_rows: Optional[int]) -> Optional[int]:
+    return None if rows is None and more_rows is None else (rows or 0) + (more_rows or 0)
+
+
+class RunReport:
+    """
+    Stage by stage measurements of a dataset build.
+    """
+
+    def __init__(self, profiler: Optional[str] = None):
+        """
+        Args:
+            profiler (Optional[str]): One of Profilers to profile the run with, or None
+        """
+        self.profiler = profiler
+        self.stages: List[StageRecord] = []
+        self.coerced_values: dict = {}
+        self.error: Optional[str] = None
+        self._started_at = None
+        self._start_time = 0.0
+        self._start_cpu_seconds = 0.0
+        self._wall_seconds = 0.0
+        self._cpu_seconds = 0.0
+        self._profile = None
+
+    def start(self):
+        self._started_at = datetime.datetime.now(datetime.timezone.utc)
+        self._start_time = time.perf_counter()
+        self._start_cpu_seconds = _get_cpu_seconds()
+        if self.profiler == "cprofile":
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        elif self.profiler == "tracemalloc":
+            tracemalloc.start()
+
+    def stop(self):
+        self._wall_seconds = time.perf_counter() - self._start_time
+        self._cpu_seconds = _get_cpu_seconds() - self._start_cpu_seconds
+        if self._profile is not None:
+            self._profile.disable()
+        if self.profiler == "tracemalloc":
+            tracemalloc.stop()
+
+    @contextlib.contextmanager
+    def stage(self, name: str, rows_in: Optional[int] = None) -> Iterator[StageRecord]:
+        """
+        Measure the code run in the with block as a stage of the build.
+
+        Args:
+            name (str): Name of the stage in the report
+            rows_in (Optional[int]): Number of rows the stage processes
+        """
+        stage = StageRecord(name, rows_in)
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        start_time = time.perf_counter()
+        start_cpu_seconds = _get_cpu_seconds()
+        try:
+            yield stage
+        finally:
+            stage.wall_seconds = time.perf_counter() - start_time
+            stage.cpu_seconds = _get_cpu_seconds() - start_cpu_seconds
+            stage.peak_rss_mb = get_peak_rss_mb()
+            if tracemalloc.is_tracing():
+                stage.traced_peak_mb = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+            self.stages.append(stage)
+            logger.info("%s: %.2f s wall, %.2f s CPU, %s rows in, %s rows out, peak RSS %.1f MB",
+                        name, stage.wall_seconds, stage.cpu_seconds, stage.rows_in, stage.rows_out,
+                        stage.peak_rss_mb)
+
+    def add_worker_stages(self, stages: List[StageRecord]):
+        """
+        Add the stages recorded by worker processes, each on its share of the rows. The stages of the same name
+        are merged into one, with the wall and CPU time and the rows of every worker added up and the largest
+        peak RSS of the workers.
+
+        Args:
+            stages (List[StageRecord]): The stages of every worker task, in any order
+        """
+        merged_stages = {}
+        for stage in stages:
+            merged_stage = merged_stages.get(stage.name)
+            if merged_stage is None:
+                merged_stages[stage.name] = merged_stage = StageRecord(stage.name, None)
+            merged_stage.rows_in = _add_rows(merged_stage.rows_in, stage.rows_in)
+            merged_stage.rows_out = _add_rows(merged_stage.rows_out, stage.rows_out)
+            merged_stage.wall_seconds += stage.wall_seconds
+            merged_stage.cpu_seconds += stage.cpu_seconds
+            merged_stage.peak_rss_mb = max(merged_stage.peak_rss_mb, stage.peak_rss_mb)
+            if stage.traced_peak_mb is not None:
+                merged_stage.traced_peak_mb = max(merged_stage.traced_peak_mb or 0.0, stage.traced_peak_mb)
+        self.stages.extend(merged_stages.values())
+
+    def to_dict(self) -> dict:
+        return {
+            "started_at": self._started_at.isoformat(timespec="seconds") if self._started_at else None,
+            "status": "failed" if self.error else "succeeded",
+            "error": self.error,
+            "wall_seconds": self._wall_seconds,
+            "cpu_seconds": self._cpu_seconds,
+            "peak_rss_mb": get_peak_rss_mb(),
+            "workers_peak_rss_mb": get_peak_rss_mb(resource.RUSAGE_CHILDREN),
+            "profiler": self.profiler,
+            "stages": {stage.name: stage.to_dict() for stage in self.stages},
+            "coerced_values": self.coerced_values,
+        }
+
+    def write(self, output_dir: str, arguments: Optional[dict] = None):
+        """
+        Write the report, and the cProfile profile when profiling with cprofile, to output_dir.
+
+        Args:
+            output_dir (str): Directory to write the report to
+            arguments (Optional[dict]): Arguments of the run, included in the report
+        """
+        report = self.to_dict()
+        report["arguments"] = arguments
+        if self._profile is not None:
+            self._profile.dump_stats(os.path.join(output_dir, PROFILE_FILE_NAME))
+            report["profile"] = PROFILE_FILE_NAME
+        with open(os.path.join(output_dir, RUN_REPORT_FILE_NAME), "w") as report_file:
+            json.dump(report, report_file, indent=2, default=str)
@@ -0,0 +1,14 @@
+import pytest
+
+from terra_project_ll97_dataset.api import DEFAULT_CARBON_EMISSIONS_BY_BUILDING_TYPE_FILE_PATH
+from terra_project_ll97_dataset.benchmark.synthetic_data import generate_datasets
+
+NUMBER_OF_BUILDINGS = 300
+
+
+@pytest.fixture(scope="session")
+def dataset_dir(tmp_path_factory) -> str:
+    """The synthetic LL97 and LL84 datasets the tests build."""
+    dataset_dir = str(tmp_path_factory.mktemp("datasets"))
+    generate_datasets(NUMBER_OF_BUILDINGS, dataset_dir, DEFAULT_CARBON_EMISSIONS_BY_BUILDING_TYPE_FILE_PATH)
+    return dataset_dir
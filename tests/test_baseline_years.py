@@ -0,0 +1,167 @@
+"""
+Builds by baseline year of two buildings that reported three years each, with known trends of their energy use.
+"""
+
+import os
+from typing import List
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from terra_project_ll97_dataset.api import build_datasets, join_datasets
+from terra_project_ll97_dataset.arguments import BuildDatasetArguments
+from terra_project_ll97_dataset.dataset.baseline_years import BASELINE_YEAR_COLUMN, REPORTING_YEARS_COLUMN, \
+    get_reporting_years, get_trend_column_names
+from terra_project_ll97_dataset.dataset.column_projection import LL84_BBL_COLUMN
+from terra_project_ll97_dataset.dataset.dataset_builder import DatasetBuilder
+from terra_project_ll97_dataset.util.common import YEARLY_DATASET_FILE_NAME
+
+ELECTRICITY_COLUMN = "Electricity Use - Grid Purchase (kWh)"
+NATURAL_GAS_COLUMN = "Natural Gas Use (kBtu)"
+
+# the gas use of 1000010001 falls by 10000 kBtu a year and its electricity use peaks in 2021,
+# 1000020002 has no electricity use and its gas use rises by 5000 kBtu a year on average
+ENERGY_USE = {
+    "1000010001": {2020: (1000.0, 100000.0), 2021: (1300.0, 90000.0), 2022: (1000.0, 80000.0)},
+    "1000020002": {2020: (0.0, 50000.0), 2021: (0.0, 70000.0), 2022: (0.0, 60000.0)},
+}
+EXPECTED_TRENDS = {
+    ("1000010001", ELECTRICITY_COLUMN): (0.0, {2020: 1100.0, 2021: 1100.0, 2022: 1100.0}),
+    ("1000010001", NATURAL_GAS_COLUMN): (-10000.0, {2020: 100000.0, 2021: 90000.0, 2022: 80000.0}),
+    ("1000020002", ELECTRICITY_COLUMN): (0.0, {2020: 0.0, 2021: 0.0, 2022: 0.0}),
+    ("1000020002", NATURAL_GAS_COLUMN): (5000.0, {2020: 55000.0, 2021: 60000.0, 2022: 65000.0}),
+}
+
+
+def get_ll97_df() -> pd.DataFrame:
+    # 1000030003 has no LL84 data
+    return pd.DataFrame({"BBL": ["1000010001", "1000020002", "1000030003"]})
+
+
+def get_ll84_frame(year: int, energy_use: dict = None) -> pd.DataFrame:
+    energy_use = energy_use or ENERGY_USE
+    df = pd.DataFrame({
+        LL84_BBL_COLUMN: list(energy_use),
+        "Largest Property Use Type": "Office",
+        "Largest Property Use Type - Gross Floor Area (ft²)": 10000.0,
+        "2nd Largest Property Use Type - Gross Floor Area (ft²)": None,
+        "3rd Largest Property Use Type - Gross Floor Area (ft²)": None,
+        ELECTRICITY_COLUMN: [building_use[year][0] for building_use in energy_use.values()],
+        NATURAL_GAS_COLUMN: [building_use[year][1] for building_use in energy_use.values()],
+        "District Steam Use (kBtu)": 0.0,
+        "Fuel Oil #2 Use (kBtu)": 0.0,
+        "Fuel Oil #4 Use (kBtu)": 0.0,
+    })
+    # older exports only have the end date of the reporting period
+    if year == 2020:
+        df["Year Ending"] = f"12/31/{year}"
+    else:
+        df["Calendar Year"] = year
+    return df
+
+
+def get_ll84_frames(energy_use: dict = None) -> List[pd.DataFrame]:
+    # most recent year first, the rows are ordered by year in the output
+    return [get_ll84_frame(year, energy_use) for year in [2022, 2021, 2020]]
+
+
+def test_get_reporting_years():
+    ll84_df = pd.DataFrame({
+        "Calendar Year": ["2021", None, None, "unknown"],
+        "Year Ending": ["12/31/2020", "12/31/2019", None, None],
+    })
+
+    assert get_reporting_years(ll84_df).tolist() == [2021, 2019, pd.NA, pd.NA]
+    with pytest.raises(ValueError):
+        get_reporting_years(ll84_df.drop(columns=["Calendar Year", "Year Ending"]))
+
+
+def test_trend_features():
+    joined_df, _, _ = join_datasets(get_ll97_df(), get_ll84_frames(), by_baseline_year=True, trend_features=True)
+
+    assert joined_df.index.tolist() == ["1000010001"] * 3 + ["1000020002"] * 3 + ["1000030003"]
+    assert joined_df[BASELINE_YEAR_COLUMN].tolist() == [2020, 2021, 2022] * 2 + [pd.NA]
+    assert joined_df[REPORTING_YEARS_COLUMN].tolist()[:6] == [3.0] * 6
+    assert np.isnan(joined_df[REPORTING_YEARS_COLUMN].iloc[6])
+    for (bbl, column), (expected_slope, expected_trend) in EXPECTED_TRENDS.items():
+        slope_column, trend_column = get_trend_column_names(column)
+        building_df = joined_df.loc[bbl]
+        assert building_df[slope_column].to_numpy() == pytest.approx([expected_slope] * 3), (bbl, column)
+        assert building_df[trend_column].to_numpy() == pytest.approx(
+            [expected_trend[year] for year in building_df[BASELINE_YEAR_COLUMN]]), (bbl, column)
+
+
+def test_single_reporting_year_has_no_slope():
+    joined_df, _, _ = join_datasets(get_ll97_df(), [get_ll84_frame(2021)], by_baseline_year=True,
+                                    trend_features=True)
+    slope_column, trend_column = get_trend_column_names(NATURAL_GAS_COLUMN)
+
+    assert joined_df[REPORTING_YEARS_COLUMN].tolist()[:2] == [1.0, 1.0]
+    assert joined_df[slope_column].isna().all()
+    assert joined_df[trend_column].tolist()[:2] == [90000.0, 70000.0]
+
+
+def test_projection_from_trend_matches_projection_from_the_fitted_use():
+    fitted_energy_use = {
+        bbl: {year: tuple(EXPECTED_TRENDS[(bbl, column)][1][year]
+                          for column in [ELECTRICITY_COLUMN, NATURAL_GAS_COLUMN])
+              for year in building_use}
+        for bbl, building_use in ENERGY_USE.items()}
+
+    results = build_datasets(get_ll97_df(), get_ll84_frames(), by_baseline_year=True, trend_features=True,
+                             project_from_trend=True)
+    fitted_results = build_datasets(get_ll97_df(), get_ll84_frames(fitted_energy_use), by_baseline_year=True)
+    reported_results = build_datasets(get_ll97_df(), get_ll84_frames(), by_baseline_year=True)
+
+    metrics = results.get_yearly_metrics()
+    np.testing.assert_allclose(metrics.to_numpy(), fitted_results.get_yearly_metrics().to_numpy(), rtol=1e-12)
+    # the 2021 electricity peak of 1000010001 is spread over its three years
+    reported_metrics = reported_results.get_yearly_metrics()
+    carbon_emissions = metrics["2030_carbon_emissions"].to_numpy()
+    reported_carbon_emissions = reported_metrics["2030_carbon_emissions"].to_numpy()
+    assert carbon_emissions[1] < reported_carbon_emissions[1]
+    assert (carbon_emissions[[0, 2]] > reported_carbon_emissions[[0, 2]]).all()
+    assert results.buildings[NATURAL_GAS_COLUMN].tolist()[3:6] == pytest.approx([55000.0, 60000.0, 65000.0])
+
+
+def test_project_from_trend_requires_trend_features():
+    with pytest.raises(ValueError):
+        build_datasets(get_ll97_df(), get_ll84_frames(), by_baseline_year=True, project_from_trend=True)
+
+
+def parse_arguments(input_dir, *arguments: str):
+    """
+    Builder arguments reading the LL97 buildings and the LL84 frames of every year written to input_dir.
+    """
+    ll97_file_path = str(input_dir / "ll97.csv")
+    get_ll97_df().to_csv(ll97_file_path, index=False)
+    ll84_file_paths = []
+    for ll84_df in get_ll84_frames():
+        ll84_file_paths.append(str(input_dir / f"ll84-{len(ll84_file_paths)}.csv"))
+        ll84_df.to_csv(ll84_file_paths[-1], index=False)
+    return BuildDatasetArguments().parser.parse_args(
+        ["--ll97_dataset", ll97_file_path, "--ll84_dataset", *ll84_file_paths, "--no_cache"] + list(arguments))
+
+
+def test_build_by_baseline_year(tmp_path):
+    output_dir = str(tmp_path / "output")
+    os.makedirs(output_dir)
+
+    DatasetBuilder(parse_arguments(tmp_path, "--output_dir", output_dir, "--by_baseline_year", "--trend_features",
+                                   "--project_from_trend")).run()
+
+    yearly_df = pd.read_csv(os.path.join(output_dir, YEARLY_DATASET_FILE_NAME), dtype={"BBL": str})
+    assert list(yearly_df.columns[:2]) == ["BBL", BASELINE_YEAR_COLUMN]
+    assert yearly_df["BBL"].tolist() == ["1000010001"] * 3 + ["1000020002"] * 3 + ["1000030003"]
+    assert yearly_df[BASELINE_YEAR_COLUMN].tolist()[:6] == [2020, 2021, 2022] * 2
+    assert yearly_df[get_trend_column_names(NATURAL_GAS_COLUMN)[0]].tolist()[:6] == pytest.approx(
+        [-10000.0] * 3 + [5000.0] * 3)
+    assert yearly_df[NATURAL_GAS_COLUMN].tolist()[3:6] == pytest.approx([55000.0, 60000.0, 65000.0])
+
+
+def test_build_rejects_project_from_trend_without_trend_features(tmp_path):
+    arguments = parse_arguments(tmp_path, "--output_dir", str(tmp_path), "--by_baseline_year", "--project_from_trend")
+
+    with pytest.raises(ValueError, match="--trend_features"):
+        DatasetBuilder(arguments)
@@ -0,0 +1,115 @@
+"""
+Equivalence of the ways the dataset builder can calculate the same datasets. The vectorized, row wise,
+multi-process, chunked and incremental builds of the synthetic benchmark data must write byte-identical files.
+"""
+
+import json
+import os
+from typing import Dict
+
+import pandas as pd
+import pytest
+
+from terra_project_ll97_dataset.arguments import BuildDatasetArguments
+from terra_project_ll97_dataset.benchmark.synthetic_data import LL84_FILE_NAME, LL97_FILE_NAME
+from terra_project_ll97_dataset.dataset.column_projection import LL84_BBL_COLUMN
+from terra_project_ll97_dataset.dataset.dataset_builder import DatasetBuilder
+from terra_project_ll97_dataset.dataset.incremental_build import FINGERPRINTS_FILE_NAME, INCREMENTAL_REPORT_FILE_NAME
+from terra_project_ll97_dataset.util.common import YEAR_RANGE_DATASET_FILE_NAME
+
+
+def build(dataset_dir: str, output_dir: str, *arguments: str) -> Dict[str, bytes]:
+    """
+    Build the datasets of dataset_dir with the given builder arguments.
+
+    Returns:
+        Dict[str, bytes]: The content of each CSV file written to output_dir
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    DatasetBuilder(BuildDatasetArguments().parser.parse_args([
+        "--ll97_dataset", os.path.join(dataset_dir, LL97_FILE_NAME),
+        "--ll84_dataset", os.path.join(dataset_dir, LL84_FILE_NAME),
+        "--output_dir", output_dir,
+        "--no_cache",
+    ] + list(arguments))).run()
+
+    outputs = {}
+    for file_name in sorted(os.listdir(output_dir)):
+        if file_name.endswith(".csv"):
+            with open(os.path.join(output_dir, file_name), "rb") as output_file:
+                outputs[file_name] = output_file.read()
+    return outputs
+
+
+def assert_same_outputs(outputs: Dict[str, bytes], expected_outputs: Dict[str, bytes]):
+    assert list(outputs) == list(expected_outputs)
+    for file_name, content in outputs.items():
+        assert content == expected_outputs[file_name], f"{file_name} differs"
+
+
+@pytest.fixture(scope="module")
+def vectorized_outputs(dataset_dir, tmp_path_factory) -> Dict[str, bytes]:
+    return build(dataset_dir, str(tmp_path_factory.mktemp("vectorized")))
+
+
+@pytest.mark.parametrize("arguments", [
+    ["--row_wise"],
+    ["--workers", "3"],
+    ["--ll84_chunksize", "100"],
+])
+def test_build_matches_vectorized_build(dataset_dir, vectorized_outputs, tmp_path, arguments):
+    outputs = build(dataset_dir, str(tmp_path), *arguments)
+
+    assert_same_outputs(outputs, vectorized_outputs)
+
+
+def test_mixed_use_build_matches_row_wise_build(dataset_dir, tmp_path):
+    outputs = build(dataset_dir, str(tmp_path / "vectorized"), "--mixed_use_thresholds")
+    row_wise_outputs = build(dataset_dir, str(tmp_path / "row_wise"), "--mixed_use_thresholds", "--row_wise")
+
+    assert_same_outputs(outputs, row_wise_outputs)
+
+
+def test_incremental_build_matches_full_build(dataset_dir, tmp_path):
+    previous_output_dir = str(tmp_path / "previous")
+    build(dataset_dir, previous_output_dir)
+
+    # revise the energy use of some buildings and drop the LL84 data of others
+    changed_dataset_dir = str(tmp_path / "changed")
+    os.makedirs(changed_dataset_dir)
+    ll84_df = pd.read_csv(os.path.join(dataset_dir, LL84_FILE_NAME), dtype=str, keep_default_na=False)
+    ll84_df.loc[ll84_df.index[:20], "Natural Gas Use (kBtu)"] = "12345.6"
+    ll84_df = ll84_df[~ll84_df[LL84_BBL_COLUMN].isin(ll84_df[LL84_BBL_COLUMN].iloc[20:25])]
+    ll84_df.to_csv(os.path.join(changed_dataset_dir, LL84_FILE_NAME), index=False)
+    with open(os.path.join(dataset_dir, LL97_FILE_NAME), "rb") as ll97_file:
+        with open(os.path.join(changed_dataset_dir, LL97_FILE_NAME), "wb") as changed_ll97_file:
+            changed_ll97_file.write(ll97_file.read())
+
+    incremental_output_dir = str(tmp_path / "incremental")
+    outputs = build(changed_dataset_dir, incremental_output_dir, "--previous_output_dir", previous_output_dir)
+    full_outputs = build(changed_dataset_dir, str(tmp_path / "full"))
+
+    with open(os.path.join(incremental_output_dir, INCREMENTAL_REPORT_FILE_NAME)) as report_file:
+        incremental_report = json.load(report_file)
+    assert not incremental_report["full_rebuild"]
+    assert incremental_report["changed"] > 0
+    assert_same_outputs(outputs, full_outputs)
+
+
+def test_incremental_build_without_previous_csv_datasets_builds_every_building(dataset_dir, vectorized_outputs,
+                                                                                 tmp_path):
+    pytest.importorskip("pyarrow")
+    # a columnar only run writes neither the csv datasets nor the fingerprints of their rows
+    parquet_output_dir = str(tmp_path / "parquet")
+    build(dataset_dir, parquet_output_dir, "--output_format", "parquet")
+    assert not os.path.exists(os.path.join(parquet_output_dir, FINGERPRINTS_FILE_NAME))
+
+    # a previous run whose fingerprints remain but whose year range dataset was removed
+    csv_output_dir = str(tmp_path / "csv")
+    build(dataset_dir, csv_output_dir)
+    os.remove(os.path.join(csv_output_dir, YEAR_RANGE_DATASET_FILE_NAME))
+
+    for previous_output_dir in [parquet_output_dir, csv_output_dir]:
+        outputs = build(dataset_dir, str(tmp_path / "incremental"), "--previous_output_dir", previous_output_dir)
+
+        assert_same_outputs(outputs, vectorized_outputs)
@@ -0,0 +1,84 @@
+"""
+Portfolio cubes of a build of the synthetic benchmark data, checked against a groupby over its wide datasets.
+"""
+
+import os
+
+import pandas as pd
+import pytest
+
+from terra_project_ll97_dataset.dataset.columnar_output import get_boroughs
+from terra_project_ll97_dataset.dataset.portfolio_cubes import CubeDimensions, CubePercentiles, \
+    PORTFOLIO_CUBES_FILE_NAME, PROPERTY_TYPE_COLUMN
+from terra_project_ll97_dataset.dataset.results_index import _split_metric_columns
+from terra_project_ll97_dataset.util.common import YEAR_RANGE_DATASET_FILE_NAME, YEARLY_DATASET_FILE_NAME
+from tests.test_dataset_builder import assert_same_outputs, build
+
+CUBE_KEYS = ["dimensions", "borough", "property_type", "period_type", "period", "metric"]
+
+
+def read_long_metrics(file_path: str, period_type: str, column_suffix: str) -> pd.DataFrame:
+    """
+    The metrics of a wide dataset as one row per building, period and metric, with the building's
+    borough and property type.
+    """
+    wide_df = pd.read_csv(file_path, dtype={"BBL": str}, float_precision="round_trip")
+    periods, metrics, _ = _split_metric_columns(list(wide_df.columns))
+    frames = []
+    for period in periods:
+        for metric in metrics:
+            frames.append(pd.DataFrame({
+                "borough": get_boroughs(pd.Index(wide_df["BBL"])).to_numpy(),
+                "property_type": wide_df[PROPERTY_TYPE_COLUMN].astype(object).to_numpy(),
+                "period_type": period_type,
+                "period": period,
+                "metric": metric,
+                "value": wide_df[f"{period}_{metric}{column_suffix}"].to_numpy(),
+            }))
+    return pd.concat(frames, ignore_index=True)
+
+
+def get_expected_cubes(output_dir: str) -> pd.DataFrame:
+    long_df = pd.concat([
+        read_long_metrics(os.path.join(output_dir, YEARLY_DATASET_FILE_NAME), "year", ""),
+        read_long_metrics(os.path.join(output_dir, YEAR_RANGE_DATASET_FILE_NAME), "year_range", "_per_year"),
+    ], ignore_index=True)
+    cubes = []
+    for dimensions in CubeDimensions:
+        grouped = long_df.groupby(dimensions + ["period_type", "period", "metric"], dropna=False)["value"]
+        # the number of buildings of each group, and the sum and percentiles of their values
+        cube = grouped.agg(["size", "sum"]).rename(columns={"size": "count"})
+        for percentile in CubePercentiles:
+            cube[f"p{percentile}"] = grouped.quantile(percentile / 100)
+        cube = cube.reset_index().assign(dimensions=",".join(dimensions) or "all")
+        cubes.append(cube.reindex(columns=CUBE_KEYS + ["count", "sum"] +
+                                  [f"p{percentile}" for percentile in CubePercentiles]))
+    return pd.concat(cubes, ignore_index=True)
+
+
+def test_cubes_match_groupby_of_the_datasets(dataset_dir, tmp_path):
+    output_dir = str(tmp_path)
+    build(dataset_dir, output_dir, "--portfolio_cubes")
+    cubes_df = pd.read_csv(os.path.join(output_dir, f"{PORTFOLIO_CUBES_FILE_NAME}.csv"),
+                           dtype={"period": str, "borough": "Int8"}, float_precision="round_trip")
+    expected_cubes_df = get_expected_cubes(output_dir)
+
+    assert len(cubes_df) == len(expected_cubes_df)
+    for df in [cubes_df, expected_cubes_df]:
+        df["borough"] = df["borough"].astype("Int8")
+        df["property_type"] = df["property_type"].astype(object).where(df["property_type"].notna(), None)
+    merged_df = cubes_df.merge(expected_cubes_df, on=CUBE_KEYS, how="outer", suffixes=("", "_expected"),
+                               indicator=True)
+    assert (merged_df["_merge"] == "both").all()
+    assert (merged_df["count"] == merged_df["count_expected"]).all()
+    for column in ["sum"] + [f"p{percentile}" for percentile in CubePercentiles]:
+        assert merged_df[column].to_numpy() == pytest.approx(merged_df[f"{column}_expected"].to_numpy(),
+                                                             rel=1e-9, abs=1e-6), column
+
+
+def test_sharded_cubes_match_single_process_cubes(dataset_dir, tmp_path):
+    outputs = build(dataset_dir, str(tmp_path / "sharded"), "--portfolio_cubes", "--workers", "3")
+    single_process_outputs = build(dataset_dir, str(tmp_path / "single_process"), "--portfolio_cubes")
+
+    assert f"{PORTFOLIO_CUBES_FILE_NAME}.csv" in outputs
+    assert_same_outputs(outputs, single_process_outputs)
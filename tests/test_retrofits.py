@@ -0,0 +1,144 @@
+"""
+Minimum cost retrofit of a few buildings with hand-computed costs, and the "none" action of the synthetic
+benchmark data checked against its year range metrics.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from terra_project_ll97_dataset.api import build_datasets
+from terra_project_ll97_dataset.benchmark.synthetic_data import LL84_FILE_NAME, LL97_FILE_NAME
+from terra_project_ll97_dataset.calculator.coefficient_tables import CoefficientTables
+from terra_project_ll97_dataset.calculator.retrofits import KBTU_PER_KWH, NO_RETROFIT_ACTION, \
+    calculate_minimum_cost_retrofits, load_retrofit_grid
+from terra_project_ll97_dataset.util.common import Metrics, StartYears, get_year_range_string, get_year_ranges
+
+NATURAL_GAS_COLUMN = "Natural Gas Use (kBtu)"
+KBTU_PER_THERM = 100.0
+
+RETROFIT_ACTIONS = pd.DataFrame({
+    "action": ["insulation", "insulation_again", "heat_pump"],
+    "change": ["reduction", "reduction", "conversion"],
+    "energy_type": ["Natural Gas", "Natural Gas", "Natural Gas"],
+    "value": [0.5, 0.5, 1.0],
+    "to_energy_type": [None, None, "Electricity"],
+    "energy_ratio": [None, None, 0.3],
+    "capital_cost": [2.0, 2.0, 2.0],
+})
+
+
+def get_coefficient_tables() -> CoefficientTables:
+    # 0.0001 tCO2 and $0.2 per kWh of electricity, 0.005 tCO2 per therm of gas at $1.0 in 2024 and $1.2 in 2025,
+    # and a threshold of 0.01 tCO2 per square foot of office
+    return CoefficientTables(
+        [2024, 2025],
+        np.array([[0.0001, 0.005, 0.0, 0.0, 0.0]] * 2),
+        np.array([[0.2, 1.0, 0.0, 0.0, 0.0], [0.2, 1.2, 0.0, 0.0, 0.0]]),
+        ["Office"],
+        np.full((1, len(StartYears)), 0.01))
+
+
+def get_buildings(natural_gas_kbtu) -> pd.DataFrame:
+    return pd.DataFrame({
+        "Largest Property Use Type": "Office",
+        "Largest Property Use Type - Gross Floor Area (ft²)": 1000.0,
+        NATURAL_GAS_COLUMN: natural_gas_kbtu,
+    })
+
+
+@pytest.fixture(scope="module")
+def solutions():
+    buildings = get_buildings([300000.0, 100000.0, 500000.0, 10000000.0, np.nan])
+    solutions = calculate_minimum_cost_retrofits(load_retrofit_grid(RETROFIT_ACTIONS), buildings,
+                                                 get_coefficient_tables(), [(2024, 2025)])
+    return {column: values[:, 0] for column, values in solutions.items()}
+
+
+def test_grid_starts_with_the_none_action():
+    retrofit_grid = load_retrofit_grid(RETROFIT_ACTIONS)
+
+    assert retrofit_grid.names == [NO_RETROFIT_ACTION, "insulation", "insulation_again", "heat_pump"]
+    assert retrofit_grid.capital_cost_per_sq_foot.tolist() == [0.0, 2.0, 2.0, 2.0]
+    # a therm of gas becomes 0.3 * 100 / 3.412 kWh of electricity
+    assert retrofit_grid.transforms[3, 1, 0] == pytest.approx(0.3 * KBTU_PER_THERM / KBTU_PER_KWH)
+    assert retrofit_grid.transforms[3, 1, 1] == 0.0
+
+
+def test_cheapest_compliant_action(solutions):
+    # 3000 therms emit 15 tCO2 over a threshold of 10, insulating halves them for $2000 of capital,
+    # converting them to 26377 kWh emits 2.6 tCO2 for as much capital but costs more energy
+    assert solutions["action"][0] == 1
+    assert solutions["capital_cost"][0] == pytest.approx(2000.0)
+    assert solutions["carbon_emissions_per_year"][0] == pytest.approx(7.5)
+    assert solutions["cost_of_energy_per_year"][0] == pytest.approx(1500 * (1.0 + 1.2) / 2)
+    assert solutions["total_cost"][0] == pytest.approx(2000.0 + 1500 * (1.0 + 1.2))
+    assert solutions["carbon_emissions_threshold_per_year"][0] == pytest.approx(10.0)
+    assert solutions["baseline_estimated_penalty_per_year"][0] == pytest.approx(268 * (15.0 - 10.0))
+
+
+def test_compliant_building_keeps_the_none_action(solutions):
+    # 1000 therms emit 5 tCO2, insulating them would save $1100 of energy for $2000
+    assert solutions["action"][1] == 0
+    assert solutions["capital_cost"][1] == 0.0
+    assert solutions["carbon_emissions_per_year"][1] == pytest.approx(5.0)
+    assert solutions["total_cost"][1] == pytest.approx(1000 * (1.0 + 1.2))
+    assert solutions["baseline_estimated_penalty_per_year"][1] == 0.0
+
+
+def test_conversion_to_electricity(solutions):
+    # insulating 5000 therms still emits 12.5 tCO2, only converting them to electricity complies
+    electricity_kwh = 5000 * KBTU_PER_THERM * 0.3 / KBTU_PER_KWH
+
+    assert solutions["action"][2] == 3
+    assert solutions["capital_cost"][2] == pytest.approx(2000.0)
+    assert solutions["carbon_emissions_per_year"][2] == pytest.approx(electricity_kwh * 0.0001)
+    assert solutions["cost_of_energy_per_year"][2] == pytest.approx(electricity_kwh * 0.2)
+    assert solutions["total_cost"][2] == pytest.approx(2000.0 + 2 * electricity_kwh * 0.2)
+
+
+@pytest.mark.parametrize("building_index", [3, 4])
+def test_no_compliant_action(solutions, building_index):
+    # 100000 therms emit 88 tCO2 even as electricity, and a building without energy use never complies
+    assert solutions["action"][building_index] == -1
+    for column in ["capital_cost", "total_cost", "carbon_emissions_per_year", "cost_of_energy_per_year"]:
+        assert np.isnan(solutions[column][building_index]), column
+    assert solutions["carbon_emissions_threshold_per_year"][building_index] == pytest.approx(10.0)
+
+
+def test_ties_keep_the_earlier_action():
+    retrofit_grid = load_retrofit_grid(RETROFIT_ACTIONS.iloc[[1, 0, 2]])
+    solutions = calculate_minimum_cost_retrofits(retrofit_grid, get_buildings([300000.0]),
+                                                 get_coefficient_tables(), [(2024, 2025)])
+
+    assert retrofit_grid.names[1] == "insulation_again"
+    assert solutions["action"][0, 0] == 1
+
+
+def test_none_action_matches_year_range_metrics(dataset_dir):
+    ll97_df = pd.read_csv(os.path.join(dataset_dir, LL97_FILE_NAME), dtype={"BBL": str})
+    ll84_df = pd.read_csv(os.path.join(dataset_dir, LL84_FILE_NAME), dtype=str)
+    results = build_datasets(ll97_df, ll84_df, retrofit_actions=RETROFIT_ACTIONS)
+    year_range_metrics = results.get_year_range_metrics()
+
+    retrofits = results.retrofits
+    year_ranges = get_year_ranges()
+    assert (retrofits["action"] == NO_RETROFIT_ACTION).any()
+    for range_index, year_range_tuple in enumerate(year_ranges):
+        year_range = get_year_range_string(year_range_tuple)
+        metric_columns = {metric: year_range_metrics[f"{year_range}_{metric}_per_year"].to_numpy()
+                          for metric in Metrics}
+        # one row per building and year range, in building order, BBLs may repeat
+        range_retrofits = retrofits.iloc[range_index::len(year_ranges)]
+        assert (range_retrofits["year_range"] == year_range).all()
+        none_rows = (range_retrofits["action"] == NO_RETROFIT_ACTION).to_numpy()
+        # bit for bit, the averages are accumulated in the same order
+        np.testing.assert_array_equal(range_retrofits["carbon_emissions_threshold_per_year"].to_numpy(),
+                                      metric_columns["carbon_emissions_threshold"])
+        np.testing.assert_array_equal(range_retrofits["baseline_estimated_penalty_per_year"].to_numpy(),
+                                      metric_columns["estimated_penalty"])
+        for metric in ["carbon_emissions", "cost_of_energy"]:
+            np.testing.assert_array_equal(range_retrofits[f"{metric}_per_year"].to_numpy()[none_rows],
+                                          metric_columns[metric][none_rows])
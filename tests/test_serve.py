@@ -0,0 +1,169 @@
+"""
+Routes of the results server, over the datasets of a build of the synthetic benchmark data.
+"""
+
+import http.client
+import json
+import os
+import threading
+
+import pandas as pd
+import pytest
+
+from terra_project_ll97_dataset.dataset.portfolio_cubes import PROPERTY_TYPE_COLUMN
+from terra_project_ll97_dataset.serve import ResultsServer
+from terra_project_ll97_dataset.util.common import YEARLY_DATASET_FILE_NAME
+from tests.test_dataset_builder import build
+
+
+def request(server: ResultsServer, method: str, path: str, body=None):
+    """
+    Returns:
+        Tuple[int, dict]: The status and the JSON body of the response
+    """
+    connection = http.client.HTTPConnection(*server.server_address, timeout=10)
+    try:
+        payload = body if isinstance(body, (bytes, type(None))) else json.dumps(body).encode()
+        connection.request(method, path, body=payload)
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        connection.close()
+
+
+def start_server(output_dir: str) -> ResultsServer:
+    server = ResultsServer(("127.0.0.1", 0), output_dir, reload_interval=0)
+    threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+    return server
+
+
+def stop_server(server: ResultsServer):
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(scope="module")
+def output_dir(dataset_dir, tmp_path_factory) -> str:
+    output_dir = str(tmp_path_factory.mktemp("served"))
+    build(dataset_dir, output_dir, "--portfolio_cubes")
+    return output_dir
+
+
+@pytest.fixture(scope="module")
+def yearly_df(output_dir) -> pd.DataFrame:
+    return pd.read_csv(os.path.join(output_dir, YEARLY_DATASET_FILE_NAME), dtype={"BBL": str},
+                       float_precision="round_trip")
+
+
+@pytest.fixture(scope="module")
+def server(output_dir):
+    server = start_server(output_dir)
+    yield server
+    stop_server(server)
+
+
+def test_health(server, yearly_df):
+    status, body = request(server, "GET", "/health")
+
+    assert status == 200
+    assert body["buildings"] == len(yearly_df)
+    assert body["version"] == server.results.version
+
+
+def test_get_building(server, yearly_df):
+    row = yearly_df.iloc[0]
+    bbl = row["BBL"]
+
+    status, body = request(server, "GET", f"/buildings/{bbl[0]}-{bbl[1:6]}-{bbl[6:]}?years=2030,2035")
+
+    assert status == 200
+    assert body["building"]["BBL"] == bbl
+    assert list(body["yearly"]) == ["2030", "2035"]
+    assert body["yearly"]["2030"]["carbon_emissions"] == row["2030_carbon_emissions"]
+    assert list(body["year_ranges"]) == ["2024-2029", "2030-2034", "2035-2039", "2040-2049", "2050+"]
+
+
+def test_get_missing_building(server):
+    status, body = request(server, "GET", "/buildings/9999999999")
+
+    assert status == 404
+    assert "9999999999" in body["error"]
+
+
+def test_get_and_post_buildings_by_bbl(server, yearly_df):
+    bbls = list(yearly_df["BBL"].dropna().iloc[[3, 1]])
+
+    get_status, get_body = request(server, "GET", f"/buildings?bbls={','.join(bbls)}&years=2040")
+    post_status, post_body = request(server, "POST", "/buildings", {"bbls": bbls, "years": [2040]})
+
+    assert get_status == post_status == 200
+    assert get_body == post_body
+    assert [building["building"]["BBL"] for building in get_body["buildings"]] == bbls
+    assert all(list(building["yearly"]) == ["2040"] for building in get_body["buildings"])
+
+
+def test_filter_buildings(server, yearly_df):
+    property_type = yearly_df[PROPERTY_TYPE_COLUMN].mode()[0]
+    expected_bbls = list(yearly_df.loc[(yearly_df[PROPERTY_TYPE_COLUMN] == property_type) &
+                                       (yearly_df["BBL"].str[0] == "1"), "BBL"])
+
+    status, body = request(server, "GET", f"/buildings?property_type={property_type.replace(' ', '+')}"
+                                          f"&borough=1&limit=2&offset=1")
+
+    assert status == 200
+    assert len(expected_bbls) >= 3
+    assert body["total"] == len(expected_bbls)
+    assert [building["building"]["BBL"] for building in body["buildings"]] == expected_bbls[1:3]
+
+
+def test_portfolio(server, yearly_df):
+    status, body = request(server, "GET", "/portfolio?dimensions=all&period=2030&metric=carbon_emissions")
+
+    assert status == 200
+    assert len(body["rows"]) == 1
+    assert body["rows"][0]["count"] == yearly_df["2030_carbon_emissions"].notna().sum()
+    assert body["rows"][0]["sum"] == pytest.approx(yearly_df["2030_carbon_emissions"].sum())
+
+
+@pytest.mark.parametrize("method, path, body, expected_status", [
+    ("POST", "/buildings", {"bbls": "1000010001"}, 400),
+    ("POST", "/buildings", {"bbls": [], "years": 2030}, 400),
+    ("POST", "/buildings", b"{not json", 400),
+    ("POST", "/buildings", [], 400),
+    ("GET", "/buildings?limit=ten", None, 400),
+    ("GET", "/buildings?offset=-1", None, 400),
+    ("GET", "/portfolio?floor_area=1", None, 400),
+    ("GET", "/portfolio?borough=manhattan", None, 400),
+    ("GET", "/retrofits", None, 404),
+    ("POST", "/health", {}, 404),
+])
+def test_bad_requests(server, method, path, body, expected_status):
+    status, response_body = request(server, method, path, body)
+
+    assert status == expected_status
+    assert response_body["error"]
+
+
+def test_reload_after_rebuild(dataset_dir, tmp_path):
+    output_dir = str(tmp_path)
+    build(dataset_dir, output_dir)
+    server = start_server(output_dir)
+    try:
+        _, health = request(server, "GET", "/health")
+        status, body = request(server, "GET", "/portfolio")
+        assert status == 404
+        assert not server.reload_if_rebuilt()
+
+        build(dataset_dir, output_dir, "--years", "2030", "--portfolio_cubes")
+
+        assert server.reload_if_rebuilt()
+        _, reloaded_health = request(server, "GET", "/health")
+        assert reloaded_health["version"] != health["version"]
+        status, body = request(server, "GET", "/buildings?limit=1")
+        assert status == 200
+        assert list(body["buildings"][0]["yearly"]) == ["2030"]
+        status, body = request(server, "GET", "/portfolio?dimensions=all&period=2030&metric=carbon_emissions")
+        assert status == 200
+        assert len(body["rows"]) == 1
+    finally:
+        stop_server(server)
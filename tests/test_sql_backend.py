@@ -0,0 +1,21 @@
+"""
+Equivalence of the duckdb and pandas backends. Both must write byte-identical CSV files for the synthetic
+benchmark data. Skipped when duckdb is not installed.
+"""
+
+import pytest
+
+from tests.test_dataset_builder import assert_same_outputs, build
+
+pytest.importorskip("duckdb")
+
+
+@pytest.mark.parametrize("arguments", [
+    [],
+    ["--mixed_use_thresholds"],
+])
+def test_sql_build_matches_pandas_build(dataset_dir, tmp_path, arguments):
+    outputs = build(dataset_dir, str(tmp_path / "sql"), "--backend", "duckdb", *arguments)
+    pandas_outputs = build(dataset_dir, str(tmp_path / "pandas"), *arguments)
+
+    assert_same_outputs(outputs, pandas_outputs)